@@ -0,0 +1,352 @@
+"""
+Admission control for the interactive routes (bounded lanes with FIFO queues),
+per-user rate limits, and ingestion yielding to interactive requests.
+"""
+import os
+import sys
+import threading
+import time
+import hashlib
+import hmac
+import math
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from config import (
+    CHAT_MAX_CONCURRENCY, CHAT_MAX_QUEUE, CHAT_MAX_QUEUE_WAIT_MS, QUESTION_MAX_CONCURRENCY, QUESTION_MAX_QUEUE,
+    QUESTION_MAX_QUEUE_WAIT_MS, RETRY_AFTER_MAX, CHAT_RATE_LIMIT_PER_MINUTE, QUESTION_RATE_LIMIT_PER_MINUTE,
+    INGEST_RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST, RATE_LIMIT_USER_SECRET, RATE_LIMIT_MAX_USERS, INGEST_NICE,
+    INGEST_YIELD_ENABLED, INGEST_YIELD_MAX_MS, INGEST_YIELD_POLL_INTERVAL,
+)
+from telemetry import QUEUE_DEPTH, ADMISSION_DECISIONS, LANE_ACTIVE, INGEST_YIELD_SECONDS, record_stage
+from retrieval import query_embedder
+
+
+# --- 1. ADMISSION CONTROL, RATE LIMITS AND INGESTION YIELDING ---
+
+class AdmissionRejected(Exception):
+    """
+    A request refused before any work was done for it: 429 when its user is
+    over their rate limit, 503 when its lane is overloaded. Served as
+    {"error", "retry_after"} with a Retry-After header.
+    """
+
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = int(min(RETRY_AFTER_MAX, max(1, math.ceil(retry_after))))
+
+    def to_dict(self):
+        return {"error": str(self), "status": self.status, "retry_after": self.retry_after}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["status"], data["error"], data["retry_after"])
+
+
+class LaneWaiter:
+    """A request queued in a Lane. wake() is called, from any thread, when it is given a slot."""
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+
+
+class LaneSlot:
+    """A slot held in a Lane; release() (or leaving the `with` block) gives it to the next waiter."""
+
+    def __init__(self, lane):
+        self.lane = lane
+        self.acquired_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.lane.release(time.monotonic() - self.acquired_at)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class Lane:
+    """
+    Concurrency limit with a bounded wait queue for one kind of request.
+    Free slots go to waiters in arrival order. A request is refused with
+    AdmissionRejected (503) instead of queueing when the queue is full or
+    its expected wait is longer than `max_wait_ms`, and gives up once it has
+    waited that long. The expected wait comes from a moving average of how
+    long requests hold their slot, which also sets the Retry-After.
+    """
+
+    def __init__(self, name, limit, max_queue, max_wait_ms):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait_ms / 1000.0
+        self.active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self._hold_seconds = None  # moving average of slot hold times
+        self._active_gauge = LANE_ACTIVE.labels(name)
+        self._depth = QUEUE_DEPTH.labels(f"lane_{name}")
+        self.outcomes = {}
+        admission_lanes[name] = self
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def _count(self, outcome):
+        # Called with self._lock held
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        ADMISSION_DECISIONS.labels(self.name, outcome).inc()
+
+    def _expected_wait(self, position):
+        """Seconds until the waiter at queue `position` (0-based) gets a slot, or None before any slot was released."""
+        if self._hold_seconds is None:
+            return None
+        # With every slot busy, one frees up every hold time / limit on average
+        return self._hold_seconds * (position + 1) / self.limit
+
+    def _rejection(self):
+        retry_after = self._expected_wait(len(self._waiters)) or 1
+        return AdmissionRejected(503, f"The service is busy ({self.name} requests). Please try again shortly.",
+                                 retry_after)
+
+    def _overloaded(self, outcome):
+        self._count(outcome)
+        return self._rejection()
+
+    def enter(self, wake):
+        """
+        Takes a free slot (returns None) or queues the caller (returns its
+        LaneWaiter, whose wake() is called when it gets a slot).
+        Raises AdmissionRejected if the caller can't be queued.
+        """
+        with self._lock:
+            if self.limit <= 0 or (self.active < self.limit and not self._waiters):
+                self.active += 1
+                self._active_gauge.inc()
+                self._count("admitted")
+                return None
+            if len(self._waiters) >= self.max_queue:
+                raise self._overloaded("queue_full")
+            expected_wait = self._expected_wait(len(self._waiters))
+            if expected_wait is not None and expected_wait > self.max_wait:
+                raise self._overloaded("wait_exceeded")
+            waiter = LaneWaiter(wake)
+            self._waiters.append(waiter)
+            self._depth.inc()
+            return waiter
+
+    def abandon(self, waiter):
+        """
+        Takes a waiter that gave up out of the queue. Returns True if it was
+        given a slot in the meantime (the caller then holds that slot).
+        """
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            self._depth.dec()
+            self._count("wait_exceeded")
+            return False
+
+    def release(self, held_seconds):
+        with self._lock:
+            if self._hold_seconds is None:
+                self._hold_seconds = held_seconds
+            else:
+                self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * held_seconds
+            waiter = self._waiters.popleft() if self._waiters else None
+            if waiter is None:
+                self.active -= 1
+                self._active_gauge.dec()
+            else:
+                # The slot passes straight to the next waiter
+                waiter.granted = True
+                self._depth.dec()
+                self._count("queued")
+        if waiter is not None:
+            waiter.wake()
+
+    def acquire(self):
+        """Blocks until the calling thread holds a slot and returns it as a LaneSlot."""
+        granted = threading.Event()
+        waiter = self.enter(granted.set)
+        if waiter is not None:
+            if not granted.wait(self.max_wait) and not self.abandon(waiter):
+                raise self.rejection()
+            record_stage("admission_wait", time.monotonic() - waiter.enqueued_at)
+        return LaneSlot(self)
+
+    def rejection(self):
+        """The AdmissionRejected for a request that gave up waiting (see abandon)."""
+        with self._lock:
+            return self._rejection()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "active": self.active,
+                "queued": len(self._waiters),
+                "max_queue": self.max_queue,
+                "max_wait_ms": round(1000 * self.max_wait),
+                "avg_hold_ms": round(1000 * self._hold_seconds, 1) if self._hold_seconds is not None else None,
+                "outcomes": dict(self.outcomes),
+            }
+
+
+class RateLimiter:
+    """
+    Per-user token buckets: each user gets `per_minute` requests a minute
+    and may spend up to `burst` of them at once. check() raises
+    AdmissionRejected (429) for a request over the limit.
+    """
+
+    def __init__(self, name, per_minute, burst=RATE_LIMIT_BURST):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.capacity = max(1, burst)
+        self._buckets = OrderedDict()  # user -> (tokens, updated_at), least recently used first
+        self._lock = threading.Lock()
+
+    def check(self, user):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(user, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated_at) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[user] = (tokens - 1 if allowed else tokens, now)
+            if len(self._buckets) > RATE_LIMIT_MAX_USERS:
+                self._prune(now)
+            if allowed:
+                return
+            ADMISSION_DECISIONS.labels(self.name, "rate_limited").inc()
+        raise AdmissionRejected(429, "Too many requests. Please slow down and try again shortly.",
+                                (1 - tokens) / self.rate)
+
+    def _prune(self, now):
+        # Buckets that have refilled completely hold no state worth keeping
+        full_after = self.capacity / self.rate
+        while len(self._buckets) > RATE_LIMIT_MAX_USERS:
+            user, (_, updated_at) = next(iter(self._buckets.items()))
+            if now - updated_at < full_after:
+                break
+            del self._buckets[user]
+
+    def stats(self):
+        with self._lock:
+            return {"per_minute": round(self.rate * 60, 2), "burst": self.capacity, "users": len(self._buckets)}
+
+
+admission_lanes = {}
+chat_lane = Lane("chat", CHAT_MAX_CONCURRENCY, CHAT_MAX_QUEUE, CHAT_MAX_QUEUE_WAIT_MS)
+question_lane = Lane("questions", QUESTION_MAX_CONCURRENCY, QUESTION_MAX_QUEUE, QUESTION_MAX_QUEUE_WAIT_MS)
+
+chat_rate_limiter = RateLimiter("chat", CHAT_RATE_LIMIT_PER_MINUTE)
+question_rate_limiter = RateLimiter("questions", QUESTION_RATE_LIMIT_PER_MINUTE)
+ingest_rate_limiter = RateLimiter("ingest", INGEST_RATE_LIMIT_PER_MINUTE)
+RATE_LIMITED_ROUTES = {
+    "/chatbot-api/chat": chat_rate_limiter,
+    "/chatbot-api/chat/stream": chat_rate_limiter,
+    "/chatbot-api/generate-questions": question_rate_limiter,
+    "/chatbot-api/ingest": ingest_rate_limiter,
+    "/chatbot-api/ingest/bulk": ingest_rate_limiter,
+}
+
+def signed_user_id(headers):
+    """The X-User-ID of a request if X-User-Signature proves it was signed with RATE_LIMIT_USER_SECRET, else None."""
+    user_id = headers.get("X-User-ID")
+    signature = headers.get("X-User-Signature")
+    if not (RATE_LIMIT_USER_SECRET and user_id and signature):
+        return None
+    expected = hmac.new(RATE_LIMIT_USER_SECRET.encode(), user_id.encode(), hashlib.sha256).hexdigest()
+    return user_id if hmac.compare_digest(expected, signature.strip().lower()) else None
+
+def request_user(headers, client_addr):
+    """Who a request counts against for rate limits: a signed user ID, else the client IP."""
+    user_id = signed_user_id(headers)
+    if user_id:
+        return "user:" + user_id[:128]
+    # Render's proxy appends the address it saw; anything before it came from the client
+    forwarded = [hop.strip() for hop in (headers.get("X-Forwarded-For") or "").split(",") if hop.strip()]
+    if forwarded:
+        return "ip:" + forwarded[-1]
+    return "ip:" + (client_addr or "unknown")
+
+def check_rate_limit(route, method, headers, client_addr):
+    """Raises AdmissionRejected (429) if the request's user is over the rate limit of its route."""
+    limiter = RATE_LIMITED_ROUTES.get(route)
+    if limiter is not None and method == "POST":
+        limiter.check(request_user(headers, client_addr))
+
+def rejection_headers(error):
+    return {"Retry-After": str(error.retry_after)}
+
+def admission_stats():
+    return {
+        "lanes": {name: lane.stats() for name, lane in admission_lanes.items()},
+        "rate_limits": {limiter.name: limiter.stats()
+                        for limiter in (chat_rate_limiter, question_rate_limiter, ingest_rate_limiter)},
+        "ingest_yield": {"enabled": INGEST_YIELD_ENABLED, "nice": INGEST_NICE,
+                         "interactive_cpu_requests": interactive_cpu_requests},
+    }
+
+
+# Chat and question requests currently embedding, retrieving or reranking:
+# latency-sensitive CPU work that ingestion pauses for (see yield_to_interactive)
+interactive_cpu_requests = 0
+interactive_cpu_lock = threading.Lock()
+
+@contextmanager
+def interactive_cpu_work():
+    """Marks the enclosed block as CPU work of an interactive request."""
+    global interactive_cpu_requests
+    with interactive_cpu_lock:
+        interactive_cpu_requests += 1
+    try:
+        yield
+    finally:
+        with interactive_cpu_lock:
+            interactive_cpu_requests -= 1
+
+def interactive_demand():
+    """True while chat or question requests need the CPU or are waiting for a lane."""
+    return (interactive_cpu_requests > 0 or query_embedder.queued > 0
+            or any(lane.queued for lane in admission_lanes.values()))
+
+def yield_to_interactive():
+    """
+    Called by ingestion between units of CPU work (pages, embedding batches):
+    waits while interactive_demand(), for at most INGEST_YIELD_MAX_MS, so a
+    large upload can't hold chat back for longer than one unit of its work.
+    """
+    if not INGEST_YIELD_ENABLED or not interactive_demand():
+        return
+    started = time.perf_counter()
+    deadline = started + INGEST_YIELD_MAX_MS / 1000.0
+    while interactive_demand() and time.perf_counter() < deadline:
+        time.sleep(INGEST_YIELD_POLL_INTERVAL)
+    seconds = time.perf_counter() - started
+    INGEST_YIELD_SECONDS.inc(seconds)
+    record_stage("ingest_yield", seconds)
+
+def lower_thread_priority():
+    """Runs the calling thread at INGEST_NICE (Linux, where each thread has its own nice value)."""
+    if INGEST_NICE <= 0 or not sys.platform.startswith("linux"):
+        return
+    try:
+        thread_id = threading.get_native_id()
+        niceness = min(19, os.getpriority(os.PRIO_PROCESS, thread_id) + INGEST_NICE)
+        os.setpriority(os.PRIO_PROCESS, thread_id, niceness)
+    except OSError as e:
+        print(f"[Ingest] Could not lower the priority of {threading.current_thread().name}: {e}")
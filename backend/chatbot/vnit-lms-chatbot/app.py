@@ -1,40 +1,36 @@
 import os
-import random
+import sys
 import threading
-import requests
-import fitz  # PyMuPDF
-import io
-import mimetypes
-import zipfile
-from flask import Flask, request, jsonify
+import uuid
+from concurrent.futures import Future
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
-import chromadb
-from sentence_transformers import SentenceTransformer
-from groq import Groq
-from dotenv import load_dotenv
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from pptx import Presentation
-from PIL import Image
-import easyocr
-import numpy as np
+from prometheus_client import CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
 import cv2
 
-# --- 1. LOAD ENVIRONMENT VARIABLES ---
-print("Loading environment variables...")
-load_dotenv()  # This loads the .env file
+from config import (
+    EMBEDDING_BACKEND, INGEST_BULK_MAX_ITEMS, INGEST_PRIORITIES, RERANK_ENABLED, CHATBOT_ROLE, INGEST_ENABLED,
+    OCR_ENABLED,
+)
+from telemetry import INGEST_QUEUED_JOBS, RequestTrace
+from groq_keys import groq_pool
+from models import serving, serving_index, serving_cache_key, components, REQUIRED_COMPONENTS, warm_up_components
+from caches import query_embedding_cache, retrieval_cache, answer_cache
+from retrieval import query_embedder, read_scope, rerank_status
+from admission import AdmissionRejected, question_lane, check_rate_limit, rejection_headers, admission_stats
+from flights import single_flight_stats, question_flight_key, chat_response, question_flights
+from ingestion import (
+    get_embedding_parity, get_google_drive_file_id, DownloadError, save_upload, QueueFullError,
+    count_queued_jobs, submit_ingest_job, submit_ingest_batch, get_ingest_batch, get_ingest_job,
+    ingest_pipeline, is_ingest_owner, start_ingest_election,
+)
+from indexes import list_search_indexes
+from questions import read_question_request, read_refresh_flag, answer_question_request
+from chat import join_chat_flight, sse_event
+
+
+# --- 1. SET UP FLASK APP AND CORS ---
 
-# --- 2. GET, SPLIT, AND CHOOSE API KEY ---
-keys_string = os.environ.get("GROQ_API_KEYS")
-if not keys_string:
-    print("Error: GROQ_API_KEYS not found in .env file.")
-    print("Please create a .env file and add: GROQ_API_KEYS='key1,key2,...'")
-    exit()
-
-api_key_list = keys_string.split(',')
-selected_api_key = random.choice(api_key_list)
-print(f"Using one of {len(api_key_list)} Groq API keys.")
-
-# --- 3. SET UP FLASK APP AND CORS ---
 app = Flask(__name__)
 # This allows your teammates' frontend (on a different domain) to call your API
 # Allow CORS from all origins (useful for development). If you need to restrict origins,
@@ -47,633 +43,422 @@ else:
     origins_list = [origin.strip() for origin in allowed_origins.split(",")]
     CORS(app, resources={r"/*": {"origins": origins_list}}, supports_credentials=True)
 
-# --- 4. GLOBAL CONSTANTS ---
-DB_PATH = "./chroma_db"
-COLLECTION_NAME = "vnit_lms"
-CHUNK_SIZE = 1000
-CHUNK_OVERLAP = 200
-GROQ_MODEL = "llama-3.1-8b-instant" # Replaced the decommissioned model
-EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
-
-# --- 5. INITIALIZE ALL MODELS AND DB (Load them once on startup) ---
-print("--- Initializing models and connecting to DB... ---")
-try:
-    groq_client = Groq(api_key=selected_api_key)
-    print("Groq client initialized.")
-    
-    embedding_model = SentenceTransformer(EMBEDDING_MODEL)
-    print(f"Embedding model '{EMBEDDING_MODEL}' loaded.")
-    
-    # Initialize EasyOCR reader (supports English by default)
-    # This will download models on first run - takes a few minutes
-    print("Initializing EasyOCR (this may take a minute on first run)...")
-    ocr_reader = easyocr.Reader(['en'], gpu=False)  # Set gpu=True if you have CUDA
-    print("EasyOCR initialized successfully.")
-    
-    db_client = chromadb.PersistentClient(path=DB_PATH)
-    collection = db_client.get_or_create_collection(name=COLLECTION_NAME)
-    print(f"Connected to ChromaDB at '{DB_PATH}'. Collection '{COLLECTION_NAME}' loaded.")
-    
-    print("--- Server is ready to receive requests. ---")
-except Exception as e:
-    print(f"--- FATAL STARTUP ERROR: {e} ---")
-    print("Please check your API keys, model names, and file permissions.")
-    exit()
 
+# --- 2. REQUEST TRACING ---
 
-# --- 6. INGESTION HELPER FUNCTIONS ---
+@app.before_request
+def begin_request_trace():
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.trace = RequestTrace(route, request.method, request.headers, request.args)
 
-def get_google_drive_file_id(url):
-    """Extracts the file ID from various Google Drive share link formats."""
-    try:
-        # Format: /file/d/FILE_ID/view
-        if '/d/' in url:
-            return url.split('/d/')[1].split('/')[0]
-        # Format: ?id=FILE_ID
-        if 'id=' in url:
-            return url.split('id=')[1].split('&')[0]
-        print(f"Could not parse File ID from URL: {url}")
-        return None
-    except Exception as e:
-        print(f"Error parsing Google Drive URL: {e}")
-        return None
-
-def detect_file_type(content, content_type=None, filename=None):
-    """
-    Detects file type from content, content-type header, or filename.
-    Returns: 'pdf', 'ppt', 'pptx', 'image', or None
-    """
-    # Check content-type header first
-    if content_type:
-        if 'pdf' in content_type.lower():
-            return 'pdf'
-        if 'presentation' in content_type.lower() or 'powerpoint' in content_type.lower():
-            return 'pptx'
-        if 'image' in content_type.lower():
-            return 'image'
-    
-    # Check filename extension
-    if filename:
-        ext = filename.lower().split('.')[-1] if '.' in filename else ''
-        if ext in ['pdf']:
-            return 'pdf'
-        if ext in ['ppt', 'pptx']:
-            return 'pptx'
-        if ext in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'webp']:
-            return 'image'
-    
-    # Check magic bytes (file signatures)
-    if content:
-        # PDF: starts with %PDF
-        if content[:4] == b'%PDF':
-            return 'pdf'
-        # PPTX: ZIP archive with specific structure (starts with PK)
-        if content[:2] == b'PK':
-            # Check if it's a PPTX by looking for specific files inside
-            try:
-                with zipfile.ZipFile(io.BytesIO(content)) as zip_file:
-                    if 'ppt/presentation.xml' in zip_file.namelist():
-                        return 'pptx'
-            except:
-                pass
-        # Images: Check common image signatures
-        if content[:2] == b'\xff\xd8':  # JPEG
-            return 'image'
-        if content[:8] == b'\x89PNG\r\n\x1a\n':  # PNG
-            return 'image'
-        if content[:6] in [b'GIF87a', b'GIF89a']:  # GIF
-            return 'image'
-        if content[:2] == b'BM':  # BMP
-            return 'image'
-    
-    return None
 
-def extract_text_from_pdf(content):
-    """Extracts text from PDF. Uses OCR if text extraction fails."""
-    full_text = ""
-    try:
-        with io.BytesIO(content) as pdf_stream:
-            with fitz.open(stream=pdf_stream, filetype="pdf") as doc:
-                for page_num, page in enumerate(doc):
-                    # Try direct text extraction first
-                    page_text = page.get_text()
-                    if page_text.strip():
-                        full_text += f"\n--- Page {page_num + 1} ---\n" + page_text
-                    else:
-                        # If no text, it's likely a scanned/image-based PDF - use OCR
-                        print(f"[PDF] Page {page_num + 1} has no text, attempting OCR...")
-                        try:
-                            # Convert PDF page to image
-                            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))  # 2x zoom for better OCR
-                            img_data = pix.tobytes("png")
-                            img = Image.open(io.BytesIO(img_data))
-                            img_array = np.array(img)
-                            
-                            # Perform OCR
-                            ocr_results = ocr_reader.readtext(img_array)
-                            page_text = "\n".join([result[1] for result in ocr_results])
-                            if page_text.strip():
-                                full_text += f"\n--- Page {page_num + 1} (OCR) ---\n" + page_text
-                        except Exception as ocr_error:
-                            print(f"[PDF] OCR failed for page {page_num + 1}: {ocr_error}")
-    except Exception as e:
-        print(f"[PDF] Error extracting text from PDF: {e}")
-        return None
-    return full_text.strip()
-
-def extract_text_from_ppt(content):
-    """Extracts text from PowerPoint presentation."""
-    full_text = ""
-    try:
-        with io.BytesIO(content) as ppt_stream:
-            prs = Presentation(ppt_stream)
-            for slide_num, slide in enumerate(prs.slides):
-                slide_text = f"\n--- Slide {slide_num + 1} ---\n"
-                # Extract text from all shapes in the slide
-                for shape in slide.shapes:
-                    if hasattr(shape, "text") and shape.text:
-                        slide_text += shape.text + "\n"
-                    # Also check for text in tables
-                    if hasattr(shape, "table"):
-                        for row in shape.table.rows:
-                            for cell in row.cells:
-                                if cell.text:
-                                    slide_text += cell.text + " "
-                        slide_text += "\n"
-                full_text += slide_text
-    except Exception as e:
-        print(f"[PPT] Error extracting text from PPT: {e}")
-        return None
-    return full_text.strip()
-
-def extract_text_from_image(content):
-    """Extracts text from image using OCR (supports handwritten notes)."""
-    try:
-        # Load image
-        img = Image.open(io.BytesIO(content))
-        img_array = np.array(img)
-        
-        # Convert to RGB if needed (EasyOCR expects RGB)
-        if len(img_array.shape) == 2:  # Grayscale
-            img_array = cv2.cvtColor(img_array, cv2.COLOR_GRAY2RGB)
-        elif img_array.shape[2] == 4:  # RGBA
-            img_array = cv2.cvtColor(img_array, cv2.COLOR_RGBA2RGB)
-        
-        # Perform OCR
-        print("[Image] Performing OCR...")
-        ocr_results = ocr_reader.readtext(img_array)
-        
-        # Combine all detected text
-        full_text = "\n".join([result[1] for result in ocr_results])
-        
-        if not full_text.strip():
-            print("[Image] No text detected in image.")
-            return None
-        
-        return full_text.strip()
-    except Exception as e:
-        print(f"[Image] Error extracting text from image: {e}")
-        return None
-
-def process_drive_link(drive_url):
+@app.after_request
+def end_request_trace(response):
+    trace = g.get("trace")
+    if trace is not None:
+        response.headers.update(trace.response_headers())
+        # Runs once the body has been sent, so streamed answers are timed (and profiled) to the end
+        response.call_on_close(lambda: trace.finish(response.status_code))
+    return response
+
+
+# --- 3. SERVICE START-UP ---
+
+def configure_worker_threads(threads):
+    """Caps torch and OpenCV compute threads so forked workers don't oversubscribe the CPU."""
+    # Torch is only loaded with the torch embedding backend or the reranker; if it
+    # isn't, don't import it here (OMP_NUM_THREADS already covers a later import).
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads)
+    cv2.setNumThreads(threads)
+
+
+services_started = False
+services_lock = threading.Lock()
+
+def start_services(threads_per_worker=None):
     """
-    The full background task:
-    1. Downloads file from Google Drive.
-    2. Detects file type (PDF, PPT, image, etc.)
-    3. Extracts text (with OCR for images and scanned PDFs).
-    4. Chunks the text.
-    5. Embeds and stores in ChromaDB.
+    Starts the background work of a serving process: warms up the models and,
+    on replicas that ingest, joins the ingestion owner election. Called by
+    `python app.py`, by gunicorn's post_fork hook (pre-fork mode, with the
+    worker's compute thread limit) and by the ASGI app's lifespan; later calls
+    do nothing. Importing app starts nothing, so reindex.py and the tests can.
     """
-    print(f"[Background Ingest] Starting task for: {drive_url}")
-    
-    try:
-        # 1. Get File ID and create download link
-        file_id = get_google_drive_file_id(drive_url)
-        if not file_id:
-            print("[Background Ingest] Error: Could not parse Google Drive File ID.")
+    global services_started
+    with services_lock:
+        if services_started:
             return
+        services_started = True
+    if threads_per_worker:
+        configure_worker_threads(threads_per_worker)
+    print(f"--- Warming up {', '.join(REQUIRED_COMPONENTS)} in the background (role: {CHATBOT_ROLE}) ---")
+    warm_up_components()
+    if RERANK_ENABLED:
+        warm_up_components(["reranker"])
+    if INGEST_ENABLED:
+        start_ingest_election()
 
-        download_url = f"https://drive.google.com/uc?export=download&id={file_id}"
-        
-        # 2. Download the file
-        print(f"[Background Ingest] Downloading file: {file_id}...")
-        response = requests.get(download_url)
-        
-        # Handle Google's large file confirmation redirect
-        if "confirm=t" in response.url: 
-            print("[Background Ingest] Large file. Following confirmation redirect...")
-            response = requests.get(download_url, cookies=response.cookies)
-
-        # Check if the download failed
-        if response.status_code != 200:
-            print(f"[Background Ingest] Error: Failed to download file. Status: {response.status_code}")
-            print("Please ensure the link is public ('Anyone with the link').")
-            return
-        
-        # Check if we actually got a file
-        if not response.content:
-            print("[Background Ingest] Error: Downloaded file is empty.")
-            return
 
-        content_type = response.headers.get('content-type', '')
-        print(f"[Background Ingest] File downloaded ({len(response.content)} bytes). Content-Type: {content_type}")
+# --- 4. RATE LIMITS AND ADMISSION ERRORS ---
 
-        # 3. Detect file type
-        file_type = detect_file_type(response.content, content_type)
-        if not file_type:
-            print("[Background Ingest] Error: Could not detect file type. Supported: PDF, PPT/PPTX, Images (JPG, PNG, etc.)")
-            return
-        
-        print(f"[Background Ingest] Detected file type: {file_type}")
-
-        # 4. Extract text based on file type
-        full_text = None
-        if file_type == 'pdf':
-            print("[Background Ingest] Extracting text from PDF...")
-            full_text = extract_text_from_pdf(response.content)
-        elif file_type == 'pptx':
-            print("[Background Ingest] Extracting text from PowerPoint...")
-            full_text = extract_text_from_ppt(response.content)
-        elif file_type == 'image':
-            print("[Background Ingest] Extracting text from image using OCR...")
-            full_text = extract_text_from_image(response.content)
-        else:
-            print(f"[Background Ingest] Error: Unsupported file type: {file_type}")
-            return
-        
-        if not full_text or not full_text.strip():
-            print("[Background Ingest] Error: No text extracted from file.")
-            return
+@app.before_request
+def enforce_rate_limit():
+    # Registered after begin_request_trace, so refused requests are still traced
+    if request.url_rule is not None:
+        check_rate_limit(request.url_rule.rule, request.method, request.headers, request.remote_addr)
 
-        print(f"[Background Ingest] Extracted {len(full_text)} characters of text.")
 
-        # 5. Chunk the text
-        print("[Background Ingest] Chunking text...")
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=CHUNK_SIZE,
-            chunk_overlap=CHUNK_OVERLAP,
-            length_function=len
-        )
-        text_chunks = text_splitter.split_text(full_text)
-        print(f"[Background Ingest] Split into {len(text_chunks)} chunks.")
+@app.errorhandler(AdmissionRejected)
+def handle_admission_rejected(error):
+    return jsonify({"error": str(error), "retry_after": error.retry_after}), error.status, rejection_headers(error)
 
-        if not text_chunks:
-            print("[Background Ingest] Error: Text could not be split into chunks.")
-            return
 
-        # 6. Embed and Store
-        print(f"[Background Ingest] Generating embeddings for {len(text_chunks)} chunks...")
-        embeddings = embedding_model.encode(text_chunks, show_progress_bar=True)
-        
-        # Create unique IDs based on file ID and chunk index
-        ids = [f"drive_{file_id}_{file_type}_chunk_{i}" for i in range(len(text_chunks))]
-        
-        print(f"[Background Ingest] Adding {len(ids)} chunks to ChromaDB...")
-        collection.add(
-            embeddings=embeddings.tolist(),
-            documents=text_chunks,
-            ids=ids
-        )
-        
-        print(f"--- [Background Ingest] COMPLETED: Ingestion for {file_type} file {file_id} ---")
-
-    except Exception as e:
-        print(f"--- [Background Ingest] FAILED: {e} ---")
-        import traceback
-        traceback.print_exc()
-
-
-# --- 7. API ENDPOINT: /chatbot-api/ingest (For Professors) ---
+# --- 5. API ENDPOINTS: /chatbot-api/ingest (For Professors) ---
 
 @app.route("/chatbot-api/ingest", methods=["POST"])
 def handle_ingestion():
     """
     API endpoint to trigger the ingestion of a new document.
-    It takes a Google Drive link, returns an "Accepted" response immediately,
-    and starts the processing in a background thread.
+    It takes a Google Drive link, returns an "Accepted" response immediately
+    with a job ID, and queues the processing for the ingestion workers.
     """
     data = request.json
     drive_link = data.get("drive_link")
+    priority = data.get("priority", "normal")
 
     if not drive_link:
         return jsonify({"error": "No 'drive_link' provided"}), 400
 
-    print(f"\n--- New Ingestion Request Received ---")
+    # Optional courseId / materialId, stored with every chunk for scoped searches
+    scope, error = read_scope(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    if not INGEST_ENABLED:
+        return jsonify({"error": "This replica does not run ingestion (CHATBOT_ROLE=chat)."}), 503
+
+    if priority not in INGEST_PRIORITIES:
+        return jsonify({"error": f"'priority' must be one of {list(INGEST_PRIORITIES)}"}), 400
+
+    print("\n--- New Ingestion Request Received ---")
     print(f"Link: {drive_link}")
+    if scope:
+        print(f"Scope: {scope}")
 
-    # Start the ingestion process in a separate thread
-    # This allows the API to return an immediate response
-    thread = threading.Thread(target=process_drive_link, args=(drive_link,))
-    thread.start()
+    try:
+        job = submit_ingest_job(drive_link, priority, {"scope": scope})
+    except QueueFullError:
+        response = jsonify({"error": "Ingestion queue is full. Please try again later."})
+        response.headers["Retry-After"] = "60"
+        return response, 503
 
     # Return a 202 "Accepted" status
     return jsonify({
-        "message": "Ingestion process started. The document will be available for queries in a few minutes."
+        "message": "Ingestion job queued. Poll the status URL to follow its progress.",
+        "job_id": job.job_id,
+        "status_url": f"/chatbot-api/ingest/{job.job_id}",
+        "queued_jobs": count_queued_jobs(),
+    }), 202
+
+
+@app.route("/chatbot-api/ingest/<job_id>", methods=["GET"])
+def handle_ingestion_status(job_id):
+    """Reports the stage, progress and timings of an ingestion job."""
+    job = get_ingest_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job ID"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/chatbot-api/ingest/bulk", methods=["POST"])
+def handle_bulk_ingestion():
+    """
+    Queues many documents in one request, e.g. a whole course. Accepts either
+    - JSON: {"drive_links": [link, ...], "courseId", "materialId", "priority"},
+      where a link may also be {"drive_link", "courseId", "materialId"}; or
+    - multipart/form-data: one or more "files" and/or "drive_links" fields,
+      plus optional "courseId", "materialId" and "priority" fields.
+    Top-level courseId/materialId apply to every item that doesn't set its own.
+    Returns 202 with a batch ID, a batch status URL and one job per document.
+    """
+    if not INGEST_ENABLED:
+        return jsonify({"error": "This replica does not run ingestion (CHATBOT_ROLE=chat)."}), 503
+
+    if request.mimetype == "multipart/form-data":
+        data = request.form.to_dict()
+        links = request.form.getlist("drive_links")
+        uploads = [upload for upload in request.files.getlist("files") if upload.filename]
+    else:
+        data = request.get_json(silent=True) or {}
+        links = data.get("drive_links") or []
+        uploads = []
+    if not isinstance(links, list):
+        return jsonify({"error": "'drive_links' must be a list"}), 400
+
+    priority = data.get("priority", "normal")
+    if priority not in INGEST_PRIORITIES:
+        return jsonify({"error": f"'priority' must be one of {list(INGEST_PRIORITIES)}"}), 400
+    scope, error = read_scope(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    items = []
+    for entry in links:
+        item_scope = scope
+        if isinstance(entry, dict):
+            drive_link = entry.get("drive_link")
+            item_scope, error = read_scope({**scope, **entry})
+            if error:
+                return jsonify({"error": error}), 400
+        else:
+            drive_link = entry
+        if not isinstance(drive_link, str) or not get_google_drive_file_id(drive_link):
+            return jsonify({"error": f"Not a Google Drive link: {drive_link}"}), 400
+        items.append((drive_link, {"scope": item_scope}))
+
+    if not items and not uploads:
+        return jsonify({"error": "Provide 'drive_links' and/or 'files'"}), 400
+    if len(items) + len(uploads) > INGEST_BULK_MAX_ITEMS:
+        return jsonify({"error": f"At most {INGEST_BULK_MAX_ITEMS} documents per request"}), 400
+
+    print(f"\n--- New Bulk Ingestion Request: {len(items)} link(s), {len(uploads)} file(s) ---")
+
+    batch_id = uuid.uuid4().hex
+    saved_paths = []
+    try:
+        for upload in uploads:
+            path = save_upload(upload)
+            saved_paths.append(path)
+            items.append((f"upload:{upload.filename}", {
+                "scope": scope,
+                "upload": {"path": path, "filename": upload.filename, "content_type": upload.mimetype},
+            }))
+        jobs = submit_ingest_batch(items, priority, batch_id)
+    except DownloadError as e:
+        for path in saved_paths:
+            os.remove(path)
+        return jsonify({"error": str(e)}), 413
+    except QueueFullError:
+        for path in saved_paths:
+            os.remove(path)
+        response = jsonify({"error": "Ingestion queue is full. Please try again later."})
+        response.headers["Retry-After"] = "60"
+        return response, 503
+
+    return jsonify({
+        "message": f"{len(jobs)} ingestion job(s) queued. Poll the status URL to follow their progress.",
+        "batch_id": batch_id,
+        "status_url": f"/chatbot-api/ingest/bulk/{batch_id}",
+        "jobs": [{"job_id": job.job_id, "drive_link": job.drive_link,
+                  "status_url": f"/chatbot-api/ingest/{job.job_id}"} for job in jobs],
+        "queued_jobs": count_queued_jobs(),
     }), 202
 
 
-# --- 8. API ENDPOINT: /chatbot-api/generate-questions (For Professors) ---
+@app.route("/chatbot-api/ingest/bulk/<batch_id>", methods=["GET"])
+def handle_bulk_ingestion_status(batch_id):
+    """Reports the overall progress of a bulk request and the state of each of its jobs."""
+    jobs = [job.to_dict() for job in get_ingest_batch(batch_id)]
+    if not jobs:
+        return jsonify({"error": "Unknown batch ID"}), 404
+    counts = {}
+    for job in jobs:
+        counts[job["status"]] = counts.get(job["status"], 0) + 1
+    return jsonify({
+        "batch_id": batch_id,
+        "total": len(jobs),
+        "counts": counts,
+        "done": counts.get("completed", 0) + counts.get("failed", 0) == len(jobs),
+        "progress": round(sum(job["progress"] for job in jobs) / len(jobs), 3),
+        "jobs": jobs,
+    })
+
+
+# --- 6. API ENDPOINT: /chatbot-api/generate-questions (For Professors) ---
 
 @app.route("/chatbot-api/generate-questions", methods=["POST"])
 def handle_generate_questions():
     """
     Handles question generation requests from professors.
     Uses RAG to generate quiz questions based on ingested course materials.
+    Questions are generated by concurrent Groq calls over slices of the
+    context, and cached per (topic, type, difficulty, context): a repeated
+    request is served from the cache, and a larger one only generates the
+    missing questions. Pass "refresh": true to generate a new set.
+    Identical requests that arrive while one is being answered share its answer.
     """
     
     data = request.json
-    topic = data.get("topic", "")
-    question_type = data.get("questionType", "mcq_single")  # mcq_single, mcq_multiple, numerical
-    num_questions = data.get("numQuestions", 1)
-    difficulty = data.get("difficulty", "medium")  # easy, medium, hard
-    
-    if not topic:
-        return jsonify({"error": "Topic is required"}), 400
-    
-    if num_questions < 1 or num_questions > 10:
-        return jsonify({"error": "Number of questions must be between 1 and 10"}), 400
+    params, error = read_question_request(data)
+    if not error:
+        scope, error = read_scope(data, allow_lists=True)
+    if error:
+        return jsonify({"error": error}), 400
+    refresh = read_refresh_flag(data)
     
-    print(f"\n--- New Question Generation Request ---")
-    print(f"Topic: {topic}, Type: {question_type}, Count: {num_questions}, Difficulty: {difficulty}")
+    print("\n--- New Question Generation Request ---")
+    print(f"Topic: {params['topic']}, Type: {params['question_type']}, Count: {params['num_questions']}, "
+          f"Difficulty: {params['difficulty']}")
 
-    try:
-        # 1. Vectorize the topic to find relevant context
-        topic_vector = embedding_model.encode(topic).tolist()
-
-        # 2. Query ChromaDB to find relevant context
-        print("Searching for relevant context...")
-        results = collection.query(
-            query_embeddings=[topic_vector],
-            n_results=10  # Get more context for better question generation
-        )
-        
-        context_chunks = results['documents'][0]
-        context = "\n\n".join(context_chunks)
-        
-        if not context_chunks:
-            print("No relevant context found in database.")
-            return jsonify({"error": "No relevant course materials found for this topic. Please ensure materials have been ingested."}), 404
-
-        print(f"Found context: {context[:300]}...")  # Print first 300 chars
-
-        # 3. Build the prompt for question generation
-        question_type_description = {
-            "mcq_single": "multiple choice with a single correct answer (provide 4 options)",
-            "mcq_multiple": "multiple choice with multiple correct answers (provide 4-5 options, at least 2 correct)",
-            "numerical": "numerical answer question (requires a number as answer)"
-        }
-        
-        difficulty_instruction = {
-            "easy": "Basic concepts and definitions",
-            "medium": "Application and understanding of concepts",
-            "hard": "Analysis, synthesis, and complex problem-solving"
-        }
-        
-        system_prompt = f"""
-        You are an expert quiz question generator for the VNIT Learning Management System.
-        Your task is to generate high-quality quiz questions based ONLY on the provided course materials.
-        
-        Instructions:
-        1. Generate {num_questions} {question_type_description.get(question_type, 'multiple choice')} question(s).
-        2. Difficulty level: {difficulty_instruction.get(difficulty, 'medium')}
-        3. Base questions STRICTLY on the provided context. Do not use external knowledge.
-        4. Questions should test understanding of the topic: "{topic}"
-        5. For MCQ questions, make distractors plausible but clearly incorrect.
-        6. For numerical questions, provide the exact numerical answer.
-        7. Include brief explanations for why the answer is correct.
-        
-        Format your response as a JSON array with this structure:
-        [
-            {{
-                "questionText": "The question text here",
-                "questionType": "{question_type}",
-                "options": ["Option A", "Option B", "Option C", "Option D"],  // Only for MCQ types
-                "correctAnswer": "Option A",  // For mcq_single or numerical value for numerical
-                "correctAnswers": ["Option A", "Option B"],  // For mcq_multiple
-                "points": 1,
-                "explanation": "Brief explanation of why this is correct"
-            }}
-        ]
-        
-        Return ONLY valid JSON, no additional text.
-        """
-        
-        final_prompt = f"""
-        {system_prompt}
-        
-        ---
-        Course Materials Context:
-        {context}
-        ---
-        
-        Topic: {topic}
-        
-        Generate {num_questions} question(s) now:
-        """
-
-        # 4. Call Groq LLM
-        print("Sending prompt to Groq for question generation...")
-        chat_completion = groq_client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that generates quiz questions. Always return valid JSON arrays."},
-                {"role": "user", "content": final_prompt}
-            ],
-            model=GROQ_MODEL,
-            temperature=0.7,  # Slightly creative but still focused
-        )
-        
-        response_text = chat_completion.choices[0].message.content
-        print(f"Groq Response: {response_text[:300]}...")
-
-        # 5. Parse JSON response
+    key = question_flight_key(params, scope, refresh)
+    flight, leader = question_flights.join(key, Future)
+    if leader:
         try:
-            import json
-            import re
-            
-            # Clean the response - remove markdown code blocks if present
-            cleaned_text = response_text.strip()
-            if cleaned_text.startswith('```json'):
-                cleaned_text = cleaned_text[7:]
-            elif cleaned_text.startswith('```'):
-                cleaned_text = cleaned_text[3:]
-            if cleaned_text.endswith('```'):
-                cleaned_text = cleaned_text[:-3]
-            cleaned_text = cleaned_text.strip()
-            
-            # Try to extract JSON from response
-            if cleaned_text.startswith('['):
-                questions = json.loads(cleaned_text)
-            elif cleaned_text.startswith('{'):
-                # Single question wrapped in object or questions key
-                obj = json.loads(cleaned_text)
-                if 'questions' in obj:
-                    questions = obj['questions']
-                elif 'question' in obj:
-                    questions = [obj['question']]
-                else:
-                    # Treat the whole object as a single question
-                    questions = [obj]
-            else:
-                # Try to find JSON array in the response
-                json_match = re.search(r'\[.*\]', cleaned_text, re.DOTALL)
-                if json_match:
-                    questions = json.loads(json_match.group())
-                else:
-                    # Try to find JSON object
-                    json_match = re.search(r'\{.*\}', cleaned_text, re.DOTALL)
-                    if json_match:
-                        obj = json.loads(json_match.group())
-                        questions = [obj] if isinstance(obj, dict) else obj
-                    else:
-                        raise ValueError("Could not find JSON in response")
-            
-            # Validate and clean questions
-            validated_questions = []
-            for q in questions:
-                if not isinstance(q, dict):
-                    continue
-                
-                # Ensure required fields
-                if 'questionText' not in q or 'questionType' not in q:
-                    continue
-                
-                # Set question type
-                q['questionType'] = question_type
-                
-                # Ensure points
-                if 'points' not in q:
-                    q['points'] = 1
-                
-                # Validate based on type
-                if question_type in ['mcq_single', 'mcq_multiple']:
-                    if 'options' not in q or not isinstance(q['options'], list) or len(q['options']) < 2:
-                        continue
-                    if question_type == 'mcq_single':
-                        if 'correctAnswer' not in q:
-                            continue
-                    else:
-                        if 'correctAnswers' not in q or not isinstance(q['correctAnswers'], list):
-                            continue
-                elif question_type == 'numerical':
-                    if 'correctAnswer' not in q:
-                        continue
-                    # Convert to number
-                    try:
-                        q['correctAnswer'] = float(q['correctAnswer'])
-                    except:
-                        continue
-                
-                validated_questions.append(q)
-            
-            if not validated_questions:
-                return jsonify({"error": "Failed to generate valid questions. Please try again."}), 500
-            
-            print(f"Generated {len(validated_questions)} valid question(s)")
-            return jsonify({"questions": validated_questions})
-            
-        except json.JSONDecodeError as e:
-            print(f"JSON parsing error: {e}")
-            return jsonify({"error": f"Failed to parse generated questions: {str(e)}"}), 500
+            with question_lane.acquire():
+                flight.set_result(answer_question_request(params, scope, refresh))
         except Exception as e:
-            print(f"Error processing questions: {e}")
-            return jsonify({"error": f"Error processing generated questions: {str(e)}"}), 500
-
-    except Exception as e:
-        print(f"Error during question generation: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"error": f"An internal error occurred: {e}"}), 500
+            flight.set_exception(e)
+        finally:
+            question_flights.land(key, flight)
+    else:
+        print("Waiting for an identical request that is already being answered...")
+    body, status = flight.result()
+    return jsonify(body), status
 
 
-# --- 9. API ENDPOINT: /chatbot-api/chat (For Students) ---
+# --- 7. API ENDPOINTS: /chatbot-api/chat (For Students) ---
 
 @app.route("/chatbot-api/chat", methods=["POST"])
 def handle_chat():
     """
     Handles chat requests from the frontend.
     Performs RAG to answer questions based on ingested documents.
+    Add ?stream=1 to receive the answer as Server-Sent Events (see handle_chat_stream).
+    Identical questions asked at the same time share one answer (and one Groq call).
     """
+    if request.args.get("stream") in ("1", "true"):
+        return handle_chat_stream()
     
     data = request.json
     user_question = data.get("question")
 
     if not user_question:
         return jsonify({"error": "No question provided"}), 400
+    scope, error = read_scope(data, allow_lists=True)
+    if error:
+        return jsonify({"error": error}), 400
 
-    print(f"\n--- New Chat Request ---")
+    print("\n--- New Chat Request ---")
     print(f"Question: {user_question}")
 
-    try:
-        # 1. Vectorize the user's question
-        question_vector = embedding_model.encode(user_question).tolist()
-
-        # 2. Query ChromaDB to find relevant context
-        print("Searching for context...")
-        results = collection.query(
-            query_embeddings=[question_vector],
-            n_results=5 # Get top 5 most relevant chunks
-        )
-        
-        context_chunks = results['documents'][0]
-        context = "\n\n".join(context_chunks)
-        
-        if not context_chunks:
-            print("No relevant context found in database.")
-            return jsonify({"answer": "I'm sorry, but I don't have that information in my knowledge base."})
-
-        print(f"Found context: {context[:200]}...") # Print first 200 chars
-
-        # 3. Build the prompt for Groq
-        system_prompt = """
-        You are a helpful AI teaching assistant for the VNIT Learning Management System.
-        Your goal is to answer student questions based ONLY on the provided course materials.
-        
-        Follow these rules STRICTLY:
-        1. Use ONLY the 'Provided Context' below to answer the question.
-        2. If the answer is not in the context, clearly state: "I'm sorry, but I don't have that information in my knowledge base."
-        3. Do not make up answers or use any external knowledge.
-        4. Be concise and direct in your response.
-        """
-        
-        final_prompt = f"""
-        {system_prompt}
-        
-        ---
-        Provided Context:
-        {context}
-        ---
-        
-        Student Question:
-        {user_question}
-        
-        Answer:
-        """
-
-        # 4. Call Groq LLM
-        print("Sending prompt to Groq...")
-        chat_completion = groq_client.chat.completions.create(
-            messages=[
-                {"role": "user", "content": final_prompt}
-            ],
-            model=GROQ_MODEL,
-        )
-        
-        bot_answer = chat_completion.choices[0].message.content
-        print(f"Groq Answer: {bot_answer}")
-
-        # 5. Send Response
-        return jsonify({"answer": bot_answer})
-
-    except Exception as e:
-        print(f"Error during RAG pipeline: {e}")
-        return jsonify({"error": f"An internal error occurred: {e}"}), 500
-
-
-# --- 9. RUN THE FLASK SERVER ---
+    flight = join_chat_flight(user_question, scope, background=False)
+    body, status = chat_response(flight.wait())
+    return jsonify(body), status
+
+
+@app.route("/chatbot-api/chat/stream", methods=["POST"])
+def handle_chat_stream():
+    """
+    Streaming variant of /chatbot-api/chat using Server-Sent Events.
+    Events, in order:
+      sources - {"sources": [{"id", "distance", "courseId", "materialId", "page"/"slide"}]}
+                retrieved before generation starts (metadata fields only when stored)
+      token   - {"text": "..."} one per streamed piece of the answer
+      done    - {"answer", "cached", "timings"} once the answer is complete
+      error   - {"error": "..."} if anything fails after the stream has started
+    A stream for a question that is already being answered attaches to that
+    answer: it receives the events sent so far, then the rest as they arrive.
+    """
+    data = request.json
+    user_question = data.get("question")
+
+    if not user_question:
+        return jsonify({"error": "No question provided"}), 400
+    scope, error = read_scope(data, allow_lists=True)
+    if error:
+        return jsonify({"error": error}), 400
+
+    print("\n--- New Streaming Chat Request ---")
+    print(f"Question: {user_question}")
+
+    flight = join_chat_flight(user_question, scope, background=True)
+
+    def generate():
+        for event, data in flight.follow():
+            yield sse_event(event, data)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        # Stop proxies (e.g. nginx on Render) from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# --- 8. API ENDPOINTS: /chatbot-api/stats and /metrics (Diagnostics) ---
+
+@app.route("/chatbot-api/stats", methods=["GET"])
+def handle_stats():
+    """Reports queue depths and batching metrics for the service's internal components."""
+    return jsonify({
+        "ingest_queue": {
+            "queued": count_queued_jobs(),
+            "pipeline": ingest_pipeline.stats(),
+            "owner_pid": os.getpid() if is_ingest_owner() else None,
+        },
+        "query_embedding": query_embedder.stats(),
+        "embedding": {
+            "backend": EMBEDDING_BACKEND,
+            "cache_key": serving_cache_key(),
+            "parity": get_embedding_parity(),
+        },
+        "index": {
+            "serving": serving_index(),
+            "switching_to": serving["switching_to"],
+            "alias": list_search_indexes(),
+        },
+        "rerank": rerank_status(),
+        "single_flight": single_flight_stats(),
+        "admission": admission_stats(),
+        "groq_keys": groq_pool.stats(),
+        "caches": {
+            "query_embedding": query_embedding_cache.stats(),
+            "retrieval": retrieval_cache.stats(),
+            "answers": answer_cache.stats(),
+        },
+    })
+
+
+@app.route("/metrics", methods=["GET"])
+def handle_metrics():
+    """
+    Prometheus metrics: request and stage latency histograms, queue depths,
+    cache hits/misses, Groq calls and tokens per key, OCR pages and seconds.
+    In pre-fork mode the samples of every worker process are aggregated.
+    """
+    INGEST_QUEUED_JOBS.set(count_queued_jobs())
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+# --- 9. API ENDPOINTS: /healthz and /readyz (Health Checks) ---
+
+@app.route("/healthz", methods=["GET"])
+def handle_healthz():
+    """Liveness: the process is up and serving HTTP, even if models are still loading."""
+    return jsonify({"status": "ok", "role": CHATBOT_ROLE})
+
+
+@app.route("/readyz", methods=["GET"])
+def handle_readyz():
+    """Readiness: 200 once every required component is warm, 503 (with per-component state) before that."""
+    statuses = {name: component.status() for name, component in components.items()}
+    ready = all(components[name].state == "ready" for name in REQUIRED_COMPONENTS)
+    body = {"ready": ready, "role": CHATBOT_ROLE, "ocr_enabled": OCR_ENABLED, "components": statuses}
+    return jsonify(body), (200 if ready else 503)
+
+
+# --- 10. RUN THE FLASK SERVER ---
+
 if __name__ == "__main__":
+    start_services()
     # Get port from environment variable (Render provides this) or default to 5001
     port = int(os.environ.get("PORT", 5001))
     # Disable debug mode in production
     debug = os.environ.get("FLASK_ENV") == "development"
     # Runs the server on port from environment and makes it accessible on your network
-    app.run(host='0.0.0.0', port=port, debug=debug)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port, debug=debug)
@@ -0,0 +1,365 @@
+"""
+ASGI entry point for the chatbot service (production launcher: gunicorn -c gunicorn.conf.py asgi:app).
+
+It serves the same /chatbot-api routes and request/response contracts as
+app.py. Chat, streaming chat and question generation are native async
+handlers: Groq calls are awaited and the CPU-bound embedding and retrieval
+work runs on a thread pool, so one process can keep hundreds of chat
+requests in flight. Every other route is served by the Flask app mounted
+underneath.
+"""
+import os
+import time
+import asyncio
+import functools
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route, Mount
+
+import app as chatbot
+from admission import AdmissionRejected, check_rate_limit, LaneSlot, rejection_headers, chat_lane, question_lane
+from telemetry import RequestTrace, log_event, record_stage
+from groq_keys import groq_pool
+from retrieval import read_scope
+from flights import (
+    Flight, SingleFlight, chat_flight_key, question_flight_key, refuse_flight, fail_flight, land_flight, chat_response,
+)
+from questions import QuestionRequest, read_question_request, read_refresh_flag
+from chat import ChatAnswer, stream_text, sse_event
+
+# Threads for embedding, retrieval and cache work. Torch releases the GIL while
+# encoding, so a few threads keep the CPU busy without oversubscribing it.
+ASGI_EXECUTOR_THREADS = int(os.environ.get("ASGI_EXECUTOR_THREADS", 8))
+executor = ThreadPoolExecutor(max_workers=ASGI_EXECUTOR_THREADS, thread_name_prefix="asgi-cpu")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """
+    Runs a blocking function on the CPU executor without blocking the event loop,
+    as part of the current request (same request ID and stage timings).
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, fn, *args, **kwargs))
+
+
+def rejection_response(error):
+    """The response for an admission.AdmissionRejected (429/503 with Retry-After), as app.handle_admission_rejected."""
+    return JSONResponse({"error": str(error), "retry_after": error.retry_after}, status_code=error.status,
+                        headers=rejection_headers(error))
+
+
+async def acquire_slot(lane):
+    """Async version of admission.Lane.acquire: waits for a slot without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    granted = asyncio.Event()
+    waiter = lane.enter(lambda: loop.call_soon_threadsafe(granted.set))
+    if waiter is not None:
+        try:
+            await asyncio.wait_for(granted.wait(), lane.max_wait)
+        except asyncio.TimeoutError:
+            if not lane.abandon(waiter):
+                raise lane.rejection()
+        except asyncio.CancelledError:
+            # The request went away; hand back the slot if it had just been given one
+            if lane.abandon(waiter):
+                LaneSlot(lane).release()
+            raise
+        record_stage("admission_wait", time.monotonic() - waiter.enqueued_at)
+    return LaneSlot(lane)
+
+
+def traced(route, handler):
+    """
+    Wraps a native handler in a telemetry.RequestTrace: request ID header, metrics,
+    request log line and optional profile, like the Flask routes get from
+    app.begin_request_trace / app.end_request_trace. Requests over their
+    user's rate limit, or refused by a lane, get a 429/503 response.
+    """
+    @functools.wraps(handler)
+    async def endpoint(request):
+        trace = RequestTrace(route, request.method, request.headers, request.query_params)
+        try:
+            check_rate_limit(route, request.method, request.headers,
+                                     request.client.host if request.client else None)
+            response = await handler(request)
+        except AdmissionRejected as e:
+            response = rejection_response(e)
+        except Exception:
+            trace.finish(500)
+            raise
+        response.headers.update(trace.response_headers())
+        if isinstance(response, StreamingResponse):
+            response.body_iterator = finish_after(response.body_iterator, trace, response.status_code)
+        else:
+            trace.finish(response.status_code)
+        return response
+    return endpoint
+
+
+async def finish_after(body, trace, status):
+    """Passes a streamed body through and finishes its trace once the last event has been sent."""
+    try:
+        async for part in body:
+            yield part
+    finally:
+        trace.finish(status)
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return {}
+
+
+# --- /chatbot-api/chat (For Students) ---
+
+class AsyncFlight(Flight):
+    """
+    A flights.Flight followed by coroutines: it is published to from the event
+    loop, and follow() and wait() await new events instead of blocking a thread.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def publish(self, event, data):
+        super().publish(event, data)
+        self._wake()
+
+    def finish(self):
+        super().finish()
+        self._wake()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self):
+        index = 0
+        while True:
+            changed = self._changed
+            pending = self.events[index:]
+            finished = self.finished
+            for item in pending:
+                yield item
+            index += len(pending)
+            if finished and index == len(self.events):
+                return
+            if index == len(self.events):
+                await changed.wait()
+
+    async def wait(self):
+        while not self.finished:
+            await self._changed.wait()
+        return list(self.events)
+
+
+chat_flights = SingleFlight("chat_async")
+question_flights = SingleFlight("questions_async")
+
+
+async def chat_events(user_question, scope):
+    """Async driver of chat.ChatAnswer, as chat.chat_events."""
+    chat = ChatAnswer(user_question, scope)
+    yield await run_blocking(chat.retrieve)
+    if chat.answer is not None:
+        yield chat.token(chat.answer)
+    else:
+        stream = await groq_pool.acreate_chat_completion(**chat.completion_request())
+        async for chunk in stream:
+            text = stream_text(chunk)
+            if text:
+                yield chat.token(text)
+    yield await run_blocking(chat.finish)
+
+
+async def run_flight(key, flight, events, slot):
+    """Async version of flights.run_flight."""
+    try:
+        async for event, data in events:
+            flight.publish(event, data)
+    except Exception as e:
+        fail_flight(flight, e)
+    finally:
+        land_flight(chat_flights, key, flight, slot)
+
+
+async def join_chat_flight(user_question, scope):
+    """
+    Returns the flight answering this question, starting one if no identical
+    question is being answered. The flight runs as its own task, so it
+    finishes for its followers even if the request that started it goes away.
+    Only a new flight waits for a slot in the chat lane (see chat.join_chat_flight).
+    """
+    key = chat_flight_key(user_question, scope)
+    flight, leader = chat_flights.join(key, AsyncFlight)
+    if not leader:
+        log_event("single_flight_join", flight="chat_async")
+        return flight
+    try:
+        slot = await acquire_slot(chat_lane)
+    except BaseException as e:
+        # Refused or cancelled: its followers get the same answer
+        refuse_flight(chat_flights, key, flight, e)
+        raise
+    flight.task = asyncio.create_task(run_flight(key, flight, chat_events(user_question, scope), slot))
+    return flight
+
+
+async def read_chat_request(request):
+    """Returns (question, scope, error_response)."""
+    data = await read_json(request)
+    user_question = data.get("question")
+    if not user_question:
+        return None, None, JSONResponse({"error": "No question provided"}, status_code=400)
+    scope, error = read_scope(data, allow_lists=True)
+    if error:
+        return None, None, JSONResponse({"error": error}, status_code=400)
+    return user_question, scope, None
+
+
+async def handle_chat(request):
+    """Async version of app.handle_chat."""
+    if request.query_params.get("stream") in ("1", "true"):
+        return await handle_chat_stream(request)
+
+    user_question, scope, error_response = await read_chat_request(request)
+    if error_response:
+        return error_response
+
+    log_event("chat_request", question=user_question, stream=False)
+
+    flight = await join_chat_flight(user_question, scope)
+    body, status = chat_response(await flight.wait())
+    return JSONResponse(body, status_code=status)
+
+
+async def handle_chat_stream(request):
+    """Async version of app.handle_chat_stream (same sources/token/done/error events)."""
+    user_question, scope, error_response = await read_chat_request(request)
+    if error_response:
+        return error_response
+
+    log_event("chat_request", question=user_question, stream=True)
+
+    flight = await join_chat_flight(user_question, scope)
+
+    async def generate():
+        async for event, data in flight.follow():
+            yield sse_event(event, data)
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# --- /chatbot-api/generate-questions (For Professors) ---
+
+async def request_questions(completion_request):
+    chat_completion = await groq_pool.acreate_chat_completion(**completion_request)
+    return chat_completion.choices[0].message.content
+
+
+async def generate_question_set(builder):
+    """Async version of questions.generate_question_set: each round's Groq calls run concurrently."""
+    while True:
+        slots = builder.next_round()
+        if not slots:
+            return builder
+        results = await asyncio.gather(
+            *(request_questions(builder.completion_request(slot)) for slot in slots), return_exceptions=True
+        )
+        for slot, result in zip(slots, results):
+            if isinstance(result, Exception):
+                builder.record(slot, error=result)
+            else:
+                builder.record(slot, result)
+
+
+async def admitted_question_request(params, scope, refresh):
+    """answer_question_request once it holds a slot in the question lane."""
+    with await acquire_slot(question_lane):
+        return await answer_question_request(params, scope, refresh)
+
+
+async def answer_question_request(params, scope, refresh):
+    """Async driver of questions.QuestionRequest, as questions.answer_question_request."""
+    question_request = QuestionRequest(params, scope, refresh)
+    try:
+        response = await run_blocking(question_request.prepare)
+        if response is not None:
+            return response
+        await generate_question_set(question_request.builder)
+        return await run_blocking(question_request.finish)
+    except Exception as e:
+        return question_request.failed(e)
+
+
+async def handle_generate_questions(request):
+    """Async version of app.handle_generate_questions."""
+    data = await read_json(request)
+    params, error = read_question_request(data)
+    if not error:
+        scope, error = read_scope(data, allow_lists=True)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    refresh = read_refresh_flag(data)
+
+    log_event("question_request", **params)
+
+    # Identical concurrent requests await the same task
+    key = question_flight_key(params, scope, refresh)
+
+    def start():
+        task = asyncio.create_task(admitted_question_request(params, scope, refresh))
+        task.add_done_callback(lambda done: question_flights.land(key, done))
+        return task
+
+    task, leader = question_flights.join(key, start)
+    if not leader:
+        log_event("single_flight_join", flight="questions_async")
+    body, status = await asyncio.shield(task)
+    return JSONResponse(body, status_code=status)
+
+
+# --- APP ---
+
+if chatbot.allowed_origins == "*":
+    cors_origins = ["*"]
+else:
+    cors_origins = [origin.strip() for origin in chatbot.allowed_origins.split(",")]
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Starts model warm-up and ingestion when a worker starts serving (see app.start_services)."""
+    chatbot.start_services()
+    yield
+
+
+app = Starlette(
+    routes=[
+        Route("/chatbot-api/chat", traced("/chatbot-api/chat", handle_chat), methods=["POST"]),
+        Route("/chatbot-api/chat/stream", traced("/chatbot-api/chat/stream", handle_chat_stream), methods=["POST"]),
+        Route("/chatbot-api/generate-questions", traced("/chatbot-api/generate-questions", handle_generate_questions),
+              methods=["POST"]),
+        # Ingestion, job status, diagnostics and /metrics are served by the Flask app
+        Mount("/", app=WSGIMiddleware(chatbot.app)),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=cors_origins, allow_credentials=True,
+                   allow_methods=["*"], allow_headers=["*"]),
+    ],
+    lifespan=lifespan,
+)
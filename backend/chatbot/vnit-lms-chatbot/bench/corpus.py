@@ -0,0 +1,169 @@
+"""
+Synthetic course corpus for the benchmark suite.
+
+Generates, deterministically from a seed, the four kinds of documents the
+service ingests: text PDFs, scanned PDFs (pages that are only an image, so
+they go through OCR), PPTX decks and photographed handwritten notes. Every
+document is written about a few topics from TOPICS, so chat and question
+generation requests built from the same topics retrieve real context.
+"""
+import io
+import json
+import os
+import random
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+from pptx import Presentation
+from pptx.util import Pt
+
+TOPICS = [
+    "TCP congestion control", "publish-subscribe messaging", "B-tree indexing", "virtual memory paging",
+    "gradient descent", "hash table collisions", "process scheduling", "two-phase commit",
+    "binary search trees", "Dijkstra's shortest path algorithm", "cache replacement policies",
+    "public key cryptography", "Fourier transforms", "finite state machines", "normalization of relational schemas",
+    "deadlock detection", "consistent hashing", "convolutional neural networks", "Ohm's law", "Kirchhoff's laws",
+]
+
+TERMS = [
+    "latency", "throughput", "invariant", "complexity", "trade-off", "failure mode", "worst case", "example",
+    "definition", "proof sketch", "implementation", "bottleneck", "optimization", "edge case", "memory usage",
+]
+
+SENTENCES = [
+    "{topic} is usually introduced by looking at its {term} first.",
+    "A common exam question asks students to explain the {term} of {topic}.",
+    "In practice, {topic} trades {term} against simplicity of the design.",
+    "The lecture works through a small example where {topic} shows its {term} clearly.",
+    "Students often confuse the {term} of {topic} with that of related techniques.",
+    "To analyse {topic}, write down the {term} and check it step by step.",
+    "Textbooks describe {topic} in terms of its {term} and a handful of rules.",
+    "The key idea of {topic} is that its {term} stays bounded as the input grows.",
+]
+
+# (kind, file extension, content type) for each document kind
+KINDS = {
+    "text_pdf": (".pdf", "application/pdf"),
+    "scanned_pdf": (".pdf", "application/pdf"),
+    "pptx": (".pptx", "application/vnd.openxmlformats-officedocument.presentationml.presentation"),
+    "handwritten": (".jpg", "image/jpeg"),
+}
+
+
+def paragraph(rng, topic, sentences=6):
+    return " ".join(rng.choice(SENTENCES).format(topic=topic, term=rng.choice(TERMS)) for _ in range(sentences))
+
+
+def load_font(size):
+    try:
+        return ImageFont.load_default(size=size)  # scalable default font, Pillow >= 10.1
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def render_text_image(text, rng, width=1240, height=1754, handwritten=False):
+    """Draws `text` on a page-sized image; `handwritten` adds slant, jitter and blur like a photo of notes."""
+    background = (248, 246, 238) if handwritten else (255, 255, 255)
+    image = Image.new("RGB", (width, height), background)
+    draw = ImageDraw.Draw(image)
+    font = load_font(30 if handwritten else 26)
+    words = text.split()
+    x, y, line_height = 80, 100, 52 if handwritten else 40
+    for word in words:
+        word_width = draw.textlength(word + " ", font=font)
+        if x + word_width > width - 80:
+            x, y = 80, y + line_height
+            if y > height - 120:
+                break
+        jitter = rng.randint(-3, 3) if handwritten else 0
+        draw.text((x, y + jitter), word, fill=(25, 25, 60) if handwritten else (0, 0, 0), font=font)
+        x += word_width
+    if handwritten:
+        image = image.rotate(rng.uniform(-2.0, 2.0), fillcolor=background).filter(ImageFilter.GaussianBlur(0.6))
+    return image
+
+
+def write_text_pdf(path, rng, topics, pages):
+    doc = fitz.open()
+    for page_num in range(pages):
+        topic = topics[page_num % len(topics)]
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, 545, 792), f"{topic}\n\n{paragraph(rng, topic, 14)}", fontsize=11)
+    doc.save(path)
+    doc.close()
+
+
+def write_scanned_pdf(path, rng, topics, pages):
+    doc = fitz.open()
+    for page_num in range(pages):
+        topic = topics[page_num % len(topics)]
+        image = render_text_image(f"{topic}. {paragraph(rng, topic, 8)}", rng)
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        page = doc.new_page()
+        page.insert_image(page.rect, stream=buffer.getvalue())
+    doc.save(path)
+    doc.close()
+
+
+def write_pptx(path, rng, topics, slides):
+    deck = Presentation()
+    for slide_num in range(slides):
+        topic = topics[slide_num % len(topics)]
+        slide = deck.slides.add_slide(deck.slide_layouts[1])
+        slide.shapes.title.text = topic
+        body = slide.placeholders[1].text_frame
+        body.text = paragraph(rng, topic, 2)
+        for _ in range(3):
+            bullet = body.add_paragraph()
+            bullet.text = rng.choice(SENTENCES).format(topic=topic, term=rng.choice(TERMS))
+            bullet.font.size = Pt(16)
+    deck.save(path)
+
+
+def write_handwritten(path, rng, topics):
+    topic = topics[0]
+    image = render_text_image(f"Notes: {topic}. {paragraph(rng, topic, 5)}", rng, height=1200, handwritten=True)
+    image.save(path, format="JPEG", quality=85)
+
+
+def generate_corpus(directory, documents=20, pages=6, mix=None, seed=1234):
+    """
+    Writes `documents` files to `directory`, cycling through the kinds in `mix`
+    (default: all four), and returns the manifest (also saved as manifest.json):
+    a list of {"id", "kind", "filename", "content_type", "topics", "bytes"}.
+    An existing manifest generated with the same settings is reused.
+    """
+    mix = list(mix or KINDS)
+    settings = {"documents": documents, "pages": pages, "mix": mix, "seed": seed}
+    manifest_path = os.path.join(directory, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            saved = json.load(f)
+        if saved["settings"] == settings:
+            return saved["documents"]
+
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    manifest = []
+    for index in range(documents):
+        kind = mix[index % len(mix)]
+        extension, content_type = KINDS[kind]
+        doc_id = f"bench{seed}doc{index:04d}"
+        filename = doc_id + extension
+        path = os.path.join(directory, filename)
+        topics = rng.sample(TOPICS, 3)
+        if kind == "text_pdf":
+            write_text_pdf(path, rng, topics, pages)
+        elif kind == "scanned_pdf":
+            write_scanned_pdf(path, rng, topics, max(1, pages // 2))
+        elif kind == "pptx":
+            write_pptx(path, rng, topics, pages)
+        else:
+            write_handwritten(path, rng, topics)
+        manifest.append({"id": doc_id, "kind": kind, "filename": filename, "content_type": content_type,
+                         "topics": topics, "bytes": os.path.getsize(path)})
+
+    with open(manifest_path, "w") as f:
+        json.dump({"settings": settings, "documents": manifest}, f, indent=2)
+    return manifest
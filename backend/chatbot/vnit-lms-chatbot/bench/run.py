@@ -0,0 +1,536 @@
+"""
+Offline benchmark suite for the chatbot service.
+
+    python bench/run.py --label baseline --output baseline.json
+    python bench/run.py --label onnx --env EMBEDDING_BACKEND=onnx --output onnx.json
+    python bench/run.py compare baseline.json onnx.json
+
+A run generates a synthetic corpus (bench/corpus.py), starts a stub Groq
+server and a local stand-in for Google Drive (bench/stubs.py), and launches
+the service from this directory against them with its own state database and
+Chroma directory, so nothing outside the work directory is touched and no
+network access is needed. The embedding, reranker and EasyOCR models must
+already be in the local model caches (set HF_HUB_OFFLINE=1 to make sure).
+
+Scenarios, each at every --concurrency level:
+  ingest     every corpus document through /chatbot-api/ingest, with at most
+             `concurrency` jobs outstanding, on a freshly started service
+  chat       /chatbot-api/chat/stream (or /chatbot-api/chat with --chat-mode json)
+  questions  /chatbot-api/generate-questions with "refresh": true
+For each: throughput, p50/p95/p99 latency, errors, peak RSS of the service's
+process tree, the per-stage timings the service reports (job stage timings,
+streamed `done` timings) and the server-side stage breakdown from /metrics.
+Results are written as JSON; `compare` prints the change between two runs.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from corpus import KINDS, TERMS, generate_corpus
+from stubs import DriveFileServer, StubGroqServer
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHAT_TEMPLATES = [
+    "What is {topic}?", "Explain the {term} of {topic}.", "How does {topic} affect {term}?",
+    "Give an example of {topic} and its {term}.", "Why does the {term} of {topic} matter?",
+]
+STAGE_SAMPLE = re.compile(r'^chatbot_stage_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$')
+OCR_SAMPLE = re.compile(r'^chatbot_ocr_(pages_total\{outcome="ok"\}|seconds_total) (\S+)$')
+
+
+# --- Statistics ---
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values` (None when empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(latencies_ms, wall_seconds, errors):
+    count = len(latencies_ms)
+    return {
+        "completed": count,
+        "errors": errors,
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_per_second": round(count / wall_seconds, 3) if wall_seconds else None,
+        "latency_ms": {
+            "mean": round(sum(latencies_ms) / count, 1) if count else None,
+            "p50": percentile(latencies_ms, 50),
+            "p95": percentile(latencies_ms, 95),
+            "p99": percentile(latencies_ms, 99),
+            "max": max(latencies_ms) if count else None,
+        },
+    }
+
+
+def summarize_stages(samples):
+    """{stage: [ms, ...]} -> {stage: {"mean", "p50", "p95"}}."""
+    return {stage: {"mean": round(sum(values) / len(values), 1), "p50": percentile(values, 50),
+                    "p95": percentile(values, 95)}
+            for stage, values in sorted(samples.items()) if values}
+
+
+# --- The service under test ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_tree_rss(root_pid):
+    """Resident memory in bytes of `root_pid` and all its descendants (Linux /proc; None elsewhere)."""
+    if not os.path.isdir("/proc"):
+        return None
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    total, stack = 0, [root_pid]
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler:
+    """Samples the service's process-tree RSS in the background and keeps the peak since the last reset()."""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = process_tree_rss(self.pid)
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+
+    def reset(self):
+        self.peak = process_tree_rss(self.pid) or 0
+
+    def stop(self):
+        self._stop.set()
+
+
+class Service:
+    """The chatbot service running from APP_DIR against the stubs, with its data in `data_dir`."""
+
+    def __init__(self, args, data_dir, groq, drive):
+        self.args = args
+        self.data_dir = data_dir
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        os.makedirs(data_dir, exist_ok=True)
+        env = dict(os.environ)
+        env.update({
+            "PORT": str(self.port),
+            "GROQ_API_KEYS": ",".join(f"bench-key-{i}" for i in range(args.groq_keys)),
+            "GROQ_BASE_URL": groq.url,
+            "DRIVE_DOWNLOAD_URL": drive.download_url,
+            "STATE_DB_PATH": os.path.join(data_dir, "state.sqlite3"),
+            "CHROMA_DB_PATH": os.path.join(data_dir, "chroma_db"),
+            "DOWNLOAD_DIR": data_dir,
+            "CHROMA_SERVER_PORT": str(free_port()),
+            "PROFILE_DIR": os.path.join(data_dir, "profiles"),
+            "WEB_CONCURRENCY": str(args.workers),
+            "FLASK_ENV": "production",
+            # Every simulated student comes from one IP, so per-user limits would refuse most of the load
+            "CHAT_RATE_LIMIT_PER_MINUTE": "0",
+            "QUESTION_RATE_LIMIT_PER_MINUTE": "0",
+            "INGEST_RATE_LIMIT_PER_MINUTE": "0",
+        })
+        for name in ("CHROMA_SERVER_URL", "PROMETHEUS_MULTIPROC_DIR"):
+            env.pop(name, None)
+        env.update(args.env)
+        if args.server == "flask":
+            command = [sys.executable, "app.py"]
+        else:
+            command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "asgi:app"]
+            if args.workers > 1:
+                # Per run, so two benchmarks on one machine don't share metric files
+                env["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(data_dir, "metrics")
+        self.log = open(os.path.join(data_dir, "service.log"), "w")
+        self.process = subprocess.Popen(command, cwd=APP_DIR, env=env, stdout=self.log, stderr=subprocess.STDOUT,
+                                        start_new_session=True)
+        self.rss = RssSampler(self.process.pid)
+
+    def wait_ready(self, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Service exited with code {self.process.returncode}; see {self.log.name}")
+            try:
+                if requests.get(self.url + "/readyz", timeout=2).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.5)
+        raise RuntimeError(f"Service not ready after {timeout}s; see {self.log.name}")
+
+    def stage_metrics(self):
+        """Current {stage: (sum_seconds, count)} and OCR totals from /metrics."""
+        stages, ocr = {}, {}
+        try:
+            text = requests.get(self.url + "/metrics", timeout=10).text
+        except requests.RequestException:
+            return stages, ocr
+        for line in text.splitlines():
+            match = STAGE_SAMPLE.match(line)
+            if match:
+                kind, stage, value = match.groups()
+                total, count = stages.get(stage, (0.0, 0))
+                stages[stage] = (total + float(value), count) if kind == "sum" else (total, count + int(float(value)))
+                continue
+            match = OCR_SAMPLE.match(line)
+            if match:
+                ocr["pages" if match.group(1).startswith("pages") else "seconds"] = float(match.group(2))
+        return stages, ocr
+
+    def stop(self):
+        self.rss.stop()
+        if self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                self.process.wait()
+        self.log.close()
+
+
+def server_breakdown(before, after):
+    """Mean server-side ms per stage between two stage_metrics() snapshots."""
+    (stages_before, ocr_before), (stages_after, ocr_after) = before, after
+    breakdown = {}
+    for stage, (total, count) in sorted(stages_after.items()):
+        prev_total, prev_count = stages_before.get(stage, (0.0, 0))
+        if count > prev_count:
+            breakdown[stage] = {"count": count - prev_count,
+                                "mean_ms": round(1000 * (total - prev_total) / (count - prev_count), 1)}
+    pages = ocr_after.get("pages", 0) - ocr_before.get("pages", 0)
+    seconds = ocr_after.get("seconds", 0) - ocr_before.get("seconds", 0)
+    if pages:
+        breakdown["ocr"] = {"pages": pages, "pages_per_second": round(pages / seconds, 2) if seconds else None}
+    return breakdown
+
+
+# --- Scenarios ---
+
+def run_ingest(service, manifest, concurrency, course_id):
+    """Submits every document with at most `concurrency` jobs outstanding and waits for all of them."""
+    session = requests.Session()
+    pending = list(manifest)
+    outstanding = {}
+    latencies, stage_samples, errors = [], {}, 0
+    service.rss.reset()
+    before = service.stage_metrics()
+    started = time.monotonic()
+    while pending or outstanding:
+        while pending and len(outstanding) < concurrency:
+            doc = pending.pop(0)
+            response = session.post(service.url + "/chatbot-api/ingest", json={
+                "drive_link": f"https://drive.google.com/file/d/{doc['id']}/view", "courseId": course_id,
+            }, timeout=30)
+            if response.status_code == 202:
+                outstanding[response.json()["job_id"]] = doc
+            else:
+                errors += 1
+        time.sleep(0.2)
+        for job_id in list(outstanding):
+            job = session.get(f"{service.url}/chatbot-api/ingest/{job_id}", timeout=30).json()
+            if job.get("status") not in ("completed", "failed"):
+                continue
+            doc = outstanding.pop(job_id)
+            if job["status"] == "failed":
+                errors += 1
+                print(f"  ingest failed: {doc['filename']}: {job.get('error')}")
+                continue
+            latencies.append(round(1000 * (job["finished_at"] - job["created_at"]), 1))
+            for stage, seconds in job.get("stage_timings", {}).items():
+                stage_samples.setdefault(stage, []).append(round(1000 * seconds, 1))
+    wall = time.monotonic() - started
+    result = {"concurrency": concurrency, **summarize(latencies, wall, errors)}
+    result["megabytes_per_second"] = round(sum(doc["bytes"] for doc in manifest) / 1e6 / wall, 3)
+    result["documents_by_kind"] = {kind: sum(doc["kind"] == kind for doc in manifest) for kind in KINDS}
+    result["stages_ms"] = summarize_stages(stage_samples)
+    result["server_stages"] = server_breakdown(before, service.stage_metrics())
+    result["peak_rss_mb"] = round(service.rss.peak / 2**20, 1)
+    return result
+
+
+def read_sse(response):
+    """Yields (event, data) from a Server-Sent Events response."""
+    event = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event: "):
+            event = line[7:]
+        elif line.startswith("data: "):
+            yield event, json.loads(line[6:])
+
+
+def chat_request(url, mode, body):
+    """One chat request; returns (latency_ms, time_to_first_token_ms, server timings) or raises."""
+    started = time.monotonic()
+    if mode == "json":
+        response = requests.post(url + "/chatbot-api/chat", json=body, timeout=120)
+        response.raise_for_status()
+        return round(1000 * (time.monotonic() - started), 1), None, {}
+    first_token, timings = None, {}
+    with requests.post(url + "/chatbot-api/chat/stream", json=body, stream=True, timeout=120) as response:
+        response.raise_for_status()
+        for event, data in read_sse(response):
+            if event == "token" and first_token is None:
+                first_token = round(1000 * (time.monotonic() - started), 1)
+            elif event == "done":
+                timings = data.get("timings", {})
+            elif event == "error":
+                raise RuntimeError(data.get("error"))
+    return round(1000 * (time.monotonic() - started), 1), first_token, timings
+
+
+def question_request(url, body):
+    started = time.monotonic()
+    response = requests.post(url + "/chatbot-api/generate-questions", json=body, timeout=300)
+    response.raise_for_status()
+    return round(1000 * (time.monotonic() - started), 1), None, {}
+
+
+def run_requests(service, concurrency, bodies, send):
+    """Sends `bodies` with `concurrency` client threads; `send(body)` returns (latency, ttft, timings)."""
+    latencies, first_tokens, stage_samples, errors = [], [], {}, 0
+    lock = threading.Lock()
+
+    def worker(body):
+        nonlocal errors
+        try:
+            latency, first_token, timings = send(body)
+        except Exception as e:
+            with lock:
+                errors += 1
+                if errors <= 3:
+                    print(f"  request failed: {e}")
+            return
+        with lock:
+            latencies.append(latency)
+            if first_token is not None:
+                first_tokens.append(first_token)
+            for key, value in timings.items():
+                stage_samples.setdefault(key.removesuffix("_ms"), []).append(value)
+
+    service.rss.reset()
+    before = service.stage_metrics()
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, bodies))
+    wall = time.monotonic() - started
+    result = {"concurrency": concurrency, **summarize(latencies, wall, errors)}
+    if first_tokens:
+        result["time_to_first_token_ms"] = {"p50": percentile(first_tokens, 50), "p95": percentile(first_tokens, 95),
+                                            "p99": percentile(first_tokens, 99)}
+    result["stages_ms"] = summarize_stages(stage_samples)
+    result["server_stages"] = server_breakdown(before, service.stage_metrics())
+    result["peak_rss_mb"] = round(service.rss.peak / 2**20, 1)
+    return result
+
+
+def chat_bodies(manifest, count, course_id, rng):
+    topics = sorted({topic for doc in manifest for topic in doc["topics"]})
+    return [{"question": rng.choice(CHAT_TEMPLATES).format(topic=rng.choice(topics), term=rng.choice(TERMS)),
+             "courseId": course_id} for _ in range(count)]
+
+
+def question_bodies(manifest, count, course_id, rng, num_questions):
+    topics = sorted({topic for doc in manifest for topic in doc["topics"]})
+    return [{"topic": rng.choice(topics), "questionType": rng.choice(["mcq_single", "mcq_multiple", "numerical"]),
+             "numQuestions": num_questions, "difficulty": "medium", "courseId": course_id, "refresh": True}
+            for _ in range(count)]
+
+
+# --- Entry points ---
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=APP_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="chatbot_bench_")
+    corpus_dir = os.path.join(workdir, "corpus")
+    print(f"Work directory: {workdir}")
+    print("Generating corpus...")
+    manifest = generate_corpus(corpus_dir, args.documents, args.pages, args.mix, args.seed)
+    groq = StubGroqServer(args.groq_latency_ms, args.groq_token_ms, args.answer_tokens).start()
+    drive = DriveFileServer(corpus_dir, manifest, args.drive_latency_ms).start()
+    rng = random.Random(args.seed)
+    course_id = "BENCH101"
+    results = {"ingest": [], "chat": [], "questions": []}
+    services = []
+
+    def start_service():
+        data_dir = os.path.join(workdir, f"service{len(services)}")
+        shutil.rmtree(data_dir, ignore_errors=True)
+        service = Service(args, data_dir, groq, drive)
+        services.append(service)
+        print(f"Starting service ({args.server}, {args.workers} worker(s)) on {service.url}...")
+        service.wait_ready(args.ready_timeout)
+        return service
+
+    service = None
+    try:
+        if "ingest" in args.scenarios:
+            for concurrency in args.concurrency:
+                if service is not None:
+                    service.stop()
+                service = start_service()  # fresh state, so nothing is skipped as unchanged
+                print(f"ingest, concurrency {concurrency}: {len(manifest)} documents")
+                results["ingest"].append(run_ingest(service, manifest, concurrency, course_id))
+        if {"chat", "questions"} & set(args.scenarios):
+            if service is None:
+                service = start_service()
+                print("Ingesting the corpus (not measured)...")
+                run_ingest(service, manifest, max(args.concurrency), course_id)
+            for concurrency in args.concurrency:
+                if "chat" in args.scenarios:
+                    print(f"chat, concurrency {concurrency}: {args.requests} requests")
+                    bodies = chat_bodies(manifest, args.requests, course_id, rng)
+                    results["chat"].append(run_requests(
+                        service, concurrency, bodies, lambda body: chat_request(service.url, args.chat_mode, body)))
+                if "questions" in args.scenarios:
+                    count = max(1, args.requests // 4)
+                    print(f"questions, concurrency {concurrency}: {count} requests")
+                    bodies = question_bodies(manifest, count, course_id, rng, args.num_questions)
+                    results["questions"].append(run_requests(
+                        service, concurrency, bodies, lambda body: question_request(service.url, body)))
+    finally:
+        if service is not None:
+            service.stop()
+        groq.stop()
+        drive.stop()
+
+    report = {
+        "label": args.label,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": git_commit(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpu_count": os.cpu_count()},
+        "config": {key: value for key, value in vars(args).items() if key not in ("command", "func")},
+        "groq_stub_calls": groq.calls,
+        "results": {name: entries for name, entries in results.items() if entries},
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print_report(report)
+    print(f"Results written to {args.output}")
+
+
+def print_report(report):
+    for scenario, entries in report["results"].items():
+        for entry in entries:
+            latency = entry["latency_ms"]
+            print(f"{scenario:<10} c={entry['concurrency']:<4} {entry['throughput_per_second']}/s  "
+                  f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms  "
+                  f"errors={entry['errors']}  peak_rss={entry['peak_rss_mb']}MB")
+
+
+def change(old, new):
+    if old in (None, 0) or new is None:
+        return ""
+    return f"{100 * (new - old) / old:+.1f}%"
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    print(f"{baseline['label']} ({baseline['git_commit'] or '?'}) -> {candidate['label']} "
+          f"({candidate['git_commit'] or '?'})")
+    for scenario, entries in candidate["results"].items():
+        old_entries = {entry["concurrency"]: entry for entry in baseline["results"].get(scenario, [])}
+        for entry in entries:
+            old = old_entries.get(entry["concurrency"])
+            if old is None:
+                continue
+            rows = [("throughput/s", old["throughput_per_second"], entry["throughput_per_second"])]
+            rows += [(f"{pct} ms", old["latency_ms"][pct], entry["latency_ms"][pct]) for pct in ("p50", "p95", "p99")]
+            rows.append(("peak RSS MB", old["peak_rss_mb"], entry["peak_rss_mb"]))
+            print(f"\n{scenario}, concurrency {entry['concurrency']}")
+            for name, before, after in rows:
+                print(f"  {name:<14} {before!s:>10} -> {after!s:<10} {change(before, after)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+
+    parser.add_argument("--label", default="run")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--workdir", help="keep corpus and service data here (default: a new temp directory)")
+    parser.add_argument("--scenarios", default="ingest,chat,questions", type=lambda v: v.split(","))
+    parser.add_argument("--concurrency", default="1,8,32", type=lambda v: [int(c) for c in v.split(",")])
+    parser.add_argument("--requests", type=int, default=200, help="chat requests per level (questions: a quarter)")
+    parser.add_argument("--chat-mode", choices=["stream", "json"], default="stream")
+    parser.add_argument("--num-questions", type=int, default=5)
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=6, help="pages/slides per document (scanned PDFs: half)")
+    parser.add_argument("--mix", type=lambda v: v.split(","), default=None,
+                        help=f"document kinds to cycle through (default: {','.join(KINDS)})")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--groq-latency-ms", type=float, default=300, help="stub Groq time before the first token")
+    parser.add_argument("--groq-token-ms", type=float, default=10, help="stub Groq time per generated token")
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--groq-keys", type=int, default=3)
+    parser.add_argument("--drive-latency-ms", type=float, default=50)
+    parser.add_argument("--server", choices=["gunicorn", "flask"], default="gunicorn")
+    parser.add_argument("--workers", type=int, default=1, help="WEB_CONCURRENCY for the gunicorn server")
+    parser.add_argument("--ready-timeout", type=float, default=300)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the service, e.g. --env RERANK_ENABLED=true")
+    args = parser.parse_args()
+    if args.command != "compare":
+        args.env = dict(item.split("=", 1) for item in args.env)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    compare(args) if args.command == "compare" else run(args)
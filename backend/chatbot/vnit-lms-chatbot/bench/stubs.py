@@ -0,0 +1,171 @@
+"""
+Local stand-ins for the services the chatbot calls, so benchmarks run offline.
+
+StubGroqServer answers the OpenAI-compatible chat completions API the Groq
+SDK uses (point the app at it with GROQ_BASE_URL). It waits a configurable
+time before answering, streams tokens at a configurable rate, reports token
+usage and rate-limit headers like Groq does, and returns valid question JSON
+for question generation prompts.
+
+DriveFileServer serves corpus files at the Drive download URL format the app
+uses (point the app at it with DRIVE_DOWNLOAD_URL).
+"""
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ANSWER_WORDS = ("the", "context", "explains", "that", "this", "topic", "depends", "on", "its", "definition",
+                "and", "a", "worked", "example", "shows", "how", "it", "behaves", "in", "practice")
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def fake_questions(prompt, rng):
+    """Builds the JSON array a question generation prompt asks for, valid for its question type."""
+    match = re.search(r"Generate (\d+) question\(s\) now", prompt)
+    count = int(match.group(1)) if match else 1
+    type_match = re.search(r'"questionType": "(\w+)"', prompt)
+    question_type = type_match.group(1) if type_match else "mcq_single"
+    questions = []
+    for _ in range(count):
+        number = rng.randint(1, 10_000)
+        question = {"questionText": f"Benchmark question {number}?", "questionType": question_type,
+                    "points": 1, "explanation": "Follows from the provided context."}
+        if question_type == "numerical":
+            question["correctAnswer"] = number
+        else:
+            question["options"] = [f"Option {letter}{number}" for letter in "ABCD"]
+            question["correctAnswer"] = question["options"][0]
+            question["correctAnswers"] = question["options"][:2]
+        questions.append(question)
+    return json.dumps(questions)
+
+
+class StubGroqHandler(QuietHandler):
+    def do_POST(self):
+        config = self.server.config
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            return self.send_json(404, {"error": {"message": "unknown path"}})
+
+        rng = random.Random()
+        prompt = "\n".join(message.get("content", "") for message in body.get("messages", []))
+        if "quiz question generator" in prompt:
+            tokens = re.findall(r"\S+\s*", fake_questions(prompt, rng))
+        else:
+            tokens = [rng.choice(ANSWER_WORDS) + " " for _ in range(config["answer_tokens"])]
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(tokens),
+                 "total_tokens": len(prompt) // 4 + len(tokens)}
+        with self.server.lock:
+            self.server.calls += 1
+        headers = {"x-ratelimit-remaining-requests": "14000", "x-ratelimit-remaining-tokens": "1000000",
+                   "x-ratelimit-reset-requests": "1s", "x-ratelimit-reset-tokens": "1s"}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        time.sleep(config["latency_ms"] / 1000)
+
+        if not body.get("stream"):
+            # A non-streamed completion takes as long as generating every token
+            time.sleep(config["token_ms"] * len(tokens) / 1000)
+            return self.send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            }, headers)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        base = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": body.get("model")}
+        for token in tokens:
+            chunk = {**base, "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(config["token_ms"] / 1000)
+        final = {**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "x_groq": {"usage": usage}}
+        self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        self.wfile.flush()
+        self.close_connection = True
+
+
+class StubGroqServer(StubServer):
+    def __init__(self, latency_ms=300, token_ms=10, answer_tokens=120):
+        super().__init__(StubGroqHandler)
+        self.config = {"latency_ms": latency_ms, "token_ms": token_ms, "answer_tokens": answer_tokens}
+        self.lock = threading.Lock()
+        self.calls = 0
+
+
+class DriveFileHandler(QuietHandler):
+    def do_GET(self):
+        file_id = parse_qs(urlparse(self.path).query).get("id", [""])[0]
+        entry = self.server.files.get(file_id)
+        if entry is None:
+            return self.send_json(404, {"error": "not found"})
+        time.sleep(self.server.latency_ms / 1000)
+        with open(entry["path"], "rb") as f:
+            data = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", entry["content_type"])
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class DriveFileServer(StubServer):
+    def __init__(self, directory, manifest, latency_ms=0):
+        super().__init__(DriveFileHandler)
+        self.latency_ms = latency_ms
+        self.files = {doc["id"]: {"path": os.path.join(directory, doc["filename"]),
+                                  "content_type": doc["content_type"]} for doc in manifest}
+
+    @property
+    def download_url(self):
+        """Value for the app's DRIVE_DOWNLOAD_URL."""
+        return self.url + "/uc?export=download&id={file_id}"
@@ -0,0 +1,230 @@
+"""Query embedding, retrieval and semantic answer caches."""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import json
+import numpy as np
+
+from config import (
+    QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL, RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL,
+    ANSWER_CACHE_ENABLED, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL,
+)
+from telemetry import CACHE_LOOKUPS
+from state_db import get_state_db
+from models import collection_change_listeners, collection_reload_listeners
+
+
+# --- 1. QUERY AND RETRIEVAL CACHES ---
+
+class TTLCache:
+    """Thread-safe, size-bounded LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, max_size, ttl, name):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0  # bumped on every clear(), see set()
+        self._hit_counter = CACHE_LOOKUPS.labels(name, "hit")
+        self._miss_counter = CACHE_LOOKUPS.labels(name, "miss")
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                self._miss_counter.inc()
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            self._hit_counter.inc()
+            return entry[1]
+
+    def set(self, key, value, generation=None):
+        """
+        Stores `value`. Pass the `generation` read before computing the value:
+        if the cache was cleared in the meantime the (possibly stale) value is dropped.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.generation += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+query_embedding_cache = TTLCache(QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL, "query_embedding")
+retrieval_cache = TTLCache(RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL, "retrieval")
+collection_change_listeners.append(lambda changed_ids: retrieval_cache.clear())
+collection_reload_listeners.append(retrieval_cache.clear)
+
+
+# --- 2. SEMANTIC ANSWER CACHE ---
+
+class SemanticAnswerCache:
+    """
+    Remembers recent chat answers together with the question embedding and the
+    IDs of the chunks the answer was generated from. A new question reuses an
+    answer when it retrieved exactly the same chunks and its embedding is
+    within `threshold` cosine similarity of the cached question.
+    """
+
+    def __init__(self, max_entries, threshold, ttl):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self._entries = OrderedDict()  # entry_id -> (vector, chunk_key, answer, created_at)
+        self._by_chunks = {}           # chunk_key -> set of entry_ids
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _chunk_key(chunk_ids):
+        return tuple(sorted(chunk_ids))
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _ensure_loaded(self):
+        """Loads persisted entries from the state database on first use."""
+        if self._loaded:
+            return
+        rows = get_state_db().execute(
+            "SELECT entry_id, embedding, chunk_ids, answer, created_at FROM answer_cache "
+            "WHERE created_at > ? ORDER BY created_at DESC LIMIT ?",
+            (time.time() - self.ttl, self.max_entries),
+        ).fetchall()
+        for entry_id, blob, chunk_ids, answer, created_at in reversed(rows):
+            self._add(entry_id, np.frombuffer(blob, dtype=np.float32),
+                      self._chunk_key(json.loads(chunk_ids)), answer, created_at)
+        self._loaded = True
+        print(f"[Answer Cache] Loaded {len(rows)} cached answer(s).")
+
+    def _add(self, entry_id, vector, chunk_key, answer, created_at):
+        self._entries[entry_id] = (vector, chunk_key, answer, created_at)
+        self._by_chunks.setdefault(chunk_key, set()).add(entry_id)
+
+    def _remove(self, entry_id):
+        _, chunk_key, _, _ = self._entries.pop(entry_id)
+        ids = self._by_chunks.get(chunk_key)
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del self._by_chunks[chunk_key]
+
+    def lookup(self, question_vector, chunk_ids):
+        """Returns a cached answer for a near-duplicate question over the same chunks, or None."""
+        query = self._unit(question_vector)
+        chunk_key = self._chunk_key(chunk_ids)
+        now = time.time()
+        with self._lock:
+            self._ensure_loaded()
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._by_chunks.get(chunk_key, ())):
+                vector, _, _, created_at = self._entries[entry_id]
+                # Entries stored by another embedding model (around an index swap) can't be compared
+                if created_at < now - self.ttl or vector.shape != query.shape:
+                    continue
+                score = float(np.dot(query, vector))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                CACHE_LOOKUPS.labels("answers", "miss").inc()
+                return None
+            self.hits += 1
+            CACHE_LOOKUPS.labels("answers", "hit").inc()
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][2]
+
+    def store(self, question, question_vector, chunk_ids, answer):
+        vector = self._unit(question_vector)
+        chunk_key = self._chunk_key(chunk_ids)
+        entry_id = uuid.uuid4().hex
+        created_at = time.time()
+        evicted = []
+        with self._lock:
+            self._ensure_loaded()
+            self._add(entry_id, vector, chunk_key, answer, created_at)
+            while len(self._entries) > self.max_entries:
+                oldest_id = next(iter(self._entries))
+                self._remove(oldest_id)
+                evicted.append(oldest_id)
+        with get_state_db() as conn:
+            conn.execute(
+                "INSERT INTO answer_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (entry_id, question, vector.tobytes(), json.dumps(list(chunk_key)), answer, created_at),
+            )
+            conn.executemany("DELETE FROM answer_cache WHERE entry_id = ?", [(e,) for e in evicted])
+
+    def invalidate_chunks(self, changed_ids):
+        """Drops every cached answer that was generated from any of `changed_ids`."""
+        changed = set(changed_ids)
+        with self._lock:
+            stale = [entry_id for entry_id, (_, chunk_key, _, _) in self._entries.items()
+                     if changed.intersection(chunk_key)]
+            for entry_id in stale:
+                self._remove(entry_id)
+        # Also remove persisted entries that are not loaded in this process
+        rows = get_state_db().execute("SELECT entry_id, chunk_ids FROM answer_cache").fetchall()
+        stale_rows = [(entry_id,) for entry_id, chunk_ids in rows if changed.intersection(json.loads(chunk_ids))]
+        with get_state_db() as conn:
+            conn.executemany("DELETE FROM answer_cache WHERE entry_id = ?", stale_rows)
+        if stale_rows:
+            print(f"[Answer Cache] Invalidated {len(stale_rows)} answer(s) after ingestion.")
+
+    def reset(self):
+        """Forgets the in-memory entries; they are reloaded from the state database on next use."""
+        with self._lock:
+            self._entries.clear()
+            self._by_chunks.clear()
+            self._loaded = False
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": ANSWER_CACHE_ENABLED,
+                "size": len(self._entries),
+                "max_size": self.max_entries,
+                "similarity_threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+answer_cache = SemanticAnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_TTL)
+collection_change_listeners.append(answer_cache.invalidate_chunks)
+collection_reload_listeners.append(answer_cache.reset)
@@ -0,0 +1,195 @@
+"""The chat pipeline shared by the Flask and ASGI routes: retrieval, prompting and answer streaming."""
+import threading
+import time
+import contextvars
+import json
+
+from config import GROQ_MODEL, ANSWER_CACHE_ENABLED, CHAT_CONTEXT_CHUNKS, CHAT_CONTEXT_TOKEN_BUDGET
+from telemetry import log_event, record_stage, timed_stage
+from groq_keys import groq_pool
+from models import serving_index
+from caches import answer_cache
+from retrieval import embed_query, search_chunks, build_context
+from admission import AdmissionRejected, chat_lane, interactive_cpu_work
+from flights import Flight, chat_flight_key, run_flight, refuse_flight, chat_flights
+
+
+# --- 1. CHAT ANSWERS ---
+
+NO_CONTEXT_ANSWER = "I'm sorry, but I don't have that information in my knowledge base."
+
+CHAT_SYSTEM_PROMPT = """
+        You are a helpful AI teaching assistant for the VNIT Learning Management System.
+        Your goal is to answer student questions based ONLY on the provided course materials.
+        
+        Follow these rules STRICTLY:
+        1. Use ONLY the 'Provided Context' below to answer the question.
+        2. If the answer is not in the context, clearly state: "I'm sorry, but I don't have that information in my knowledge base."
+        3. Do not make up answers or use any external knowledge.
+        4. Be concise and direct in your response.
+        """
+
+def build_chat_messages(context, user_question):
+    """Builds the Groq messages for answering `user_question` from `context`."""
+    final_prompt = f"""
+        {CHAT_SYSTEM_PROMPT}
+        
+        ---
+        Provided Context:
+        {context}
+        ---
+        
+        Student Question:
+        {user_question}
+        
+        Answer:
+        """
+    return [{"role": "user", "content": final_prompt}]
+
+def retrieve_chat_context(user_question, timings, scope=None):
+    """
+    Embeds the question, retrieves the top chunks for it within the course/material
+    `scope` and assembles them into passages that fit CHAT_CONTEXT_TOKEN_BUDGET.
+    Returns (question_vector, chunk_ids, passages, sources) and records timings in ms.
+    `sources` describes each chunk used: its id, distance and course/material/page metadata.
+    """
+    with interactive_cpu_work():
+        # One index for the whole request, even if the alias is swapped meanwhile
+        index = serving_index()
+        # 1. Vectorize the user's question
+        with timed_stage("embed", timings):
+            question_vector = embed_query(user_question, index)
+
+        # 2. Query ChromaDB to find relevant context
+        print("Searching for context...")
+        with timed_stage("retrieve", timings):
+            hits = search_chunks(
+                user_question,
+                question_vector,
+                n_results=CHAT_CONTEXT_CHUNKS, # Get the most relevant chunks
+                scope=scope,
+                index=index
+            )
+            passages, hits = build_context(hits, CHAT_CONTEXT_TOKEN_BUDGET)
+
+    sources = []
+    for hit in hits:
+        source = {"id": hit["id"], "distance": hit["distance"]}
+        source.update({key: value for key, value in hit["metadata"].items()
+                       if key in ("courseId", "materialId", "fileType", "page", "slide")})
+        sources.append(source)
+    return question_vector, [hit["id"] for hit in hits], passages, sources
+
+
+class ChatAnswer:
+    """
+    One chat answer being produced: the retrieval, answer cache and bookkeeping
+    around the Groq stream. chat_events here and in asgi.py drive it; they only
+    differ in how they wait for the blocking steps and the stream.
+    """
+
+    def __init__(self, user_question, scope):
+        self.user_question = user_question
+        self.scope = scope
+        self.started = time.monotonic()
+        self.timings = {}
+        self.answer = None  # set by retrieve() when no Groq call is needed
+        self.cached = False
+        self.parts = []
+
+    def retrieve(self):
+        """Retrieves the context and looks for a reusable answer (blocking). Returns the sources event."""
+        self.question_vector, self.context_ids, self.context_chunks, sources = retrieve_chat_context(
+            self.user_question, self.timings, self.scope
+        )
+        if not self.context_chunks:
+            print("No relevant context found in database.")
+            self.answer = NO_CONTEXT_ANSWER
+        elif ANSWER_CACHE_ENABLED:
+            # A near-duplicate of a recent question over the same chunks can reuse its answer
+            self.answer = answer_cache.lookup(self.question_vector, self.context_ids)
+            self.cached = self.answer is not None
+        return "sources", {"sources": sources}
+
+    def completion_request(self):
+        """The arguments of the streaming Groq call, when retrieve() left no answer to reuse."""
+        print("Streaming prompt to Groq...")
+        self.generation_started = time.monotonic()
+        return {
+            "messages": build_chat_messages("\n\n".join(self.context_chunks), self.user_question),
+            "model": GROQ_MODEL,
+            "stream": True,
+        }
+
+    def token(self, text):
+        """The token event for the next piece of the answer."""
+        if not self.parts:
+            record_stage("first_token", time.monotonic() - self.started, self.timings)
+        self.parts.append(text)
+        return "token", {"text": text}
+
+    def finish(self):
+        """Caches a generated answer (blocking). Returns the done event."""
+        if self.answer is None:
+            self.answer = "".join(self.parts)
+            record_stage("generate", time.monotonic() - self.generation_started, self.timings)
+            print(f"Groq Answer: {self.answer}")
+            if ANSWER_CACHE_ENABLED and self.answer:
+                answer_cache.store(self.user_question, self.question_vector, self.context_ids, self.answer)
+        self.timings["total_ms"] = round(1000 * (time.monotonic() - self.started), 1)
+        return "done", {"answer": self.answer, "cached": self.cached, "timings": self.timings}
+
+
+def stream_text(chunk):
+    """The text of one chunk of a streamed Groq completion, or None."""
+    return chunk.choices[0].delta.content if chunk.choices else None
+
+def chat_events(user_question, scope):
+    """
+    Answers `user_question` from the chunks in `scope`, yielding (event, data)
+    pairs: sources, then one token per streamed piece of the answer, then done.
+    """
+    chat = ChatAnswer(user_question, scope)
+    yield chat.retrieve()
+    if chat.answer is not None:
+        yield chat.token(chat.answer)
+    else:
+        # 3. Call Groq LLM
+        for chunk in groq_pool.create_chat_completion(**chat.completion_request()):
+            text = stream_text(chunk)
+            if text:
+                yield chat.token(text)
+    yield chat.finish()
+
+def join_chat_flight(user_question, scope, background):
+    """
+    Returns the flight answering this question within `scope`, starting one
+    if no identical question is being answered. A new flight runs in this
+    thread, or in a background thread when `background` is set (streams:
+    the answer must outlive the leader's connection, since others follow it).
+    Only a new flight takes a slot in the chat lane; raises AdmissionRejected
+    (and so refuses its followers too) if it can't get one.
+    """
+    key = chat_flight_key(user_question, scope)
+    flight, leader = chat_flights.join(key, Flight)
+    if not leader:
+        log_event("single_flight_join", flight="chat")
+        return flight
+    try:
+        slot = chat_lane.acquire()
+    except AdmissionRejected as e:
+        refuse_flight(chat_flights, key, flight, e)
+        raise
+    events = chat_events(user_question, scope)
+    if background:
+        run = contextvars.copy_context().run
+        threading.Thread(target=run, args=(run_flight, chat_flights, key, flight, events, slot),
+                         name="chat-flight", daemon=True).start()
+    else:
+        run_flight(chat_flights, key, flight, events, slot)
+    return flight
+
+
+def sse_event(event, data):
+    """Formats one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
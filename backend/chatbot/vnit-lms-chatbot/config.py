@@ -0,0 +1,243 @@
+"""
+Settings of the chatbot service, read from the environment (and .env) once at import.
+Every other module imports the names it uses from here.
+"""
+import os
+import tempfile
+from dotenv import load_dotenv
+
+
+# --- 1. LOAD ENVIRONMENT VARIABLES ---
+
+print("Loading environment variables...")
+load_dotenv()  # This loads the .env file
+
+
+# --- 2. GET AND SPLIT API KEYS ---
+
+keys_string = os.environ.get("GROQ_API_KEYS")
+if not keys_string:
+    print("Error: GROQ_API_KEYS not found in .env file.")
+    print("Please create a .env file and add: GROQ_API_KEYS='key1,key2,...'")
+    exit()
+
+api_key_list = [key.strip() for key in keys_string.split(',') if key.strip()]
+print(f"Spreading requests over {len(api_key_list)} Groq API keys.")
+
+
+# --- 3. GLOBAL CONSTANTS ---
+
+DB_PATH = os.environ.get("CHROMA_DB_PATH", "./chroma_db")
+COLLECTION_NAME = "vnit_lms"
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+GROQ_MODEL = "llama-3.1-8b-instant" # Replaced the decommissioned model
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+# COLLECTION_NAME, EMBEDDING_MODEL, CHUNK_SIZE and CHUNK_OVERLAP describe the
+# first index only. Queries are served from the index the alias in the state
+# database points at; to change the model or the chunking, build a shadow index
+# with reindex.py and swap the alias once it is verified (see indexes.py).
+
+# Embedding backend: "torch" runs the SentenceTransformer model; "onnx" runs the
+# same model on ONNX Runtime with int8-quantized weights, without importing torch.
+# The ONNX files come from the model's Hugging Face repo unless local paths are given.
+EMBEDDING_BACKENDS = ("torch", "onnx")
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch").lower()
+if EMBEDDING_BACKEND not in EMBEDDING_BACKENDS:
+    raise ValueError(f"EMBEDDING_BACKEND must be one of {EMBEDDING_BACKENDS}, got '{EMBEDDING_BACKEND}'")
+ONNX_MODEL_FILE = os.environ.get("ONNX_MODEL_FILE", "onnx/model_quint8_avx2.onnx")
+ONNX_MODEL_PATH = os.environ.get("ONNX_MODEL_PATH")
+ONNX_TOKENIZER_PATH = os.environ.get("ONNX_TOKENIZER_PATH")
+EMBEDDING_MAX_SEQ_LENGTH = 256  # all-MiniLM-L6-v2 truncates inputs to 256 tokens
+# Cached chunk embeddings are only reused by the model and backend that produced them
+def embedding_cache_key(model_name):
+    if EMBEDDING_BACKEND == "torch":
+        return model_name
+    return f"{model_name}|onnx|{os.path.basename(ONNX_MODEL_PATH or ONNX_MODEL_FILE)}"
+# Parity check: stored vectors are compared with the configured backend's vectors
+# for the same chunks. Below this mean cosine similarity documents should be re-ingested.
+EMBEDDING_PARITY_SAMPLE = int(os.environ.get("EMBEDDING_PARITY_SAMPLE", 200))
+EMBEDDING_PARITY_MIN_COSINE = float(os.environ.get("EMBEDDING_PARITY_MIN_COSINE", 0.98))
+
+# Ingestion queue settings. Jobs run as a pipeline: INGEST_DOWNLOAD_WORKERS
+# threads download (network bound), INGEST_WORKERS threads extract text (CPU
+# bound; a fixed number keeps OCR from fighting over the CPU) and one thread
+# embeds and stores the chunks of several documents at a time.
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 2))
+INGEST_DOWNLOAD_WORKERS = int(os.environ.get("INGEST_DOWNLOAD_WORKERS", 4))
+INGEST_STORE_BATCH_CHUNKS = int(os.environ.get("INGEST_STORE_BATCH_CHUNKS", 1024))  # chunks per embed/store round
+INGEST_STORE_BATCH_SIZE = 1000  # chunks per collection.upsert call
+INGEST_BULK_MAX_ITEMS = int(os.environ.get("INGEST_BULK_MAX_ITEMS", 100))  # links + files per bulk request
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", 100))
+INGEST_JOB_RETENTION = int(os.environ.get("INGEST_JOB_RETENTION", 3600))  # seconds to keep finished jobs
+INGEST_STAGES = ["download", "extract", "chunk", "embed", "store"]
+INGEST_PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+INGEST_EMBED_BATCH_SIZE = 64  # chunks per encode call, also the progress granularity
+INGEST_POLL_INTERVAL = 2.0  # seconds between checks for jobs queued by other processes
+# Jobs interrupted by a restart (redeploy, OOM kill) are queued again and resume
+# from their checkpoints: the downloaded file's hash, every OCR'd page and every
+# embedded batch. A job interrupted more than INGEST_MAX_RESUMES times is failed
+# instead, since it is probably what brought the process down.
+INGEST_MAX_RESUMES = int(os.environ.get("INGEST_MAX_RESUMES", 3))
+PAGE_CHECKPOINT_TTL = 7 * 24 * 3600  # seconds to keep OCR'd pages of documents whose extraction never finished
+
+# Download settings. Files are streamed to disk in chunks instead of being held in memory.
+DOWNLOAD_DIR = os.environ.get("DOWNLOAD_DIR", tempfile.gettempdir())
+# Where Drive files are downloaded from; the benchmark suite points this at a local file server
+DRIVE_DOWNLOAD_URL = os.environ.get("DRIVE_DOWNLOAD_URL", "https://drive.google.com/uc?export=download&id={file_id}")
+MAX_DOWNLOAD_MB = int(os.environ.get("MAX_DOWNLOAD_MB", 250))
+DOWNLOAD_CONNECT_TIMEOUT = float(os.environ.get("DOWNLOAD_CONNECT_TIMEOUT", 10))  # seconds
+DOWNLOAD_READ_TIMEOUT = float(os.environ.get("DOWNLOAD_READ_TIMEOUT", 60))  # seconds between received bytes
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Query embeddings from concurrent requests are encoded together in micro-batches.
+# A batch is sent to the model when it is full or the oldest request has waited EMBED_BATCH_MAX_WAIT_MS.
+EMBED_BATCH_MAX_SIZE = int(os.environ.get("EMBED_BATCH_MAX_SIZE", 32))
+EMBED_BATCH_MAX_WAIT_MS = float(os.environ.get("EMBED_BATCH_MAX_WAIT_MS", 5))
+
+# Caches in front of the RAG path: question text -> embedding, and
+# (embedding, n_results, filters) -> retrieved chunks. The retrieval cache is
+# cleared whenever ingestion writes to the collection.
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 4096))
+QUERY_EMBEDDING_CACHE_TTL = int(os.environ.get("QUERY_EMBEDDING_CACHE_TTL", 24 * 3600))  # seconds
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE", 2048))
+RETRIEVAL_CACHE_TTL = int(os.environ.get("RETRIEVAL_CACHE_TTL", 900))  # seconds
+
+# Semantic answer cache: a question is answered from the cache when it retrieved
+# the same chunks as a cached question and their embeddings are at least
+# ANSWER_CACHE_SIMILARITY (cosine) apart. Entries persist in the state database.
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", 0.95))
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 5000))
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", 7 * 24 * 3600))  # seconds
+
+# Single-flight coalescing: identical chat questions (same normalized text and
+# scope) or question generation requests that arrive while one is already being
+# answered wait for that answer instead of calling Groq again.
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+# Admission control. Chat and question generation each have a lane with its own
+# concurrency limit (0 = unlimited). A request that finds its lane full waits in
+# the lane's queue; it is refused with 503 and Retry-After when the queue already
+# holds *_MAX_QUEUE requests, when its expected wait exceeds *_MAX_QUEUE_WAIT_MS,
+# or once it has waited that long. Limits apply per worker process.
+CHAT_MAX_CONCURRENCY = int(os.environ.get("CHAT_MAX_CONCURRENCY", 64))
+CHAT_MAX_QUEUE = int(os.environ.get("CHAT_MAX_QUEUE", 256))
+CHAT_MAX_QUEUE_WAIT_MS = float(os.environ.get("CHAT_MAX_QUEUE_WAIT_MS", 10000))
+QUESTION_MAX_CONCURRENCY = int(os.environ.get("QUESTION_MAX_CONCURRENCY", 8))
+QUESTION_MAX_QUEUE = int(os.environ.get("QUESTION_MAX_QUEUE", 32))
+QUESTION_MAX_QUEUE_WAIT_MS = float(os.environ.get("QUESTION_MAX_QUEUE_WAIT_MS", 30000))
+RETRY_AFTER_MAX = 60  # seconds; cap on the Retry-After of a refused request
+# Per-user rate limits in requests per minute (0 = off), as token buckets that
+# allow bursts of RATE_LIMIT_BURST; 429 with Retry-After when exceeded. Requests
+# are counted per client IP: the address Render's proxy appended last to
+# X-Forwarded-For (earlier hops are client-supplied). A caller that can sign user
+# IDs with RATE_LIMIT_USER_SECRET (X-User-ID plus X-User-Signature, the hex
+# HMAC-SHA256 of the ID) is counted per user instead; unsigned IDs are ignored.
+CHAT_RATE_LIMIT_PER_MINUTE = float(os.environ.get("CHAT_RATE_LIMIT_PER_MINUTE", 30))
+QUESTION_RATE_LIMIT_PER_MINUTE = float(os.environ.get("QUESTION_RATE_LIMIT_PER_MINUTE", 10))
+INGEST_RATE_LIMIT_PER_MINUTE = float(os.environ.get("INGEST_RATE_LIMIT_PER_MINUTE", 60))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 10))
+RATE_LIMIT_USER_SECRET = os.environ.get("RATE_LIMIT_USER_SECRET", "")
+RATE_LIMIT_MAX_USERS = 10000  # buckets kept per limiter; idle (full) ones are dropped beyond this
+# Ingestion runs behind interactive requests: its threads and OCR processes run
+# at INGEST_NICE (Linux niceness, 0 = unchanged), and between pages and embedding
+# batches it pauses, up to INGEST_YIELD_MAX_MS at a time, while chat or question
+# requests are retrieving context or waiting for a lane.
+INGEST_NICE = int(os.environ.get("INGEST_NICE", 10))
+INGEST_YIELD_ENABLED = os.environ.get("INGEST_YIELD_ENABLED", "true").lower() == "true"
+INGEST_YIELD_MAX_MS = float(os.environ.get("INGEST_YIELD_MAX_MS", 2000))
+INGEST_YIELD_POLL_INTERVAL = 0.02  # seconds between checks while yielding
+
+# Hybrid retrieval: every chunk is also kept in a BM25 full-text index (SQLite
+# FTS5 in the state database), and the lexical and vector hits are merged by
+# reciprocal rank fusion so exact terms ("CS101", "Theorem 4.2") are not missed.
+HYBRID_SEARCH_ENABLED = os.environ.get("HYBRID_SEARCH_ENABLED", "true").lower() == "true"
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", 20))  # hits taken from each retriever before fusion
+RRF_K = 60  # rank constant of reciprocal rank fusion
+# Chunks sent to Groq per prompt
+CHAT_CONTEXT_CHUNKS = int(os.environ.get("CHAT_CONTEXT_CHUNKS", 4))
+QUESTION_CONTEXT_CHUNKS = int(os.environ.get("QUESTION_CONTEXT_CHUNKS", 8))
+
+# Question generation fans out into concurrent Groq calls of QUESTIONS_PER_CALL
+# questions, each over its own slice of the context passages (fewer, larger
+# calls when there are fewer passages than calls). Only slots that come back
+# short are retried. Generated sets are cached per (topic, type, difficulty,
+# context) for QUESTION_CACHE_TTL seconds.
+QUESTIONS_PER_CALL = int(os.environ.get("QUESTIONS_PER_CALL", 3))
+QUESTION_RETRY_ROUNDS = int(os.environ.get("QUESTION_RETRY_ROUNDS", 2))
+QUESTION_FANOUT_WORKERS = int(os.environ.get("QUESTION_FANOUT_WORKERS", 8))
+QUESTION_CACHE_TTL = int(os.environ.get("QUESTION_CACHE_TTL", 7 * 24 * 3600))  # seconds
+
+# Optional cross-encoder reranking: over-fetch RERANK_CANDIDATES hits, score them
+# against the query with a small CPU cross-encoder in one batch and keep the best.
+# If scoring takes longer than RERANK_TIMEOUT_MS the retrieval order is used instead.
+RERANK_ENABLED = os.environ.get("RERANK_ENABLED", "false").lower() == "true"
+RERANK_MODEL = os.environ.get("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_CANDIDATES = int(os.environ.get("RERANK_CANDIDATES", 50))
+RERANK_TIMEOUT_MS = float(os.environ.get("RERANK_TIMEOUT_MS", 250))
+RERANK_SCORE_CACHE_SIZE = int(os.environ.get("RERANK_SCORE_CACHE_SIZE", 50000))
+
+# Context assembly: retrieved chunks are merged with their neighbours, stripped
+# of repeated overlap and near-duplicates, and packed best-first into at most
+# this many (estimated) prompt tokens.
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.environ.get("CHAT_CONTEXT_TOKEN_BUDGET", 1500))
+QUESTION_CONTEXT_TOKEN_BUDGET = int(os.environ.get("QUESTION_CONTEXT_TOKEN_BUDGET", 3000))
+NEAR_DUPLICATE_SIMILARITY = 0.8  # word 5-gram Jaccard similarity above which a passage is a duplicate
+
+# Replica role. "all" serves chat and runs ingestion; "chat" only answers
+# questions, so it never starts ingestion workers or loads EasyOCR.
+CHATBOT_ROLE = os.environ.get("CHATBOT_ROLE", "all")
+INGEST_ENABLED = CHATBOT_ROLE != "chat"
+OCR_ENABLED = INGEST_ENABLED and os.environ.get("OCR_ENABLED", "true").lower() == "true"
+
+# Groq key pool: how often a failed call is retried on another key, and the
+# base of the jittered exponential backoff between attempts.
+GROQ_MAX_ATTEMPTS = int(os.environ.get("GROQ_MAX_ATTEMPTS", 4))
+GROQ_BACKOFF_SECONDS = float(os.environ.get("GROQ_BACKOFF_SECONDS", 0.5))
+GROQ_MAX_COOLDOWN_WAIT = 10.0  # never sleep longer than this waiting for a rate-limited key
+
+# Local SQLite database for ingestion state: the extraction/embedding cache and
+# the list of chunk IDs stored for each Drive file.
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "./chatbot_state.sqlite3")
+INGEST_LOCK_PATH = STATE_DB_PATH + ".ingest.lock"
+
+# Shadow reindexing (reindex.py): a new collection is built from the stored
+# document text in the background and swapped in by moving the index alias.
+# Writes to the live index and the swap itself take INDEX_LOCK_PATH. The build
+# runs at INGEST_NICE with REINDEX_THREADS torch threads, and embeds only
+# REINDEX_DUTY_CYCLE of the time (0.5 = sleeps as long as it worked).
+INDEX_LOCK_PATH = STATE_DB_PATH + ".index.lock"
+REINDEX_THREADS = int(os.environ.get("REINDEX_THREADS", 1))
+REINDEX_DUTY_CYCLE = min(1.0, max(0.05, float(os.environ.get("REINDEX_DUTY_CYCLE", 0.5))))
+REINDEX_BATCH_CHUNKS = 256  # chunks embedded and upserted per build step
+# Verification before a swap: a sample of the new index's chunks must find
+# themselves in the top REINDEX_VERIFY_TOP_K results for at least this fraction.
+REINDEX_VERIFY_SAMPLE = int(os.environ.get("REINDEX_VERIFY_SAMPLE", 200))
+REINDEX_VERIFY_TOP_K = 5
+REINDEX_VERIFY_MIN_RECALL = float(os.environ.get("REINDEX_VERIFY_MIN_RECALL", 0.9))
+
+# Pre-fork serving (set by gunicorn.conf.py when WEB_CONCURRENCY > 1): models are
+# loaded once in the gunicorn master and shared copy-on-write by the forked
+# workers, and Chroma runs as a single server process (CHROMA_SERVER_URL) that
+# owns chroma.sqlite3 instead of every worker opening it.
+PREFORK = os.environ.get("CHATBOT_PREFORK") == "1"
+CHROMA_SERVER_URL = os.environ.get("CHROMA_SERVER_URL")
+# How often a process checks whether another process changed the collection
+COLLECTION_VERSION_CHECK_INTERVAL = 1.0  # seconds
+
+# OCR settings for scanned PDFs. Each OCR worker process holds its own EasyOCR
+# reader (a few hundred MB), so keep OCR_WORKERS in line with the instance RAM.
+# OCR_WORKERS=0 runs OCR in this process, one page at a time.
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", max(1, min(4, (os.cpu_count() or 2) // 2))))
+OCR_THREADS_PER_WORKER = int(os.environ.get("OCR_THREADS_PER_WORKER", 1))
+OCR_ZOOM = 2.0  # 2x zoom for better OCR
+
+# Observability. /metrics serves Prometheus metrics; in pre-fork mode gunicorn.conf.py
+# sets PROMETHEUS_MULTIPROC_DIR so the samples of every worker are added together.
+# With PROFILING_ENABLED, a request sent with "X-Profile: 1" (or ?profile=1) runs
+# under cProfile and its stats are written to PROFILE_DIR/<request id>.prof.
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "chatbot_profiles"))
+# Routes counted in the metrics but not written to the request log (scrapes and health checks)
+UNLOGGED_ROUTES = {"/metrics", "/healthz", "/readyz"}
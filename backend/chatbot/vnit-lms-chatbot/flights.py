@@ -0,0 +1,159 @@
+"""Single-flight coalescing: identical concurrent requests share one answer."""
+import threading
+import json
+
+from config import SINGLE_FLIGHT_ENABLED
+from telemetry import SINGLE_FLIGHT_REQUESTS, log_event
+from retrieval import normalize_query
+from admission import AdmissionRejected
+
+
+# --- 1. SINGLE-FLIGHT REQUEST COALESCING ---
+
+class Flight:
+    """
+    The events of one chat answer being produced. Identical requests that
+    arrive while it runs follow it: they get the events published so far,
+    then each new one as it is published.
+    """
+
+    def __init__(self):
+        self.events = []  # (event, data), as yielded by chat_events
+        self.finished = False
+        self._condition = threading.Condition()
+
+    def publish(self, event, data):
+        with self._condition:
+            self.events.append((event, data))
+            self._condition.notify_all()
+
+    def finish(self):
+        with self._condition:
+            self.finished = True
+            self._condition.notify_all()
+
+    def follow(self):
+        """Yields every event of the flight, waiting for new ones until it finishes."""
+        index = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: index < len(self.events) or self.finished)
+                pending = self.events[index:]
+                finished = self.finished
+            yield from pending
+            index += len(pending)
+            if finished and index == len(self.events):
+                return
+
+    def wait(self):
+        """Waits for the flight to finish and returns all its events."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.finished)
+            return list(self.events)
+
+
+class SingleFlight:
+    """
+    Maps request keys to the flight (a Flight, Future or asyncio Task) working
+    on them, so identical concurrent requests share one piece of work.
+    A flight lands (is forgotten) when it finishes; later requests start a new one.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.led = 0
+        self.joined = 0
+        single_flight_groups.append(self)
+
+    def join(self, key, start):
+        """Returns (flight, is_leader): the flight in progress for `key`, or a new one made by start()."""
+        if not SINGLE_FLIGHT_ENABLED:
+            return start(), True
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.joined += 1
+                SINGLE_FLIGHT_REQUESTS.labels(self.name, "follower").inc()
+                return flight, False
+            flight = self._flights[key] = start()
+            self.led += 1
+        SINGLE_FLIGHT_REQUESTS.labels(self.name, "leader").inc()
+        return flight, True
+
+    def land(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._flights), "led": self.led, "joined": self.joined}
+
+
+single_flight_groups = []
+
+def single_flight_stats():
+    return {"enabled": SINGLE_FLIGHT_ENABLED, **{group.name: group.stats() for group in single_flight_groups}}
+
+def chat_flight_key(user_question, scope):
+    return (normalize_query(user_question), json.dumps(scope or {}, sort_keys=True))
+
+def question_flight_key(params, scope, refresh):
+    return (normalize_query(params["topic"]), params["question_type"], params["num_questions"],
+            params["difficulty"], json.dumps(scope or {}, sort_keys=True), refresh)
+
+def run_flight(flights, key, flight, events, slot=None):
+    """
+    Publishes `events` (a chat_events generator) to `flight` until it is done,
+    then releases the flight's admission `slot`, if any.
+    """
+    try:
+        for event, data in events:
+            flight.publish(event, data)
+    except Exception as e:
+        fail_flight(flight, e)
+    finally:
+        land_flight(flights, key, flight, slot)
+
+def fail_flight(flight, error):
+    """Ends a flight's events with an error event for `error`, raised while producing them."""
+    log_event("error", where="chat_flight", error=str(error))
+    flight.publish("error", {"error": f"An internal error occurred: {error}"})
+
+def refuse_flight(flights, key, flight, error):
+    """
+    Ends a flight that never got an admission slot: its followers get the
+    same refusal (`error` is an AdmissionRejected) or see it cancelled.
+    """
+    if isinstance(error, AdmissionRejected):
+        flight.publish("error", error.to_dict())
+    else:
+        flight.publish("error", {"error": "The request was cancelled."})
+    land_flight(flights, key, flight)
+
+def land_flight(flights, key, flight, slot=None):
+    """Releases the flight's admission `slot`, if any, forgets the flight and wakes its followers."""
+    if slot is not None:
+        slot.release()
+    flights.land(key, flight)
+    flight.finish()
+
+def chat_response(events):
+    """
+    The /chatbot-api/chat JSON body and status code for the events of a finished
+    chat flight. Raises AdmissionRejected if the flight was refused admission.
+    """
+    event, data = events[-1] if events else ("error", {"error": "No answer was produced."})
+    if event == "error" and "retry_after" in data:
+        raise AdmissionRejected.from_dict(data)
+    if event == "error":
+        return {"error": data["error"]}, 500
+    body = {"answer": data["answer"]}
+    if data["cached"]:
+        body["cached"] = True
+    return body, 200
+
+chat_flights = SingleFlight("chat")
+question_flights = SingleFlight("questions")
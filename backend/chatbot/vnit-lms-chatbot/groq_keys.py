@@ -0,0 +1,225 @@
+"""Groq clients for every API key, with per-key cooldowns and rotation on rate limits."""
+import random
+import asyncio
+import threading
+import time
+import re
+from groq import Groq, AsyncGroq, RateLimitError, APIConnectionError, InternalServerError
+
+from config import api_key_list, GROQ_MAX_ATTEMPTS, GROQ_BACKOFF_SECONDS, GROQ_MAX_COOLDOWN_WAIT
+from telemetry import GROQ_REQUESTS, GROQ_TOKENS, log_event, timed_stage
+
+
+# --- 1. GROQ API KEY POOL ---
+
+def parse_groq_duration(value):
+    """Parses Groq reset headers such as '7.66s', '2m59.56s', '1h2m' or '250ms' into seconds."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        total += float(amount) * {"ms": 0.001, "h": 3600, "m": 60, "s": 1}[unit]
+    return total
+
+
+RETRYABLE_GROQ_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+
+class GroqKey:
+    """One Groq API key, its client, and what Groq last told us about its rate limits."""
+
+    def __init__(self, index, api_key):
+        self.index = index
+        self.label = f"key{index}...{api_key[-4:]}"
+        # The pool does its own retries on a different key
+        self.client = Groq(api_key=api_key, max_retries=0)
+        self.async_client = AsyncGroq(api_key=api_key, max_retries=0)  # used by the ASGI app
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.total_tokens = 0
+        self.in_flight = 0
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.cooldown_until = 0.0
+
+    def record_usage(self, usage):
+        """Adds a completion's token usage to this key's totals."""
+        self.total_tokens += usage.total_tokens or 0
+        GROQ_TOKENS.labels(self.label, "prompt").inc(usage.prompt_tokens or 0)
+        GROQ_TOKENS.labels(self.label, "completion").inc(usage.completion_tokens or 0)
+
+    def update_from_headers(self, headers):
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_requests is not None:
+            self.remaining_requests = int(float(remaining_requests))
+        if remaining_tokens is not None:
+            self.remaining_tokens = int(float(remaining_tokens))
+        # Out of quota: rest the key until Groq says the window resets
+        if self.remaining_requests == 0:
+            reset = parse_groq_duration(headers.get("x-ratelimit-reset-requests"))
+            self.cooldown_until = max(self.cooldown_until, time.time() + (reset or 1.0))
+        elif self.remaining_tokens == 0:
+            reset = parse_groq_duration(headers.get("x-ratelimit-reset-tokens"))
+            self.cooldown_until = max(self.cooldown_until, time.time() + (reset or 1.0))
+
+    def to_dict(self):
+        return {
+            "key": self.label,
+            "requests": self.requests,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "in_flight": self.in_flight,
+            "total_tokens": self.total_tokens,
+            "remaining_requests": self.remaining_requests,
+            "remaining_tokens": self.remaining_tokens,
+            "cooldown_seconds": round(max(0.0, self.cooldown_until - time.time()), 1),
+        }
+
+
+class GroqKeyPool:
+    """
+    Spreads chat completions round-robin over every configured Groq key.
+    Keys that report no remaining quota or return 429 are rested until their
+    limit resets, and the failed call is retried on another key after a
+    jittered backoff.
+    """
+
+    def __init__(self, api_keys, max_attempts=4, backoff_seconds=0.5):
+        self.keys = [GroqKey(i, key) for i, key in enumerate(api_keys)]
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self._cursor = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self, exclude):
+        """
+        Picks the next usable key in round-robin order, skipping `exclude` and rested keys.
+        Returns (key, seconds_to_wait_before_using_it).
+        """
+        with self._lock:
+            now = time.time()
+            candidates = [key for key in self.keys if key not in exclude] or self.keys
+            count = len(self.keys)
+            ordered = sorted(candidates, key=lambda key: (key.index - self._cursor) % count)
+            ready = [key for key in ordered if key.cooldown_until <= now]
+            # If every key is resting, use the one that becomes available first
+            key = ready[0] if ready else min(ordered, key=lambda key: key.cooldown_until)
+            self._cursor = (key.index + 1) % count
+            key.in_flight += 1
+        wait = min(max(0.0, key.cooldown_until - time.time()), GROQ_MAX_COOLDOWN_WAIT)
+        return key, wait
+
+    def _release(self, key):
+        with self._lock:
+            key.in_flight -= 1
+
+    def _backoff_seconds(self, attempt):
+        return random.uniform(0, self.backoff_seconds * (2 ** attempt))
+
+    def _record_success(self, key, headers, completion):
+        with self._lock:
+            key.requests += 1
+            key.update_from_headers(headers)
+            usage = getattr(completion, "usage", None)
+            if usage is not None:
+                key.record_usage(usage)
+        GROQ_REQUESTS.labels(key.label, "ok").inc()
+
+    def _record_stream_chunk(self, key, chunk):
+        # Groq sends the token usage of a streamed completion in its last chunk
+        usage = getattr(getattr(chunk, "x_groq", None), "usage", None)
+        if usage is not None:
+            with self._lock:
+                key.record_usage(usage)
+
+    def _record_failure(self, key, error):
+        with self._lock:
+            if isinstance(error, RateLimitError):
+                retry_after = parse_groq_duration(error.response.headers.get("retry-after"))
+                key.rate_limited += 1
+                key.update_from_headers(error.response.headers)
+                key.cooldown_until = max(key.cooldown_until, time.time() + (retry_after or 1.0))
+            else:
+                key.errors += 1
+        outcome = "rate_limited" if isinstance(error, RateLimitError) else "error"
+        GROQ_REQUESTS.labels(key.label, outcome).inc()
+        log_event("groq_retry", key=key.label, outcome=outcome, error=str(error))
+
+    def _next_exclusions(self, tried, key):
+        tried.add(key)
+        if len(tried) == len(self.keys):
+            tried.clear()
+
+    def _count_stream_usage(self, key, stream):
+        for chunk in stream:
+            self._record_stream_chunk(key, chunk)
+            yield chunk
+
+    async def _acount_stream_usage(self, key, stream):
+        async for chunk in stream:
+            self._record_stream_chunk(key, chunk)
+            yield chunk
+
+    def create_chat_completion(self, **kwargs):
+        """Drop-in replacement for client.chat.completions.create(**kwargs), with key failover."""
+        tried = set()
+        last_error = None
+        for attempt in range(self.max_attempts):
+            key, wait = self._acquire(tried)
+            try:
+                if wait:
+                    time.sleep(wait)
+                # Streams are timed until Groq starts sending; the handlers time the rest
+                with timed_stage("groq"):
+                    raw = key.client.chat.completions.with_raw_response.create(**kwargs)
+                    completion = raw.parse()
+                self._record_success(key, raw.headers, completion)
+                if kwargs.get("stream"):
+                    return self._count_stream_usage(key, completion)
+                return completion
+            except RETRYABLE_GROQ_ERRORS as e:
+                last_error = e
+                self._record_failure(key, e)
+            finally:
+                self._release(key)
+            self._next_exclusions(tried, key)
+            time.sleep(self._backoff_seconds(attempt))
+        raise last_error
+
+    async def acreate_chat_completion(self, **kwargs):
+        """Awaitable version of create_chat_completion using the keys' AsyncGroq clients."""
+        tried = set()
+        last_error = None
+        for attempt in range(self.max_attempts):
+            key, wait = self._acquire(tried)
+            try:
+                if wait:
+                    await asyncio.sleep(wait)
+                with timed_stage("groq"):
+                    raw = await key.async_client.chat.completions.with_raw_response.create(**kwargs)
+                    completion = await raw.parse()
+                self._record_success(key, raw.headers, completion)
+                if kwargs.get("stream"):
+                    return self._acount_stream_usage(key, completion)
+                return completion
+            except RETRYABLE_GROQ_ERRORS as e:
+                last_error = e
+                self._record_failure(key, e)
+            finally:
+                self._release(key)
+            self._next_exclusions(tried, key)
+            await asyncio.sleep(self._backoff_seconds(attempt))
+        raise last_error
+
+    def stats(self):
+        with self._lock:
+            return [key.to_dict() for key in self.keys]
+
+
+groq_pool = GroqKeyPool(api_key_list, GROQ_MAX_ATTEMPTS, GROQ_BACKOFF_SECONDS)
@@ -0,0 +1,112 @@
+"""
+Production launcher settings for the chatbot service.
+
+    gunicorn -c gunicorn.conf.py asgi:app
+
+Runs the async ASGI app (asgi.py) on uvicorn workers. `python app.py` still
+starts the Flask development server for local testing.
+
+With WEB_CONCURRENCY > 1 the service runs in pre-fork mode:
+- the app is imported and the embedding model loaded once in the master
+  (when_ready), and the workers are forked from it, so they share the model weights copy-on-write;
+- torch, OpenMP/MKL and OpenCV are limited to THREADS_PER_WORKER threads in
+  each worker;
+- the master starts one Chroma server that owns chroma_db/chroma.sqlite3 and
+  all workers talk to it, so only one process ever writes the database;
+- one worker (elected with a file lock) runs the ingestion queue;
+- Prometheus metrics are written to PROMETHEUS_MULTIPROC_DIR so /metrics
+  reports the sum over all workers, whichever worker answers the scrape.
+"""
+import gc
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import urllib.request
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+# Model loading on boot can take a while on small instances
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 180))
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
+
+prefork = workers > 1
+threads_per_worker = int(os.environ.get("THREADS_PER_WORKER", max(1, (os.cpu_count() or 1) // max(workers, 1))))
+chroma_port = int(os.environ.get("CHROMA_SERVER_PORT", 8001))
+
+if prefork:
+    preload_app = True
+    os.environ["CHATBOT_PREFORK"] = "1"
+    # These are read when torch / numpy / OpenCV are first imported, which
+    # happens in the master while the app is preloaded, so set them here.
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ.setdefault(var, str(threads_per_worker))
+    os.environ.setdefault("CHROMA_SERVER_URL", f"http://127.0.0.1:{chroma_port}")
+    # Read by prometheus_client when it is first imported (while the app is preloaded).
+    # Samples left by a previous run would be added to this one's, so start empty.
+    metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR",
+                                        os.path.join(tempfile.gettempdir(), "chatbot_metrics"))
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def wait_for_chroma(url, deadline):
+    while time.time() < deadline:
+        for path in ("/api/v2/heartbeat", "/api/v1/heartbeat"):
+            try:
+                with urllib.request.urlopen(url + path, timeout=2) as response:
+                    if response.status == 200:
+                        return True
+            except Exception:
+                pass
+        time.sleep(0.5)
+    return False
+
+
+def on_starting(server):
+    """Master: start the single Chroma server before any worker exists."""
+    server.chroma_process = None
+    if not prefork or os.environ.get("CHROMA_SERVER_EXTERNAL") == "1":
+        return
+    db_path = os.environ.get("CHROMA_DB_PATH", "./chroma_db")
+    server.log.info(f"Starting Chroma server on port {chroma_port} for {db_path}")
+    server.chroma_process = subprocess.Popen(
+        ["chroma", "run", "--path", db_path, "--host", "127.0.0.1", "--port", str(chroma_port)]
+    )
+    if not wait_for_chroma(os.environ["CHROMA_SERVER_URL"], time.time() + 60):
+        server.log.error("Chroma server did not become ready within 60s")
+
+
+def when_ready(server):
+    """Master, after the app is preloaded and before workers are forked."""
+    if prefork:
+        from models import preload_models
+        preload_models()
+        # Move everything loaded so far out of the garbage collector's view, so
+        # collections in the workers don't write to (and un-share) those pages.
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    """Worker: limit threads, connect to Chroma and start background services."""
+    if prefork:
+        import app as chatbot
+        chatbot.start_services(threads_per_worker)
+
+
+def child_exit(server, worker):
+    """Master: drop the live-process gauges (in-flight requests, queue depths) of a worker that exited."""
+    if prefork:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    process = getattr(server, "chroma_process", None)
+    if process is not None:
+        process.terminate()
+        process.wait(timeout=10)
@@ -0,0 +1,339 @@
+"""
+Shadow search indexes: building, verifying, swapping, rolling back and dropping
+them (see reindex.py). Reading the alias lives in models.py.
+"""
+import os
+import random
+import time
+import json
+import numpy as np
+
+from config import (
+    EMBEDDING_BACKEND, INGEST_STORE_BATCH_SIZE, INGEST_EMBED_BATCH_SIZE, INGEST_NICE, REINDEX_THREADS,
+    REINDEX_DUTY_CYCLE, REINDEX_BATCH_CHUNKS, REINDEX_VERIFY_SAMPLE, REINDEX_VERIFY_TOP_K,
+    REINDEX_VERIFY_MIN_RECALL,
+)
+from state_db import lexical_index_status, get_state_db, get_cached_extraction
+from models import (
+    collection_handles, get_search_index, read_index_alias, components, get_embedding_model, get_collection,
+    active_index, index_write_lock, notify_collection_changed,
+)
+from ingestion import current_chunk_config, embed_chunks, chunk_text
+
+
+# --- 1. SEARCH INDEXES: SHADOW BUILDS AND SWAPS ---
+
+# An index is a Chroma collection plus the settings its chunks were made with
+# (see DEFAULT_INDEX). The alias (state_meta 'index_alias') names the live
+# index and the previous one, which is kept for rollback. ingested_documents
+# and the lexical index always describe the live index; a shadow index keeps
+# its own records in index_documents / index_lexical_chunks, and a swap
+# exchanges the two in one SQLite transaction.
+
+# Indexes in these states can be swapped in (the others are unbuilt or unverified)
+SWAPPABLE_INDEX_STATUSES = ("verified", "previous", "retired")
+
+def list_search_indexes():
+    """Every known index with its status and last verification report."""
+    alias = read_index_alias()
+    rows = get_state_db().execute(
+        "SELECT name, embedding_model, chunk_size, chunk_overlap, status, created_at, built_at, verification, error "
+        "FROM search_indexes ORDER BY created_at"
+    ).fetchall()
+    indexes = [dict(row, verification=json.loads(row["verification"] or "null")) for row in rows]
+    if not any(index["name"] == alias["active"]["name"] for index in indexes):
+        indexes.insert(0, dict(alias["active"], status="live"))
+    return {"active": alias["active"]["name"],
+            "previous": alias["previous"]["name"] if alias["previous"] else None,
+            "indexes": indexes}
+
+def create_search_index(name, embedding_model, chunk_size, chunk_overlap):
+    """Registers a new, empty shadow index; build_index fills it."""
+    if chunk_overlap >= chunk_size:
+        raise ValueError("chunk_overlap must be smaller than chunk_size.")
+    if get_search_index(name) is not None:
+        raise ValueError(f"Index '{name}' already exists.")
+    with get_state_db() as conn:
+        conn.execute(
+            "INSERT INTO search_indexes (name, embedding_model, chunk_size, chunk_overlap, status, created_at) "
+            "VALUES (?, ?, ?, ?, 'building', ?)",
+            (name, embedding_model, chunk_size, chunk_overlap, time.time()),
+        )
+    return get_search_index(name)
+
+def update_search_index(name, **fields):
+    assignments = ", ".join(f"{field} = ?" for field in fields)
+    with get_state_db() as conn:
+        conn.execute(f"UPDATE search_indexes SET {assignments} WHERE name = ?", [*fields.values(), name])
+
+def get_index_status(name):
+    row = get_state_db().execute("SELECT status FROM search_indexes WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+def run_in_background():
+    """Lowers this process (reindex.py) to INGEST_NICE with REINDEX_THREADS model threads."""
+    if INGEST_NICE > 0 and hasattr(os, "nice"):
+        os.nice(INGEST_NICE)
+    os.environ["OMP_NUM_THREADS"] = str(REINDEX_THREADS)  # read by the ONNX backend when it loads
+    if EMBEDDING_BACKEND == "torch":
+        import torch
+        torch.set_num_threads(REINDEX_THREADS)
+
+def stale_index_documents(index):
+    """Live documents that `index` doesn't hold, or holds an older version or scope of."""
+    rows = get_state_db().execute(
+        "SELECT d.source_id, d.content_sha256, d.file_type, d.scope FROM ingested_documents d "
+        "LEFT JOIN index_documents i ON i.collection = ? AND i.source_id = d.source_id "
+        "WHERE i.source_id IS NULL OR i.content_sha256 != d.content_sha256 OR i.scope != d.scope",
+        (index["name"],),
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+def store_index_batch(index, batch):
+    """Embeds and upserts a batch of re-chunked documents into the shadow `index` and records them."""
+    collection = get_collection(index["name"])
+    texts = [chunk for doc in batch for chunk in doc["text_chunks"]]
+    embeddings, _ = embed_chunks(texts, model_name=index["embedding_model"])
+    ids = [chunk_id for doc in batch for chunk_id in doc["ids"]]
+    metadatas = [metadata for doc in batch for metadata in doc["metadatas"]]
+    for start in range(0, len(ids), INGEST_STORE_BATCH_SIZE):
+        end = start + INGEST_STORE_BATCH_SIZE
+        collection.upsert(embeddings=embeddings[start:end], documents=texts[start:end],
+                          metadatas=metadatas[start:end], ids=ids[start:end])
+
+    conn = get_state_db()
+    for doc in batch:
+        row = conn.execute("SELECT chunk_ids FROM index_documents WHERE collection = ? AND source_id = ?",
+                           (index["name"], doc["source_id"])).fetchone()
+        orphan_ids = sorted(set(json.loads(row[0])) - set(doc["ids"])) if row else []
+        if orphan_ids:
+            collection.delete(ids=orphan_ids)
+    with conn:
+        for doc in batch:
+            conn.execute(
+                "INSERT OR REPLACE INTO index_documents "
+                "(collection, source_id, content_sha256, file_type, chunk_config, chunk_ids, updated_at, scope) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (index["name"], doc["source_id"], doc["content_sha256"], doc["file_type"],
+                 current_chunk_config(index), json.dumps(doc["ids"]), time.time(), doc["scope"]),
+            )
+            conn.execute("DELETE FROM index_lexical_chunks WHERE collection = ? AND source_id = ?",
+                         (index["name"], doc["source_id"]))
+            conn.executemany(
+                "INSERT INTO index_lexical_chunks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(index["name"], chunk_id, doc["source_id"], metadata.get("courseId", ""),
+                  metadata.get("materialId", ""), json.dumps(metadata), text)
+                 for chunk_id, text, metadata in zip(doc["ids"], doc["text_chunks"], doc["metadatas"])],
+            )
+
+def build_index_documents(index, documents):
+    """
+    Re-chunks and re-embeds `documents` (rows of ingested_documents) from their
+    stored text into `index`, REINDEX_BATCH_CHUNKS chunks at a time, sleeping
+    between batches to keep to REINDEX_DUTY_CYCLE.
+    Returns the source IDs whose text is no longer stored.
+    """
+    missing = []
+    batch = []
+    done = 0
+
+    def flush():
+        started = time.monotonic()
+        store_index_batch(index, batch)
+        batch.clear()
+        time.sleep((time.monotonic() - started) * (1 - REINDEX_DUTY_CYCLE) / REINDEX_DUTY_CYCLE)
+
+    for document in documents:
+        full_text = get_cached_extraction(document["content_sha256"])
+        if not full_text:
+            missing.append(document["source_id"])
+            continue
+        text_chunks, ids, metadatas = chunk_text(document["source_id"], document["file_type"],
+                                                 json.loads(document["scope"]), full_text, index)
+        batch.append(dict(document, text_chunks=text_chunks, ids=ids, metadatas=metadatas))
+        if sum(len(doc["ids"]) for doc in batch) >= REINDEX_BATCH_CHUNKS:
+            flush()
+        done += 1
+        if done % 50 == 0:
+            print(f"[Reindex] {index['name']}: {done}/{len(documents)} document(s) re-chunked.")
+    if batch:
+        flush()
+    return missing
+
+def build_index(index):
+    """
+    Fills the shadow `index` from the stored text of every live document, then
+    catches up with documents ingested while it was building, and verifies it.
+    Live queries keep using the live index throughout. Returns the verification report.
+    """
+    update_search_index(index["name"], status="building", error=None)
+    print(f"[Reindex] Building '{index['name']}' ({current_chunk_config(index)})...")
+    try:
+        skipped = set()
+        while True:
+            documents = [d for d in stale_index_documents(index) if d["source_id"] not in skipped]
+            if not documents:
+                break
+            print(f"[Reindex] {len(documents)} document(s) to add to '{index['name']}'.")
+            skipped.update(build_index_documents(index, documents))
+    except Exception as e:
+        update_search_index(index["name"], status="failed", error=str(e))
+        raise
+    if skipped:
+        print(f"[Reindex] WARNING: no stored text for {len(skipped)} document(s); re-ingest them: {sorted(skipped)}")
+    update_search_index(index["name"], status="built", built_at=time.time())
+    return verify_index(index)
+
+def verify_index(index, sample_size=REINDEX_VERIFY_SAMPLE):
+    """
+    Checks a built index before it may be swapped in: it holds the current
+    version of every live document, its collection holds exactly the recorded
+    chunks, and sampled chunks retrieve themselves in the top REINDEX_VERIFY_TOP_K.
+    Saves the report on the index and marks it verified when it passed.
+    """
+    conn = get_state_db()
+    stale = stale_index_documents(index)
+    recorded = sum(len(json.loads(row[0])) for row in conn.execute(
+        "SELECT chunk_ids FROM index_documents WHERE collection = ?", (index["name"],)))
+    collection = get_collection(index["name"])
+    stored = collection.count()
+    live_recorded = sum(len(json.loads(row[0])) for row in conn.execute("SELECT chunk_ids FROM ingested_documents"))
+    report = {
+        "stale_documents": len(stale),
+        "recorded_chunks": recorded,
+        "stored_chunks": stored,
+        # Chunks in the live index that no ingested document owns (stored before
+        # the ingestion cache existed); they are not carried over
+        "unowned_live_chunks": max(0, get_collection(active_index()["name"]).count() - live_recorded),
+        "checked_at": time.time(),
+    }
+    offset = random.randint(0, max(0, stored - sample_size))
+    page = collection.get(limit=sample_size, offset=offset, include=["documents"])
+    if page["ids"]:
+        vectors = get_embedding_model(index["embedding_model"]).encode(page["documents"],
+                                                                        batch_size=INGEST_EMBED_BATCH_SIZE)
+        results = collection.query(query_embeddings=np.asarray(vectors, dtype=np.float32).tolist(),
+                                   n_results=REINDEX_VERIFY_TOP_K, include=["documents"])
+        # Identical chunk texts are interchangeable, so finding the same text counts
+        found = sum(chunk_id in ids or text in texts for chunk_id, text, ids, texts
+                    in zip(page["ids"], page["documents"], results["ids"], results["documents"]))
+        report["self_recall"] = round(found / len(page["ids"]), 3)
+    else:
+        report["self_recall"] = None
+    report["passed"] = (not stale and stored == recorded
+                        and (report["self_recall"] is None or report["self_recall"] >= REINDEX_VERIFY_MIN_RECALL))
+    status = get_index_status(index["name"])
+    if status in ("built", "verified"):
+        status = "verified" if report["passed"] else "built"
+    update_search_index(index["name"], status=status, verification=json.dumps(report))
+    print(f"[Reindex] Verification of '{index['name']}' {'passed' if report['passed'] else 'FAILED'}: {report}")
+    return report
+
+def stash_live_index(conn, name):
+    """Copies the live document records and lexical entries aside under index `name`."""
+    conn.execute("DELETE FROM index_documents WHERE collection = ?", (name,))
+    conn.execute(
+        "INSERT INTO index_documents "
+        "(collection, source_id, content_sha256, file_type, chunk_config, chunk_ids, updated_at, scope) "
+        "SELECT ?, source_id, content_sha256, file_type, chunk_config, chunk_ids, updated_at, scope "
+        "FROM ingested_documents", (name,))
+    conn.execute("DELETE FROM index_lexical_chunks WHERE collection = ?", (name,))
+    if lexical_index_status["available"]:
+        conn.execute(
+            "INSERT INTO index_lexical_chunks "
+            "SELECT ?, c.chunk_id, c.source_id, c.course_id, c.material_id, c.metadata, i.text "
+            "FROM lexical_chunks c JOIN lexical_index i ON i.rowid = c.rowid", (name,))
+
+def load_live_index(conn, name):
+    """Replaces the live document records and lexical entries with those stashed under index `name`."""
+    conn.execute("DELETE FROM ingested_documents")
+    conn.execute(
+        "INSERT INTO ingested_documents "
+        "(source_id, content_sha256, file_type, chunk_config, chunk_ids, updated_at, scope) "
+        "SELECT source_id, content_sha256, file_type, chunk_config, chunk_ids, updated_at, scope "
+        "FROM index_documents WHERE collection = ?", (name,))
+    if lexical_index_status["available"]:
+        conn.execute("DELETE FROM lexical_index")
+        conn.execute("DELETE FROM lexical_chunks")
+        conn.execute(
+            "INSERT INTO lexical_chunks (chunk_id, source_id, course_id, material_id, metadata) "
+            "SELECT chunk_id, source_id, course_id, material_id, metadata "
+            "FROM index_lexical_chunks WHERE collection = ?", (name,))
+        conn.execute(
+            "INSERT INTO lexical_index (rowid, text) SELECT c.rowid, s.text FROM lexical_chunks c "
+            "JOIN index_lexical_chunks s ON s.collection = ? AND s.chunk_id = c.chunk_id", (name,))
+    conn.execute("DELETE FROM index_documents WHERE collection = ?", (name,))
+    conn.execute("DELETE FROM index_lexical_chunks WHERE collection = ?", (name,))
+
+def swap_index(name, force=False):
+    """
+    Makes index `name` live. Documents ingested since it was built are added to
+    it first (ingestion waits meanwhile); then one transaction stashes the live
+    index's records, puts the new index's in their place and moves the alias,
+    keeping the old index as the rollback target. Every process follows within
+    COLLECTION_VERSION_CHECK_INTERVAL. `force` skips the verification check.
+    """
+    with index_write_lock():
+        alias = read_index_alias()
+        current, target = alias["active"], get_search_index(name)
+        if target is None:
+            raise ValueError(f"Unknown index '{name}'.")
+        if target["name"] == current["name"]:
+            raise ValueError(f"'{name}' is already the live index.")
+        status = get_index_status(name)
+        if status not in SWAPPABLE_INDEX_STATUSES and not force:
+            raise ValueError(f"Index '{name}' is {status or 'unbuilt'}; verify it first (or force the swap).")
+        missing = build_index_documents(target, stale_index_documents(target))
+        if missing and not force:
+            raise ValueError(f"No stored text for {len(missing)} live document(s) {sorted(missing)}; "
+                             f"re-ingest them first (or force the swap).")
+
+        conn = get_state_db()
+        with conn:
+            stash_live_index(conn, current["name"])
+            load_live_index(conn, target["name"])
+            conn.execute(
+                "INSERT OR IGNORE INTO search_indexes (name, embedding_model, chunk_size, chunk_overlap, status, created_at) "
+                "VALUES (?, ?, ?, ?, 'live', ?)",
+                (current["name"], current["embedding_model"], current["chunk_size"], current["chunk_overlap"],
+                 time.time()),
+            )
+            conn.execute("UPDATE search_indexes SET status = 'retired' WHERE status = 'previous'")
+            conn.execute("UPDATE search_indexes SET status = 'previous' WHERE name = ?", (current["name"],))
+            conn.execute("UPDATE search_indexes SET status = 'live' WHERE name = ?", (target["name"],))
+            # Cached answers name chunks and hold question vectors of the old index
+            conn.execute("DELETE FROM answer_cache")
+            conn.execute("INSERT OR REPLACE INTO state_meta VALUES ('index_alias', ?)",
+                         (json.dumps({"active": target["name"], "previous": current["name"]}),))
+        notify_collection_changed([])
+    print(f"[Index] Swapped the live index from '{current['name']}' to '{target['name']}'.")
+    return {"active": target["name"], "previous": current["name"]}
+
+def rollback_index():
+    """Swaps back to the previous index (documents ingested since the swap are added to it first)."""
+    previous = read_index_alias()["previous"]
+    if previous is None:
+        raise ValueError("There is no previous index to roll back to.")
+    return swap_index(previous["name"])
+
+def drop_index(name):
+    """Deletes an index that isn't live: its collection and its stashed records. Dropping the previous index ends rollback."""
+    with index_write_lock():
+        alias = read_index_alias()
+        if name == alias["active"]["name"]:
+            raise ValueError(f"'{name}' is the live index.")
+        if get_search_index(name) is None:
+            raise ValueError(f"Unknown index '{name}'.")
+        try:
+            components["chroma"].get().delete_collection(name=name)
+        except Exception as e:  # never created, or already deleted
+            print(f"[Index] Collection '{name}' not deleted: {e}")
+        collection_handles.pop(name, None)
+        with get_state_db() as conn:
+            conn.execute("DELETE FROM search_indexes WHERE name = ?", (name,))
+            conn.execute("DELETE FROM index_documents WHERE collection = ?", (name,))
+            conn.execute("DELETE FROM index_lexical_chunks WHERE collection = ?", (name,))
+            if alias["previous"] and alias["previous"]["name"] == name:
+                conn.execute("INSERT OR REPLACE INTO state_meta VALUES ('index_alias', ?)",
+                             (json.dumps({"active": alias["active"]["name"], "previous": None}),))
+    print(f"[Index] Dropped index '{name}'.")
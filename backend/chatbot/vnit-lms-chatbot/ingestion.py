@@ -0,0 +1,1318 @@
+"""
+Document ingestion: download, text extraction (with OCR), chunking, embedding
+and storage, run by a staged pipeline on the process that owns ingestion.
+"""
+import os
+import random
+import threading
+import queue
+import time
+import uuid
+import tempfile
+import hashlib
+import re
+import bisect
+import json
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import requests
+from requests.adapters import HTTPAdapter
+import fitz  # PyMuPDF
+import zipfile
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pptx import Presentation
+from PIL import Image
+import numpy as np
+import cv2
+import ocr_worker
+
+from config import (
+    EMBEDDING_BACKEND, EMBEDDING_PARITY_SAMPLE, EMBEDDING_PARITY_MIN_COSINE, INGEST_WORKERS,
+    INGEST_DOWNLOAD_WORKERS, INGEST_STORE_BATCH_CHUNKS, INGEST_STORE_BATCH_SIZE, INGEST_QUEUE_SIZE,
+    INGEST_JOB_RETENTION, INGEST_STAGES, INGEST_PRIORITIES, INGEST_EMBED_BATCH_SIZE, INGEST_POLL_INTERVAL,
+    INGEST_MAX_RESUMES, PAGE_CHECKPOINT_TTL, DOWNLOAD_DIR, DRIVE_DOWNLOAD_URL, MAX_DOWNLOAD_MB,
+    DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT, DOWNLOAD_CHUNK_SIZE, INGEST_NICE, HYBRID_SEARCH_ENABLED,
+    OCR_ENABLED, INGEST_LOCK_PATH, OCR_WORKERS, OCR_THREADS_PER_WORKER, OCR_ZOOM,
+)
+from telemetry import (
+    STAGE_LATENCY, CACHE_LOOKUPS, QUEUE_DEPTH, INGEST_JOBS, OCR_PAGES, OCR_SECONDS, request_id_var, log_event,
+)
+from state_db import (
+    lexical_index_status, get_state_db, chunk_hash, get_cached_extraction, has_cached_extraction,
+    save_extraction, get_page_checkpoints, save_page_checkpoint, get_cached_embeddings, save_embeddings,
+    get_ingested_document, save_ingested_document, index_chunks,
+)
+from models import (
+    serving_index, serving_cache_key, get_embedding_model, get_collection, get_ocr_reader, active_index,
+    index_write_lock, notify_collection_changed,
+)
+from retrieval import SCOPE_FIELDS, UNSCOPED
+from admission import yield_to_interactive, lower_thread_priority
+
+
+# --- 1. INGESTION CACHE AND EMBEDDINGS ---
+
+# Shared HTTP session so downloads reuse pooled connections to Google Drive
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=max(INGEST_DOWNLOAD_WORKERS, 4)))
+
+def current_chunk_config(index=None):
+    """Settings that change the stored chunks of `index` (default: the live one); a document is re-chunked if they differ."""
+    # The backend is left out on purpose: ONNX vectors are checked for parity with
+    # the stored torch vectors (see check_embedding_parity) instead of forcing a re-ingest
+    index = index or active_index()
+    return f"{index['embedding_model']}|{index['chunk_size']}|{index['chunk_overlap']}"
+
+def find_legacy_chunk_ids(file_id, file_type, start, collection_name=None):
+    """
+    Finds positional chunk IDs (drive_<id>_<type>_chunk_<i>, i >= start) stored
+    before the ingestion cache existed, so they can be cleaned up.
+    """
+    found = []
+    batch_size = 100
+    while True:
+        candidates = [f"drive_{file_id}_{file_type}_chunk_{i}" for i in range(start, start + batch_size)]
+        existing = get_collection(collection_name).get(ids=candidates, include=[])["ids"]
+        found.extend(existing)
+        if len(existing) < batch_size:
+            return found
+        start += batch_size
+
+# Legacy chunk IDs: drive_<file id>_<file type>_chunk_<i>
+CHUNK_ID_PATTERN = re.compile(r"^drive_(.+)_[a-z]+_chunk_\d+$")
+
+def backfill_lexical_index():
+    """
+    Indexes chunks that were stored in Chroma before the lexical index existed.
+    Runs once on the ingestion owner; later ingestions keep the index up to date.
+    """
+    conn = get_state_db()
+    if not lexical_index_status["available"]:
+        return
+    if conn.execute("SELECT 1 FROM state_meta WHERE key = 'lexical_index_backfilled'").fetchone():
+        return
+    by_source = {}
+    offset = 0
+    page_size = 1000
+    while True:
+        page = get_collection().get(limit=page_size, offset=offset, include=["documents", "metadatas"])
+        for chunk_id, text, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+            metadata = metadata or {}
+            match = CHUNK_ID_PATTERN.match(chunk_id)
+            source_id = metadata.get("sourceId") or (match.group(1) if match else chunk_id)
+            by_source.setdefault(source_id, []).append((chunk_id, text, metadata))
+        if len(page["ids"]) < page_size:
+            break
+        offset += page_size
+    for source_id, chunks in by_source.items():
+        index_chunks(source_id, *zip(*chunks))
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO state_meta VALUES ('lexical_index_backfilled', ?)", (str(time.time()),))
+    if by_source:
+        log_event("lexical_backfill", chunks=sum(len(c) for c in by_source.values()), sources=len(by_source))
+        notify_collection_changed([])
+
+def backfill_scope_markers():
+    """
+    Stores UNSCOPED for the course/material fields of chunks ingested before
+    scoping existed, so scoped searches still find them (Chroma can't filter on a
+    missing field). Runs once on the ingestion owner.
+    """
+    conn = get_state_db()
+    if conn.execute("SELECT 1 FROM state_meta WHERE key = 'scope_markers_backfilled'").fetchone():
+        return
+    collection = get_collection()
+    updated = []
+    offset = 0
+    page_size = 1000
+    while True:
+        page = collection.get(limit=page_size, offset=offset, include=["metadatas"])
+        ids, metadatas = [], []
+        for chunk_id, metadata in zip(page["ids"], page["metadatas"]):
+            metadata = metadata or {}
+            if all(field in metadata for field in SCOPE_FIELDS):
+                continue
+            ids.append(chunk_id)
+            metadatas.append({**dict.fromkeys(SCOPE_FIELDS, UNSCOPED), **metadata})
+        if ids:
+            collection.update(ids=ids, metadatas=metadatas)
+            updated.extend(ids)
+        if len(page["ids"]) < page_size:
+            break
+        offset += page_size
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO state_meta VALUES ('scope_markers_backfilled', ?)", (str(time.time()),))
+    if updated:
+        log_event("scope_backfill", chunks=len(updated))
+        notify_collection_changed(updated)
+
+def embed_chunks(text_chunks, job=None, model_name=None):
+    """
+    Embeds chunks with `model_name` (default: the serving index's model),
+    reusing cached vectors for chunk texts that were embedded before.
+    Returns (embeddings, number_of_chunks_actually_encoded).
+    """
+    model_name = model_name or serving_index()["embedding_model"]
+    hashes = [chunk_hash(chunk) for chunk in text_chunks]
+    cached = get_cached_embeddings(hashes, model_name)
+    missing = [i for i, h in enumerate(hashes) if h not in cached]
+    CACHE_LOOKUPS.labels("chunk_embeddings", "hit").inc(len(hashes) - len(missing))
+    CACHE_LOOKUPS.labels("chunk_embeddings", "miss").inc(len(missing))
+
+    for start in range(0, len(missing), INGEST_EMBED_BATCH_SIZE):
+        yield_to_interactive()
+        batch_indexes = missing[start:start + INGEST_EMBED_BATCH_SIZE]
+        vectors = get_embedding_model(model_name).encode([text_chunks[i] for i in batch_indexes],
+                                                         batch_size=INGEST_EMBED_BATCH_SIZE).tolist()
+        batch_hashes = [hashes[i] for i in batch_indexes]
+        save_embeddings(batch_hashes, vectors, model_name)
+        cached.update(zip(batch_hashes, vectors))
+        if job:
+            job.set_progress(start + len(batch_indexes), len(missing))
+
+    return [cached[h] for h in hashes], len(missing)
+
+def get_embedding_parity():
+    row = get_state_db().execute("SELECT value FROM state_meta WHERE key = 'embedding_parity'").fetchone()
+    return json.loads(row[0]) if row else None
+
+def check_embedding_parity(sample_size=EMBEDDING_PARITY_SAMPLE):
+    """
+    Re-encodes a sample of stored chunks with the configured backend and
+    compares the result with the vectors already in the collection.
+    Saves and returns a report; "passed" is False when the mean cosine
+    similarity is below EMBEDDING_PARITY_MIN_COSINE.
+    """
+    collection = get_collection()
+    total = collection.count()
+    offset = random.randint(0, max(0, total - sample_size))
+    page = collection.get(limit=sample_size, offset=offset, include=["documents", "embeddings"])
+    report = {"backend": serving_cache_key(), "sample": len(page["ids"]), "checked_at": time.time()}
+    if page["ids"]:
+        stored = np.asarray(page["embeddings"], dtype=np.float32)
+        fresh = np.asarray(get_embedding_model().encode(page["documents"], batch_size=INGEST_EMBED_BATCH_SIZE),
+                           dtype=np.float32)
+        stored /= np.clip(np.linalg.norm(stored, axis=1, keepdims=True), 1e-12, None)
+        fresh /= np.clip(np.linalg.norm(fresh, axis=1, keepdims=True), 1e-12, None)
+        cosines = (stored * fresh).sum(axis=1)
+        report.update({
+            "mean_cosine": round(float(cosines.mean()), 5),
+            "min_cosine": round(float(cosines.min()), 5),
+            "passed": bool(cosines.mean() >= EMBEDDING_PARITY_MIN_COSINE),
+        })
+    else:
+        report["passed"] = True  # nothing stored yet, nothing to drift from
+    with get_state_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO state_meta VALUES ('embedding_parity', ?)", (json.dumps(report),))
+    log_event("embedding_parity", **report)
+    if not report["passed"]:
+        print(f"[Embeddings] WARNING: {EMBEDDING_BACKEND} backend drifts from the stored vectors. "
+              f"Re-ingest the documents or set EMBEDDING_BACKEND=torch.")
+    return report
+
+def check_embedding_parity_once():
+    """Runs the parity check the first time this backend is used against the collection."""
+    if EMBEDDING_BACKEND == "torch":
+        return
+    previous = get_embedding_parity()
+    if previous and previous.get("backend") == serving_cache_key():
+        return
+    try:
+        check_embedding_parity()
+    except Exception as e:
+        log_event("error", where="embedding_parity", error=str(e))
+
+
+# --- 2. INGESTION HELPER FUNCTIONS ---
+
+def get_google_drive_file_id(url):
+    """Extracts the file ID from various Google Drive share link formats."""
+    try:
+        # Format: /file/d/FILE_ID/view
+        if '/d/' in url:
+            return url.split('/d/')[1].split('/')[0]
+        # Format: ?id=FILE_ID
+        if 'id=' in url:
+            return url.split('id=')[1].split('&')[0]
+        print(f"Could not parse File ID from URL: {url}")
+        return None
+    except Exception as e:
+        print(f"Error parsing Google Drive URL: {e}")
+        return None
+
+class DownloadError(Exception):
+    """Raised when a Drive file cannot be downloaded (bad status, empty, or too large)."""
+
+
+def download_drive_file(file_id, job=None):
+    """
+    Streams a Google Drive file to a temporary file on disk.
+    Enforces MAX_DOWNLOAD_MB and the connect/read timeouts.
+    Returns (path, content_type, size_in_bytes, sha256_hex). The caller must delete the file.
+    """
+    download_url = DRIVE_DOWNLOAD_URL.format(file_id=file_id)
+    max_bytes = MAX_DOWNLOAD_MB * 1024 * 1024
+    timeout = (DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)
+
+    response = http_session.get(download_url, stream=True, timeout=timeout)
+
+    # Handle Google's large file confirmation redirect
+    if "confirm=t" in response.url:
+        print("[Background Ingest] Large file. Following confirmation redirect...")
+        response.close()
+        response = http_session.get(download_url, cookies=response.cookies, stream=True, timeout=timeout)
+
+    with response:
+        # Check if the download failed
+        if response.status_code != 200:
+            print("Please ensure the link is public ('Anyone with the link').")
+            raise DownloadError(f"Failed to download file. Status: {response.status_code}")
+
+        expected_size = int(response.headers.get('content-length') or 0)
+        if expected_size > max_bytes:
+            raise DownloadError(f"File is {expected_size} bytes, larger than the {MAX_DOWNLOAD_MB} MB limit.")
+
+        content_type = response.headers.get('content-type', '')
+        size = 0
+        digest = hashlib.sha256()
+        tmp = tempfile.NamedTemporaryFile(dir=DOWNLOAD_DIR, prefix="ingest_", delete=False)
+        try:
+            with tmp:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise DownloadError(f"File exceeds the {MAX_DOWNLOAD_MB} MB limit.")
+                    tmp.write(chunk)
+                    digest.update(chunk)
+                    if job and expected_size:
+                        job.set_progress(size, expected_size)
+            # Check if we actually got a file
+            if size == 0:
+                raise DownloadError("Downloaded file is empty.")
+        except BaseException:
+            os.remove(tmp.name)
+            raise
+
+    return tmp.name, content_type, size, digest.hexdigest()
+
+
+def save_upload(upload):
+    """
+    Streams a file uploaded to the bulk endpoint (a werkzeug FileStorage) into
+    DOWNLOAD_DIR, enforcing MAX_DOWNLOAD_MB. Returns its path; the ingestion
+    pipeline deletes it once the text is extracted.
+    """
+    max_bytes = MAX_DOWNLOAD_MB * 1024 * 1024
+    size = 0
+    tmp = tempfile.NamedTemporaryFile(dir=DOWNLOAD_DIR, prefix="upload_", delete=False)
+    try:
+        with tmp:
+            while True:
+                block = upload.stream.read(DOWNLOAD_CHUNK_SIZE)
+                if not block:
+                    break
+                size += len(block)
+                if size > max_bytes:
+                    raise DownloadError(f"'{upload.filename}' exceeds the {MAX_DOWNLOAD_MB} MB limit.")
+                tmp.write(block)
+        if size == 0:
+            raise DownloadError(f"'{upload.filename}' is empty.")
+    except BaseException:
+        os.remove(tmp.name)
+        raise
+    return tmp.name
+
+
+def detect_file_type(path, content_type=None, filename=None):
+    """
+    Detects file type from the file on disk, content-type header, or filename.
+    Returns: 'pdf', 'ppt', 'pptx', 'image', or None
+    """
+    # Check content-type header first
+    if content_type:
+        if 'pdf' in content_type.lower():
+            return 'pdf'
+        if 'presentation' in content_type.lower() or 'powerpoint' in content_type.lower():
+            return 'pptx'
+        if 'image' in content_type.lower():
+            return 'image'
+    
+    # Check filename extension
+    if filename:
+        ext = filename.lower().split('.')[-1] if '.' in filename else ''
+        if ext in ['pdf']:
+            return 'pdf'
+        if ext in ['ppt', 'pptx']:
+            return 'pptx'
+        if ext in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'webp']:
+            return 'image'
+    
+    # Check magic bytes (file signatures)
+    if path:
+        with open(path, 'rb') as f:
+            header = f.read(8)
+        # PDF: starts with %PDF
+        if header[:4] == b'%PDF':
+            return 'pdf'
+        # PPTX: ZIP archive with specific structure (starts with PK)
+        if header[:2] == b'PK':
+            # Check if it's a PPTX by looking for specific files inside.
+            # ZipFile only reads the central directory, not the whole archive.
+            try:
+                with zipfile.ZipFile(path) as zip_file:
+                    if 'ppt/presentation.xml' in zip_file.namelist():
+                        return 'pptx'
+            except:
+                pass
+        # Images: Check common image signatures
+        if header[:2] == b'\xff\xd8':  # JPEG
+            return 'image'
+        if header[:8] == b'\x89PNG\r\n\x1a\n':  # PNG
+            return 'image'
+        if header[:6] in [b'GIF87a', b'GIF89a']:  # GIF
+            return 'image'
+        if header[:2] == b'BM':  # BMP
+            return 'image'
+    
+    return None
+
+# Process pool for OCR of scanned PDF pages, created on first use
+ocr_pool = None
+ocr_pool_lock = threading.Lock()
+
+def get_ocr_pool():
+    global ocr_pool
+    with ocr_pool_lock:
+        if ocr_pool is None:
+            log_event("ocr_pool_start", workers=OCR_WORKERS, threads_per_worker=OCR_THREADS_PER_WORKER)
+            ocr_pool = ProcessPoolExecutor(
+                max_workers=OCR_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=ocr_worker.init_worker,
+                initargs=(OCR_THREADS_PER_WORKER, INGEST_NICE),
+            )
+        return ocr_pool
+
+def reset_ocr_pool():
+    """Drops a broken pool (e.g. a worker was OOM-killed) so the next job starts a fresh one."""
+    global ocr_pool
+    with ocr_pool_lock:
+        if ocr_pool is not None:
+            ocr_pool.shutdown(wait=False, cancel_futures=True)
+            ocr_pool = None
+
+def ocr_pdf_pages(path, page_numbers, job=None, checkpoint_key=None):
+    """
+    OCRs the given 0-based pages of the PDF at `path`.
+    Pages are spread over the OCR process pool. Returns {page_number: text}.
+    With a `checkpoint_key` (the file's content hash) every page is saved as
+    soon as it is read, so an interrupted extraction doesn't OCR it again.
+    """
+    results = {}
+    if not OCR_ENABLED:
+        log_event("ocr_skipped", pages=len(page_numbers), reason="disabled")
+        return results
+    started = time.perf_counter()
+    try:
+        if OCR_WORKERS <= 0:
+            with fitz.open(path, filetype="pdf") as doc:
+                for done, page_num in enumerate(page_numbers, start=1):
+                    yield_to_interactive()
+                    try:
+                        img_array = ocr_worker.render_page(doc[page_num], OCR_ZOOM)
+                        results[page_num] = ocr_worker.read_text(get_ocr_reader(), img_array)
+                        if checkpoint_key:
+                            save_page_checkpoint(checkpoint_key, page_num, results[page_num])
+                    except Exception as ocr_error:
+                        log_event("ocr_page_failed", page=page_num + 1, error=str(ocr_error))
+                    if job:
+                        job.set_progress(done, len(page_numbers))
+            return results
+
+        pool = get_ocr_pool()
+        futures = {pool.submit(ocr_worker.ocr_pdf_page, path, page_num, OCR_ZOOM): page_num
+                   for page_num in page_numbers}
+        for done, future in enumerate(as_completed(futures), start=1):
+            page_num = futures[future]
+            try:
+                results[page_num] = future.result()
+                if checkpoint_key:
+                    save_page_checkpoint(checkpoint_key, page_num, results[page_num])
+            except BrokenProcessPool:
+                reset_ocr_pool()
+                raise
+            except Exception as ocr_error:
+                log_event("ocr_page_failed", page=page_num + 1, error=str(ocr_error))
+            if job:
+                job.set_progress(done, len(page_numbers))
+        return results
+    finally:
+        record_ocr(len(results), len(page_numbers) - len(results), time.perf_counter() - started)
+
+def record_ocr(pages, failed, seconds):
+    """Counts one OCR pass in the metrics and logs its throughput."""
+    OCR_PAGES.labels("ok").inc(pages)
+    OCR_PAGES.labels("failed").inc(failed)
+    OCR_SECONDS.inc(seconds)
+    log_event("ocr", pages=pages, failed=failed, seconds=round(seconds, 3),
+              pages_per_second=round(pages / seconds, 2) if seconds else None)
+
+def extract_pdf_pages(path, job=None, content_sha256=None):
+    """
+    Extracts text from each page of the PDF at `path`.
+    Pages with a text layer are read directly; the rest are OCR'd in parallel,
+    checkpointed under `content_sha256` (pages already checkpointed are reused).
+    Returns a list of (page_number, text, used_ocr) in page order, 1-based.
+    """
+    pages = []
+    ocr_page_numbers = []
+    # Opening by path lets PyMuPDF read pages from disk instead of a copy in memory
+    with fitz.open(path, filetype="pdf") as doc:
+        for page_num, page in enumerate(doc):
+            # Try direct text extraction first
+            page_text = page.get_text()
+            if page_text.strip():
+                pages.append((page_num + 1, page_text, False))
+            else:
+                # If no text, it's likely a scanned/image-based PDF - use OCR
+                pages.append((page_num + 1, "", True))
+                ocr_page_numbers.append(page_num)
+
+    if ocr_page_numbers:
+        log_event("ocr_needed", pages=len(ocr_page_numbers), total_pages=len(pages))
+        checkpoints = get_page_checkpoints(content_sha256) if content_sha256 else {}
+        ocr_texts = {page_num: checkpoints[page_num] for page_num in ocr_page_numbers if page_num in checkpoints}
+        remaining = [page_num for page_num in ocr_page_numbers if page_num not in checkpoints]
+        if ocr_texts:
+            log_event("ocr_resume", checkpointed_pages=len(ocr_texts))
+        if remaining:
+            ocr_texts.update(ocr_pdf_pages(path, remaining, job, content_sha256))
+        for page_num, page_text in ocr_texts.items():
+            pages[page_num] = (page_num + 1, page_text, True)
+
+    return [page for page in pages if page[1].strip()]
+
+def extract_text_from_pdf(path, job=None, content_sha256=None):
+    """Extracts text from the PDF at `path`. Uses OCR if text extraction fails."""
+    try:
+        pages = extract_pdf_pages(path, job, content_sha256)
+    except Exception as e:
+        print(f"[PDF] Error extracting text from PDF: {e}")
+        return None
+    parts = []
+    for page_number, page_text, used_ocr in pages:
+        label = f"Page {page_number} (OCR)" if used_ocr else f"Page {page_number}"
+        parts.append(f"\n--- {label} ---\n" + page_text)
+    return "".join(parts).strip()
+
+def extract_text_from_ppt(path):
+    """Extracts text from the PowerPoint presentation at `path`."""
+    full_text = ""
+    try:
+        prs = Presentation(path)
+        for slide_num, slide in enumerate(prs.slides):
+            slide_text = f"\n--- Slide {slide_num + 1} ---\n"
+            # Extract text from all shapes in the slide
+            for shape in slide.shapes:
+                if hasattr(shape, "text") and shape.text:
+                    slide_text += shape.text + "\n"
+                # Also check for text in tables
+                if hasattr(shape, "table"):
+                    for row in shape.table.rows:
+                        for cell in row.cells:
+                            if cell.text:
+                                slide_text += cell.text + " "
+                    slide_text += "\n"
+            full_text += slide_text
+    except Exception as e:
+        print(f"[PPT] Error extracting text from PPT: {e}")
+        return None
+    return full_text.strip()
+
+def extract_text_from_image(path):
+    """Extracts text from the image at `path` using OCR (supports handwritten notes)."""
+    try:
+        # Load image
+        img = Image.open(path)
+        img_array = np.array(img)
+        
+        # Convert to RGB if needed (EasyOCR expects RGB)
+        if len(img_array.shape) == 2:  # Grayscale
+            img_array = cv2.cvtColor(img_array, cv2.COLOR_GRAY2RGB)
+        elif img_array.shape[2] == 4:  # RGBA
+            img_array = cv2.cvtColor(img_array, cv2.COLOR_RGBA2RGB)
+        
+        # Perform OCR
+        print("[Image] Performing OCR...")
+        reader = get_ocr_reader()
+        started = time.perf_counter()
+        ocr_results = reader.readtext(img_array)
+        record_ocr(1, 0, time.perf_counter() - started)
+        
+        # Combine all detected text
+        full_text = "\n".join([result[1] for result in ocr_results])
+        
+        if not full_text.strip():
+            print("[Image] No text detected in image.")
+            return None
+        
+        return full_text.strip()
+    except Exception as e:
+        print(f"[Image] Error extracting text from image: {e}")
+        return None
+
+# Page and slide markers written by extract_text_from_pdf / extract_text_from_ppt
+LOCATION_MARKER = re.compile(r"^--- (Page|Slide) (\d+)", re.MULTILINE)
+
+def locate_chunks(full_text, text_chunks):
+    """
+    Returns, for each chunk, the ("page" or "slide", number) it starts on,
+    or None when the text has no page/slide markers (e.g. images).
+    """
+    markers = [(m.start(), m.group(1).lower(), int(m.group(2))) for m in LOCATION_MARKER.finditer(full_text)]
+    marker_offsets = [offset for offset, _, _ in markers]
+    locations = []
+    search_from = 0
+    start = 0
+    for chunk in text_chunks:
+        # Chunks come out of the splitter in order, so each one starts after the previous start
+        found = full_text.find(chunk, search_from)
+        if found != -1:
+            start = found
+            search_from = found + 1
+        index = bisect.bisect_right(marker_offsets, start) - 1
+        locations.append(markers[index][1:] if index >= 0 else None)
+    return locations
+
+def build_chunk_metadata(source_id, file_type, scope, locations):
+    """
+    Metadata stored with every chunk: the course/material scope it was
+    ingested under, its source file and type, its page or slide and when it was ingested.
+    """
+    ingested_at = time.time()
+    metadatas = []
+    for location in locations:
+        metadata = {"sourceId": source_id, "fileType": file_type, "ingestedAt": ingested_at,
+                    **dict.fromkeys(SCOPE_FIELDS, UNSCOPED), **scope}
+        if location:
+            metadata[location[0]] = location[1]
+        metadatas.append(metadata)
+    return metadatas
+
+class IngestDocument:
+    """One document moving through the ingestion pipeline, with what each stage produced."""
+
+    def __init__(self, job):
+        self.job = job
+        self.scope = job.options.get("scope", {})
+        # Set for files uploaded to /chatbot-api/ingest/bulk: {"path", "filename", "content_type"}
+        self.upload = job.options.get("upload")
+        self.source_id = None      # Drive file ID, or upload_<content hash> for uploads
+        self.file_path = None
+        self.content_type = None
+        self.content_sha256 = None
+        self.file_type = None
+        self.previous = None       # what the last ingestion of this source stored
+        self.full_text = None
+        self.index = None          # the index whose chunk settings text_chunks follow
+        self.text_chunks = []
+        self.ids = []
+        self.metadatas = []
+
+    def release_file(self):
+        """Deletes the downloaded or uploaded file once its text has been extracted (or the job ended)."""
+        path = self.file_path or (self.upload or {}).get("path")
+        if path and os.path.exists(path):
+            os.remove(path)
+        self.file_path = None
+
+def chunk_text(source_id, file_type, scope, full_text, index):
+    """
+    Splits a document's text with the chunk settings of `index`.
+    Returns (text_chunks, chunk_ids, metadatas).
+    """
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=index["chunk_size"],
+        chunk_overlap=index["chunk_overlap"],
+        length_function=len
+    )
+    text_chunks = text_splitter.split_text(full_text)
+    # Create unique IDs based on the source and chunk index
+    prefix = source_id if source_id.startswith("upload_") else f"drive_{source_id}"
+    chunk_ids = [f"{prefix}_{file_type}_chunk_{i}" for i in range(len(text_chunks))]
+    metadatas = build_chunk_metadata(source_id, file_type, scope, locate_chunks(full_text, text_chunks))
+    return text_chunks, chunk_ids, metadatas
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def fetch_document(doc):
+    """
+    Stage 1: downloads the Drive file (or takes the uploaded file), skips it if
+    it is unchanged since the last ingestion and detects its type.
+    A resumed job whose text was already extracted doesn't fetch the file again.
+    Returns False when the job has already ended (failed or skipped).
+    """
+    job = doc.job
+    job.start_stage("download")
+    resumed = job.checkpoint.get("file")
+    if resumed and has_cached_extraction(resumed["content_sha256"]):
+        doc.source_id = resumed["source_id"]
+        doc.content_sha256 = resumed["content_sha256"]
+        doc.file_type = resumed["file_type"]
+        log_event("ingest_resume", job_id=job.job_id, source_id=doc.source_id, from_stage="extract")
+    elif doc.upload:
+        doc.file_path = doc.upload["path"]
+        if not os.path.exists(doc.file_path):
+            return job.fail("Uploaded file is no longer available.")
+        doc.content_type = doc.upload.get("content_type")
+        doc.content_sha256 = file_sha256(doc.file_path)
+        doc.source_id = f"upload_{doc.content_sha256[:24]}"
+        log_event("ingest_upload", job_id=job.job_id, source_id=doc.source_id, filename=doc.upload.get("filename"))
+    else:
+        # 1. Get File ID and create download link
+        file_id = get_google_drive_file_id(job.drive_link)
+        if not file_id:
+            return job.fail("Could not parse Google Drive File ID.")
+        doc.source_id = file_id
+
+        # 2. Download the file (streamed to a temporary file on disk)
+        print(f"[Background Ingest] Downloading file: {file_id}...")
+        try:
+            doc.file_path, doc.content_type, file_size, doc.content_sha256 = download_drive_file(file_id, job)
+        except DownloadError as e:
+            return job.fail(str(e))
+        print(f"[Background Ingest] File downloaded ({file_size} bytes). Content-Type: {doc.content_type}")
+
+    # Skip files whose bytes (and course/material scope) haven't changed since the last ingestion
+    doc.previous = get_ingested_document(doc.source_id)
+    if (doc.previous and doc.previous["content_sha256"] == doc.content_sha256
+            and doc.previous["chunk_config"] == current_chunk_config()
+            and doc.previous["scope"] == doc.scope):
+        job.complete("File unchanged since last ingestion; skipped.")
+        log_event("ingest_skipped", job_id=job.job_id, source_id=doc.source_id, reason="unchanged")
+        return False
+
+    # 3. Detect file type
+    if not doc.file_type:
+        filename = (doc.upload or {}).get("filename")
+        doc.file_type = detect_file_type(doc.file_path, doc.content_type, filename)
+        if not doc.file_type:
+            return job.fail("Could not detect file type. Supported: PDF, PPT/PPTX, Images (JPG, PNG, etc.)")
+        print(f"[Background Ingest] Detected file type: {doc.file_type}")
+        job.save_checkpoint("file", {"source_id": doc.source_id, "content_sha256": doc.content_sha256,
+                                     "file_type": doc.file_type})
+    return True
+
+def extract_document(doc):
+    """
+    Stage 2: extracts the text (reusing the text of identical files), splits it
+    into chunks and builds their IDs and metadata.
+    Returns False when the job has failed.
+    """
+    job = doc.job
+    file_type = doc.file_type
+
+    # 4. Extract text based on file type (reusing the text of identical files)
+    job.start_stage("extract")
+    full_text = get_cached_extraction(doc.content_sha256)
+    extraction_cached = bool(full_text)
+    if extraction_cached:
+        log_event("extraction_cache_hit", job_id=job.job_id, source_id=doc.source_id)
+    elif file_type == 'pdf':
+        print("[Background Ingest] Extracting text from PDF...")
+        full_text = extract_text_from_pdf(doc.file_path, job, doc.content_sha256)
+    elif file_type == 'pptx':
+        print("[Background Ingest] Extracting text from PowerPoint...")
+        full_text = extract_text_from_ppt(doc.file_path)
+    elif file_type == 'image':
+        print("[Background Ingest] Extracting text from image using OCR...")
+        full_text = extract_text_from_image(doc.file_path)
+    else:
+        return job.fail(f"Unsupported file type: {file_type}")
+
+    if not full_text or not full_text.strip():
+        return job.fail("No text extracted from file.")
+
+    print(f"[Background Ingest] Extracted {len(full_text)} characters of text.")
+    if not extraction_cached:
+        save_extraction(doc.content_sha256, file_type, full_text)
+    # The file isn't needed once its text is saved (a resumed job starts from the saved text)
+    doc.release_file()
+
+    # 5. Chunk the text, with the settings of the live index
+    job.start_stage("chunk")
+    print("[Background Ingest] Chunking text...")
+    doc.index = active_index()
+    doc.text_chunks, doc.ids, doc.metadatas = chunk_text(doc.source_id, file_type, doc.scope, full_text, doc.index)
+    print(f"[Background Ingest] Split into {len(doc.text_chunks)} chunks.")
+
+    if not doc.text_chunks:
+        return job.fail("Text could not be split into chunks.")
+    doc.full_text = full_text
+    return True
+
+def embed_and_store_documents(docs):
+    """
+    Stage 3: embeds the chunks of all `docs` together (only chunk texts that
+    are new) with the live index's model, then stores them (store_documents).
+    """
+    for doc in docs:
+        doc.job.start_stage("embed")
+    job = docs[0].job if len(docs) == 1 else None
+    while True:
+        index = active_index()
+        for doc in docs:
+            if doc.index["name"] != index["name"]:
+                # The index alias was swapped after this document was chunked
+                doc.index = index
+                doc.text_chunks, doc.ids, doc.metadatas = chunk_text(
+                    doc.source_id, doc.file_type, doc.scope, doc.full_text, index)
+        all_chunks = [chunk for doc in docs for chunk in doc.text_chunks]
+
+        # 6. Embed (only chunks whose text is new) and Store
+        print(f"[Background Ingest] Generating embeddings for {len(all_chunks)} chunks from {len(docs)} document(s)...")
+        embeddings, encoded = embed_chunks(all_chunks, job, index["embedding_model"])
+        log_event("ingest_embed", documents=len(docs), chunks=len(all_chunks), encoded=encoded,
+                  reused=len(all_chunks) - encoded, index=index["name"])
+
+        # The alias can't move while the chunks are stored; if it moved while
+        # they were embedded, start over for the new index
+        with index_write_lock():
+            if active_index()["name"] == index["name"]:
+                store_documents(docs, all_chunks, embeddings, index)
+                break
+        log_event("ingest_rechunk", reason="index_swapped", previous_index=index["name"])
+
+    for doc in docs:
+        doc.job.complete(f"Ingested {len(doc.ids)} chunks from {doc.file_type} file {doc.source_id}.")
+        print(f"--- [Background Ingest] COMPLETED: Ingestion for {doc.file_type} file {doc.source_id} ---")
+
+def store_documents(docs, all_chunks, embeddings, index):
+    """
+    Upserts the embedded chunks of `docs` into the live `index` in large
+    collection calls, removes each document's stale chunks and records it as
+    ingested. Runs under index_write_lock.
+    """
+    for doc in docs:
+        doc.job.start_stage("store")
+    collection = get_collection(index["name"])
+    all_ids = [chunk_id for doc in docs for chunk_id in doc.ids]
+    all_metadatas = [metadata for doc in docs for metadata in doc.metadatas]
+    print(f"[Background Ingest] Upserting {len(all_ids)} chunks to ChromaDB...")
+    for start in range(0, len(all_ids), INGEST_STORE_BATCH_SIZE):
+        end = start + INGEST_STORE_BATCH_SIZE
+        collection.upsert(
+            embeddings=embeddings[start:end],
+            documents=all_chunks[start:end],
+            metadatas=all_metadatas[start:end],
+            ids=all_ids[start:end]
+        )
+
+    changed_ids = list(all_ids)
+    for doc in docs:
+        # Remove chunks left over from a previous, longer version of the document
+        # (read again: a swap since the download replaced the ingested documents)
+        doc.previous = get_ingested_document(doc.source_id)
+        if doc.previous:
+            orphan_ids = sorted(set(doc.previous["chunk_ids"]) - set(doc.ids))
+        elif not doc.upload:
+            orphan_ids = find_legacy_chunk_ids(doc.source_id, doc.file_type, len(doc.ids), index["name"])
+        else:
+            orphan_ids = []
+        if orphan_ids:
+            log_event("ingest_orphans_deleted", source_id=doc.source_id, chunks=len(orphan_ids))
+            collection.delete(ids=orphan_ids)
+            changed_ids.extend(orphan_ids)
+        index_chunks(doc.source_id, doc.ids, doc.text_chunks, doc.metadatas)
+    notify_collection_changed(changed_ids)
+
+    for doc in docs:
+        save_ingested_document(doc.source_id, doc.content_sha256, doc.file_type, doc.ids,
+                               current_chunk_config(index), doc.scope)
+
+def process_drive_link(drive_url, job=None):
+    """
+    Runs the full ingestion of one document in the calling thread:
+    1. Downloads file from Google Drive (or takes the uploaded file).
+    2. Detects file type (PDF, PPT, image, etc.)
+    3. Extracts text (with OCR for images and scanned PDFs).
+    4. Chunks the text.
+    5. Embeds and stores in ChromaDB, with the job's course/material scope as metadata.
+
+    The ingestion owner runs the same stages as a pipeline (IngestPipeline).
+    Progress is reported on `job` (an IngestJob) so the status endpoint can
+    show which stage the document is in.
+    """
+    if job is None:
+        job = IngestJob(drive_url)
+    print(f"[Background Ingest] Starting task for: {drive_url}")
+    doc = IngestDocument(job)
+    try:
+        if fetch_document(doc) and extract_document(doc):
+            embed_and_store_documents([doc])
+    except Exception as e:
+        job.fail(str(e))
+        import traceback
+        traceback.print_exc()
+    finally:
+        doc.release_file()
+
+
+# --- 3. INGESTION JOB QUEUE ---
+
+class IngestJob:
+    """
+    Tracks one ingestion request as it moves through the pipeline stages
+    (download -> extract -> chunk -> embed -> store).
+    Jobs are rows in the state database, so every worker process can queue
+    them and report their status, while only the ingestion owner runs them.
+    `checkpoint` holds what a job interrupted by a restart resumes from.
+    """
+
+    PROGRESS_SAVE_INTERVAL = 1.0  # seconds between progress writes to the database
+
+    def __init__(self, drive_link, priority="normal", options=None, batch_id=None):
+        self.job_id = uuid.uuid4().hex
+        self.drive_link = drive_link
+        self.priority = priority
+        self.options = options or {}
+        self.batch_id = batch_id
+        self.status = "queued"  # queued, running, completed, failed
+        self.stage = None
+        self.stage_progress = 0.0
+        self.message = ""
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.stage_timings = {}
+        self.checkpoint = {}
+        self.resumes = 0
+        self._stage_started_at = None
+        self._last_saved = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_row(cls, row):
+        job = cls(row["drive_link"], row["priority"], json.loads(row["options"]), row["batch_id"])
+        job.job_id = row["job_id"]
+        job.status = row["status"]
+        job.stage = row["stage"]
+        job.stage_progress = row["stage_progress"]
+        job.message = row["message"] or ""
+        job.error = row["error"]
+        job.created_at = row["created_at"]
+        job.started_at = row["started_at"]
+        job.finished_at = row["finished_at"]
+        job.stage_timings = json.loads(row["stage_timings"])
+        job.checkpoint = json.loads(row["checkpoint"])
+        job.resumes = row["resumes"]
+        job._stage_started_at = row["stage_started_at"]
+        return job
+
+    def insert(self):
+        with get_state_db() as conn:
+            conn.execute(
+                "INSERT INTO ingest_jobs (job_id, drive_link, priority, priority_rank, options, status, created_at, "
+                "batch_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.job_id, self.drive_link, self.priority, INGEST_PRIORITIES[self.priority],
+                 json.dumps(self.options), self.status, self.created_at, self.batch_id),
+            )
+
+    def _save(self):
+        self._last_saved = time.monotonic()
+        with get_state_db() as conn:
+            conn.execute(
+                "UPDATE ingest_jobs SET status = ?, stage = ?, stage_progress = ?, stage_started_at = ?, "
+                "message = ?, error = ?, started_at = ?, finished_at = ?, stage_timings = ? WHERE job_id = ?",
+                (self.status, self.stage, self.stage_progress, self._stage_started_at, self.message,
+                 self.error, self.started_at, self.finished_at, json.dumps(self.stage_timings), self.job_id),
+            )
+
+    def save_checkpoint(self, name, value):
+        """Records `value` under `name` in the job's checkpoint, written to the database right away."""
+        with self._lock:
+            self.checkpoint[name] = value
+            with get_state_db() as conn:
+                conn.execute("UPDATE ingest_jobs SET checkpoint = ? WHERE job_id = ?",
+                             (json.dumps(self.checkpoint), self.job_id))
+
+    def _close_stage(self, now):
+        if self.stage and self._stage_started_at is not None:
+            self.stage_timings[self.stage] = round(now - self._stage_started_at, 3)
+            STAGE_LATENCY.labels(f"ingest_{self.stage}").observe(max(0.0, now - self._stage_started_at))
+
+    def _log_finished(self):
+        INGEST_JOBS.labels(self.status).inc()
+        log_event("ingest_job", job_id=self.job_id, batch_id=self.batch_id, status=self.status,
+                  error=self.error, stage_timings=self.stage_timings)
+
+    def start_stage(self, stage):
+        """Marks the end of the current stage and the start of `stage`."""
+        now = time.time()
+        with self._lock:
+            if self.started_at is None:
+                self.started_at = now
+            self.status = "running"
+            self._close_stage(now)
+            self.stage = stage
+            self.stage_progress = 0.0
+            self._stage_started_at = now
+            self._save()
+
+    def set_progress(self, done, total):
+        """Updates progress within the current stage (e.g. pages OCR'd, chunks embedded)."""
+        with self._lock:
+            self.stage_progress = min(1.0, done / total) if total else 1.0
+            if time.monotonic() - self._last_saved >= self.PROGRESS_SAVE_INTERVAL:
+                self._save()
+
+    def complete(self, message=""):
+        now = time.time()
+        with self._lock:
+            self._close_stage(now)
+            self.status = "completed"
+            self.stage_progress = 1.0
+            self.message = message
+            self.finished_at = now
+            self._save()
+        self._log_finished()
+
+    def fail(self, error):
+        """Marks the job as failed. Returns None so callers can `return job.fail(...)`."""
+        print(f"--- [Background Ingest] FAILED ({self.job_id}): {error} ---")
+        now = time.time()
+        with self._lock:
+            self._close_stage(now)
+            self.status = "failed"
+            self.error = error
+            self.finished_at = now
+            self._save()
+        self._log_finished()
+        return None
+
+    @property
+    def progress(self):
+        """Overall progress between 0 and 1 across all stages."""
+        if self.status == "completed":
+            return 1.0
+        if self.stage not in INGEST_STAGES:
+            return 0.0
+        done_stages = INGEST_STAGES.index(self.stage)
+        return round((done_stages + self.stage_progress) / len(INGEST_STAGES), 3)
+
+    def to_dict(self):
+        with self._lock:
+            now = time.time()
+            timings = dict(self.stage_timings)
+            if self.status == "running" and self._stage_started_at is not None:
+                timings[self.stage] = round(now - self._stage_started_at, 3)
+            return {
+                "job_id": self.job_id,
+                "drive_link": self.drive_link,
+                "priority": self.priority,
+                "scope": self.options.get("scope", {}),
+                "batch_id": self.batch_id,
+                "status": self.status,
+                "stage": self.stage,
+                "progress": self.progress,
+                "message": self.message,
+                "error": self.error,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "queue_wait_seconds": round((self.started_at or now) - self.created_at, 3),
+                "total_seconds": round((self.finished_at or now) - self.started_at, 3) if self.started_at else None,
+                "stage_timings": timings,
+                "resumes": self.resumes,
+            }
+
+
+class QueueFullError(Exception):
+    """Raised when INGEST_QUEUE_SIZE jobs are already waiting."""
+
+
+# Jobs running in this process, so status requests see live progress
+active_jobs = {}
+active_jobs_lock = threading.Lock()
+# Set when a job is queued from this process, to wake idle workers early
+ingest_wakeup = threading.Event()
+
+
+def count_queued_jobs():
+    return get_state_db().execute("SELECT COUNT(*) FROM ingest_jobs WHERE status = 'queued'").fetchone()[0]
+
+
+def prune_finished_jobs():
+    """Forgets finished jobs older than INGEST_JOB_RETENTION so the job table stays bounded."""
+    with get_state_db() as conn:
+        conn.execute(
+            "DELETE FROM ingest_jobs WHERE finished_at IS NOT NULL AND finished_at < ?",
+            (time.time() - INGEST_JOB_RETENTION,),
+        )
+        # Pages OCR'd for a file whose extraction never finished (its job failed or was abandoned)
+        conn.execute("DELETE FROM extraction_pages WHERE created_at < ?", (time.time() - PAGE_CHECKPOINT_TTL,))
+
+
+def submit_ingest_job(drive_link, priority="normal", options=None):
+    """
+    Registers a new ingestion job in the queue.
+    Raises QueueFullError if INGEST_QUEUE_SIZE jobs are already waiting.
+    """
+    return submit_ingest_batch([(drive_link, options)], priority)[0]
+
+
+def submit_ingest_batch(items, priority="normal", batch_id=None):
+    """
+    Queues one job per (drive_link, options) item, all or nothing.
+    Raises QueueFullError if they don't fit in INGEST_QUEUE_SIZE.
+    """
+    prune_finished_jobs()
+    if count_queued_jobs() + len(items) > INGEST_QUEUE_SIZE:
+        raise QueueFullError()
+    jobs = [IngestJob(drive_link, priority, options, batch_id) for drive_link, options in items]
+    for job in jobs:
+        job.insert()
+    ingest_wakeup.set()
+    return jobs
+
+
+def get_ingest_batch(batch_id):
+    """Returns the jobs of a bulk request (live state for jobs running in this process), oldest first."""
+    rows = get_state_db().execute(
+        "SELECT * FROM ingest_jobs WHERE batch_id = ? ORDER BY created_at", (batch_id,)
+    ).fetchall()
+    jobs = []
+    for row in rows:
+        with active_jobs_lock:
+            job = active_jobs.get(row["job_id"])
+        jobs.append(job or IngestJob.from_row(row))
+    return jobs
+
+
+def get_ingest_job(job_id):
+    """Returns the live job if it runs in this process, else its last saved state, or None."""
+    with active_jobs_lock:
+        job = active_jobs.get(job_id)
+    if job is not None:
+        return job
+    row = get_state_db().execute("SELECT * FROM ingest_jobs WHERE job_id = ?", (job_id,)).fetchone()
+    return IngestJob.from_row(row) if row else None
+
+
+def claim_next_job():
+    """Atomically marks the highest-priority queued job as running and returns it (or None)."""
+    conn = get_state_db()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT * FROM ingest_jobs WHERE status = 'queued' ORDER BY priority_rank, created_at LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE ingest_jobs SET status = 'running' WHERE job_id = ?", (row["job_id"],))
+    job = IngestJob.from_row(row)
+    job.status = "running"
+    return job
+
+
+class IngestPipeline:
+    """
+    Runs queued jobs through the ingestion stages as a pipeline, so one
+    document downloads while another is extracted and a third is embedded:
+
+        download threads -> extract threads -> embed/store thread
+           (network)          (CPU, OCR)        (batched across documents)
+
+    The hand-off queues are bounded, so downloads stop claiming jobs when
+    extraction falls behind. The embed/store thread takes every document
+    that is ready (up to INGEST_STORE_BATCH_CHUNKS chunks) and embeds and
+    upserts them together. The extract and embed/store threads run at a
+    lower priority and pause for chat and question requests (see
+    yield_to_interactive).
+    """
+
+    def __init__(self, download_workers, extract_workers):
+        self.download_workers = download_workers
+        self.extract_workers = extract_workers
+        self.extract_queue = queue.Queue(maxsize=extract_workers * 2)
+        self.store_queue = queue.Queue(maxsize=extract_workers * 4)
+        self.extract_depth = QUEUE_DEPTH.labels("ingest_extract")
+        self.store_depth = QUEUE_DEPTH.labels("ingest_store")
+
+    def start(self):
+        for i in range(self.download_workers):
+            threading.Thread(target=self._download_loop, name=f"ingest-download-{i}", daemon=True).start()
+        for i in range(self.extract_workers):
+            threading.Thread(target=self._extract_loop, name=f"ingest-extract-{i}", daemon=True).start()
+        threading.Thread(target=self._store_loop, name="ingest-store", daemon=True).start()
+
+    @staticmethod
+    def _run_stage(doc, stage):
+        """Runs one stage; returns True if the document should move on to the next one."""
+        request_id_var.set(doc.job.job_id)
+        try:
+            if stage(doc):
+                return True
+        except Exception as e:
+            doc.job.fail(str(e))
+            import traceback
+            traceback.print_exc()
+        IngestPipeline._finish(doc)
+        return False
+
+    @staticmethod
+    def _finish(doc):
+        doc.release_file()
+        with active_jobs_lock:
+            active_jobs.pop(doc.job.job_id, None)
+
+    def _download_loop(self):
+        while True:
+            job = claim_next_job()
+            if job is None:
+                # Jobs queued by other worker processes are picked up on the next poll
+                ingest_wakeup.wait(INGEST_POLL_INTERVAL)
+                ingest_wakeup.clear()
+                continue
+            with active_jobs_lock:
+                active_jobs[job.job_id] = job
+            print(f"[Background Ingest] Starting task for: {job.drive_link}")
+            doc = IngestDocument(job)
+            if self._run_stage(doc, fetch_document):
+                self.extract_queue.put(doc)
+                self.extract_depth.inc()
+
+    def _extract_loop(self):
+        lower_thread_priority()
+        while True:
+            doc = self.extract_queue.get()
+            self.extract_depth.dec()
+            yield_to_interactive()
+            if self._run_stage(doc, extract_document):
+                self.store_queue.put(doc)
+                self.store_depth.inc()
+
+    def _store_loop(self):
+        lower_thread_priority()
+        while True:
+            docs = [self.store_queue.get()]
+            chunks = len(docs[0].text_chunks)
+            while chunks < INGEST_STORE_BATCH_CHUNKS:
+                try:
+                    doc = self.store_queue.get_nowait()
+                except queue.Empty:
+                    break
+                docs.append(doc)
+                chunks += len(doc.text_chunks)
+            self.store_depth.dec(len(docs))
+            # A batch spans several jobs; their own log lines carry the job IDs
+            request_id_var.set(docs[0].job.job_id if len(docs) == 1 else None)
+            try:
+                embed_and_store_documents(docs)
+            except Exception as e:
+                for doc in docs:
+                    doc.job.fail(str(e))
+                import traceback
+                traceback.print_exc()
+            finally:
+                for doc in docs:
+                    self._finish(doc)
+
+    def stats(self):
+        return {
+            "download_workers": self.download_workers,
+            "extract_workers": self.extract_workers,
+            "waiting_for_extract": self.extract_queue.qsize(),
+            "waiting_for_store": self.store_queue.qsize(),
+        }
+
+
+ingest_pipeline = IngestPipeline(INGEST_DOWNLOAD_WORKERS, INGEST_WORKERS)
+
+
+def recover_interrupted_jobs():
+    """
+    Jobs left 'running' by a process that died (redeploy, OOM kill) are queued
+    again, ahead of newer jobs of their priority, and resume from their
+    checkpoints. A job already resumed INGEST_MAX_RESUMES times is failed.
+    """
+    with get_state_db() as conn:
+        failed = conn.execute(
+            "UPDATE ingest_jobs SET status = 'failed', finished_at = ?, "
+            "error = 'Interrupted by a restart too many times; it may be crashing the service.' "
+            "WHERE status = 'running' AND resumes >= ?",
+            (time.time(), INGEST_MAX_RESUMES),
+        ).rowcount
+        # The stage restarts, so its timer does too
+        resumed = conn.execute(
+            "UPDATE ingest_jobs SET status = 'queued', resumes = resumes + 1, stage = NULL, stage_progress = 0, "
+            "stage_started_at = NULL, message = 'Resuming after a restart.' WHERE status = 'running'"
+        ).rowcount
+    if resumed or failed:
+        log_event("ingest_recovered", resumed=resumed, failed=failed, max_resumes=INGEST_MAX_RESUMES)
+    if resumed:
+        ingest_wakeup.set()
+
+
+def start_ingest_workers():
+    ingest_pipeline.start()
+    print(f"Started the ingestion pipeline ({INGEST_DOWNLOAD_WORKERS} download, {INGEST_WORKERS} extract, "
+          f"1 embed/store thread) in process {os.getpid()}.")
+
+
+# Only one process runs ingestion, so OCR/embedding load doesn't multiply with
+# the number of web workers and a single process writes ingestion results.
+# The owner holds an exclusive lock on INGEST_LOCK_PATH for its lifetime.
+ingest_lock_file = None
+
+def try_acquire_ingest_lock():
+    global ingest_lock_file
+    if fcntl is None:  # no flock (Windows): single-process use only
+        return True
+    lock_file = open(INGEST_LOCK_PATH, "a+")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    ingest_lock_file = lock_file
+    return True
+
+def is_ingest_owner():
+    """True if this process holds the ingestion lock (always, without flock)."""
+    return ingest_lock_file is not None or fcntl is None
+
+
+def become_ingest_owner():
+    print(f"[Ingest] Process {os.getpid()} owns ingestion.")
+    recover_interrupted_jobs()
+    start_ingest_workers()
+    threading.Thread(target=backfill_scope_markers, name="scope-backfill", daemon=True).start()
+    if HYBRID_SEARCH_ENABLED:
+        threading.Thread(target=backfill_lexical_index, name="lexical-backfill", daemon=True).start()
+    threading.Thread(target=check_embedding_parity_once, name="embedding-parity", daemon=True).start()
+
+
+def ingest_election_loop():
+    # If the current owner dies, one of the remaining processes takes over
+    while not try_acquire_ingest_lock():
+        time.sleep(INGEST_POLL_INTERVAL * 5)
+    become_ingest_owner()
+
+
+def start_ingest_election():
+    if try_acquire_ingest_lock():
+        become_ingest_owner()
+    else:
+        threading.Thread(target=ingest_election_loop, name="ingest-election", daemon=True).start()
@@ -0,0 +1,400 @@
+"""
+Lazily loaded models and the Chroma client, the index this process serves
+(following the index alias), and collection change notifications.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+import json
+import sqlite3
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+import numpy as np
+
+from config import (
+    DB_PATH, COLLECTION_NAME, CHUNK_SIZE, CHUNK_OVERLAP, EMBEDDING_MODEL, EMBEDDING_BACKEND, ONNX_MODEL_FILE,
+    ONNX_MODEL_PATH, ONNX_TOKENIZER_PATH, EMBEDDING_MAX_SEQ_LENGTH, embedding_cache_key, RERANK_ENABLED,
+    RERANK_MODEL, OCR_ENABLED, STATE_DB_PATH, INDEX_LOCK_PATH, CHROMA_SERVER_URL,
+    COLLECTION_VERSION_CHECK_INTERVAL,
+)
+from state_db import get_state_db
+
+
+# --- 1. INITIALIZE MODELS AND DB (lazily, warmed in the background) ---
+
+class LazyComponent:
+    """
+    A model or client that is loaded on first use, or warmed up ahead of time
+    in a background thread. Its state (cold/loading/ready/failed) is reported
+    by /readyz.
+    """
+
+    def __init__(self, name, loader):
+        self.name = name
+        self._loader = loader
+        self._value = None
+        self._lock = threading.Lock()
+        self.state = "cold"
+        self.error = None
+        self.load_seconds = None
+
+    def get(self):
+        """Returns the loaded component, loading it now if nobody has yet."""
+        if self._value is not None:
+            return self._value
+        with self._lock:
+            if self._value is None:
+                self.state = "loading"
+                started = time.monotonic()
+                try:
+                    self._value = self._loader()
+                except Exception as e:
+                    self.state = "failed"
+                    self.error = str(e)
+                    print(f"--- FAILED to load {self.name}: {e} ---")
+                    raise
+                self.load_seconds = round(time.monotonic() - started, 2)
+                self.state = "ready"
+                self.error = None
+                print(f"{self.name} loaded in {self.load_seconds}s.")
+        return self._value
+
+    def _warm(self):
+        try:
+            self.get()
+        except Exception:
+            pass  # already recorded in self.state / self.error
+
+    def warm_in_background(self):
+        thread = threading.Thread(target=self._warm, name=f"warm-{self.name}", daemon=True)
+        thread.start()
+        return thread
+
+    def status(self):
+        return {"state": self.state, "load_seconds": self.load_seconds, "error": self.error}
+
+
+class OnnxEmbeddingModel:
+    """
+    The embedding model on ONNX Runtime, with the same output as the
+    SentenceTransformer pipeline (mean pooling over the attention mask, then L2
+    normalisation) and the same `encode` call, so it can stand in for it.
+    """
+
+    def __init__(self, model_path, tokenizer_path, max_seq_length=EMBEDDING_MAX_SEQ_LENGTH):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=max_seq_length)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+        options = ort.SessionOptions()
+        # Follow the per-worker thread limit set by gunicorn.conf.py (0 = all cores)
+        options.intra_op_num_threads = int(os.environ.get("OMP_NUM_THREADS", 0))
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        outputs = [output.name for output in self.session.get_outputs()]
+        self.output_name = "last_hidden_state" if "last_hidden_state" in outputs else outputs[0]
+        self.dimension = self.session.get_outputs()[0].shape[-1]
+
+    def _encode_batch(self, sentences):
+        encodings = self.tokenizer.encode_batch(sentences)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": attention_mask,
+        }
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+        token_embeddings = self.session.run([self.output_name], feeds)[0]
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        """Embeds a string (returns one vector) or a list of strings (returns a 2-D array)."""
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size)[0]
+        batches = [self._encode_batch(sentences[start:start + batch_size])
+                   for start in range(0, len(sentences), batch_size)]
+        if not batches:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        return np.vstack(batches).astype(np.float32)
+
+
+def load_embedding_model(model_name=EMBEDDING_MODEL):
+    if EMBEDDING_BACKEND == "onnx":
+        from huggingface_hub import hf_hub_download
+        repo_id = f"sentence-transformers/{model_name}"
+        # Local ONNX files are for the default model; other models come from their repo
+        local = model_name == EMBEDDING_MODEL
+        model_path = (local and ONNX_MODEL_PATH) or hf_hub_download(repo_id, ONNX_MODEL_FILE)
+        tokenizer_path = (local and ONNX_TOKENIZER_PATH) or hf_hub_download(repo_id, "tokenizer.json")
+        return OnnxEmbeddingModel(model_path, tokenizer_path)
+    # Imported here so the web server can start before torch is loaded
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+def load_reranker():
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(RERANK_MODEL, device="cpu", max_length=512)
+
+def load_ocr_reader():
+    # Initialize EasyOCR reader (supports English by default)
+    # This will download models on first run - takes a few minutes
+    import easyocr
+    print("Initializing EasyOCR (this may take a minute on first run)...")
+    return easyocr.Reader(['en'], gpu=False)  # Set gpu=True if you have CUDA
+
+def load_chroma_client():
+    import chromadb
+    if CHROMA_SERVER_URL:
+        from urllib.parse import urlparse
+        url = urlparse(CHROMA_SERVER_URL)
+        db_client = chromadb.HttpClient(host=url.hostname, port=url.port or 8000, ssl=url.scheme == "https")
+        location = CHROMA_SERVER_URL
+    else:
+        db_client = chromadb.PersistentClient(path=DB_PATH)
+        location = DB_PATH
+    name = serving_index()["name"]
+    collection_handles[name] = db_client.get_or_create_collection(name=name)
+    print(f"Connected to ChromaDB at '{location}'. Collection '{name}' loaded.")
+    return db_client
+
+
+# One component per embedding model: after an index swap to another model both
+# may be loaded for a moment. components["embedding_model"] is the serving one.
+embedding_models = {}
+embedding_models_lock = threading.Lock()
+
+def embedding_model_component(model_name):
+    with embedding_models_lock:
+        component = embedding_models.get(model_name)
+        if component is None:
+            component = LazyComponent("embedding_model", lambda: load_embedding_model(model_name))
+            embedding_models[model_name] = component
+        return component
+
+# Collection handles by name (the serving index and, in reindex.py, shadow indexes)
+collection_handles = {}
+
+# Which index (collection + embedding/chunk settings) this process serves.
+# Shadow builds and swaps of the alias are in indexes.py.
+DEFAULT_INDEX = {"name": COLLECTION_NAME, "embedding_model": EMBEDDING_MODEL,
+                 "chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP}
+
+def get_search_index(name, conn=None):
+    """Returns {"name", "embedding_model", "chunk_size", "chunk_overlap"} for an index, or None."""
+    conn = conn or get_state_db()
+    row = conn.execute(
+        "SELECT name, embedding_model, chunk_size, chunk_overlap FROM search_indexes WHERE name = ?", (name,)
+    ).fetchone()
+    if row:
+        return {"name": row[0], "embedding_model": row[1], "chunk_size": row[2], "chunk_overlap": row[3]}
+    # The first index isn't registered until it is swapped out
+    return dict(DEFAULT_INDEX) if name == COLLECTION_NAME else None
+
+def read_index_alias(conn=None):
+    """Returns {"active": index, "previous": index or None}; before the first swap the active index is DEFAULT_INDEX."""
+    conn = conn or get_state_db()
+    row = conn.execute("SELECT value FROM state_meta WHERE key = 'index_alias'").fetchone()
+    alias = json.loads(row[0]) if row else {"active": COLLECTION_NAME, "previous": None}
+    return {
+        "active": get_search_index(alias["active"], conn),
+        "previous": get_search_index(alias["previous"], conn) if alias["previous"] else None,
+    }
+
+# The index this process answers queries from. It follows the alias, but only
+# once the new index's embedding model is loaded, so queries never wait on it.
+serving = {"index": None, "switching_to": None}
+serving_lock = threading.Lock()
+
+def serving_index():
+    """The index this process serves queries from (see follow_index_alias)."""
+    if serving["index"] is None:
+        with serving_lock:
+            if serving["index"] is None:
+                # Own connection: this may run in the gunicorn master, whose
+                # connections must not be inherited by the forked workers
+                conn = sqlite3.connect(STATE_DB_PATH, timeout=30)
+                try:
+                    index = read_index_alias(conn)["active"]
+                except sqlite3.OperationalError:
+                    index = dict(DEFAULT_INDEX)  # new database: nothing swapped yet
+                finally:
+                    conn.close()
+                components["embedding_model"] = embedding_model_component(index["embedding_model"])
+                serving["index"] = index
+                if index != DEFAULT_INDEX:
+                    print(f"[Index] Serving '{index['name']}' ({index['embedding_model']}, chunks of "
+                          f"{index['chunk_size']}/{index['chunk_overlap']}); the configured defaults only "
+                          f"apply to the first index.")
+    return serving["index"]
+
+def serving_cache_key():
+    return embedding_cache_key(serving_index()["embedding_model"])
+
+components = {
+    "embedding_model": embedding_model_component(EMBEDDING_MODEL),
+    "chroma": LazyComponent("chroma", load_chroma_client),
+    # Only loaded on the first OCR that runs in this process
+    "ocr_reader": LazyComponent("ocr_reader", load_ocr_reader),
+    # Warmed at start-up when RERANK_ENABLED; requests skip reranking until it is ready
+    "reranker": LazyComponent("reranker", load_reranker),
+}
+# Components that must be warm before /readyz reports ready
+REQUIRED_COMPONENTS = ["embedding_model", "chroma"]
+# Models loaded in the gunicorn master in pre-fork mode. An ONNX Runtime session
+# can't be used across fork (its thread pool stays behind), and the int8 model is
+# small, so with the ONNX backend every worker loads its own.
+PRELOADED_MODELS = (["embedding_model"] if EMBEDDING_BACKEND == "torch" else []) + (["reranker"] if RERANK_ENABLED else [])
+
+def get_embedding_model(model_name=None):
+    """The embedding model called `model_name`, by default the serving index's."""
+    return embedding_model_component(model_name or serving_index()["embedding_model"]).get()
+
+def get_collection(name=None):
+    """The Chroma collection called `name`, by default the serving index's."""
+    name = name or serving_index()["name"]
+    collection = collection_handles.get(name)
+    if collection is None:
+        collection = components["chroma"].get().get_or_create_collection(name=name)
+        collection_handles[name] = collection
+    return collection
+
+def get_ocr_reader():
+    if not OCR_ENABLED:
+        raise RuntimeError("OCR is disabled on this replica (CHATBOT_ROLE/OCR_ENABLED).")
+    return components["ocr_reader"].get()
+
+def warm_up_components(names=None, wait=False):
+    """Loads the given components (default: REQUIRED_COMPONENTS) in parallel background threads."""
+    serving_index()  # picks the embedding model of the index the alias points at
+    threads = [components[name].warm_in_background() for name in (names or REQUIRED_COMPONENTS)]
+    if wait:
+        for thread in threads:
+            thread.join()
+
+def preload_models():
+    """
+    Pre-fork mode: called from gunicorn's when_ready hook, so the model is
+    loaded in the master before it forks and every worker shares the same
+    read-only weights. Chroma clients are per worker.
+    """
+    print(f"--- Pre-fork mode: loading {', '.join(PRELOADED_MODELS)} in the master process ---")
+    warm_up_components(PRELOADED_MODELS, wait=True)
+
+
+# --- 2. SERVING INDEX AND ALIAS ---
+
+def active_index():
+    """The live index as the state database has it now; ingestion writes to this one."""
+    return read_index_alias()["active"]
+
+def switch_serving_index(index):
+    """Starts answering queries from `index` and drops everything cached from the old one."""
+    previous = serving_index()
+    components["embedding_model"] = embedding_model_component(index["embedding_model"])
+    serving["index"] = index
+    collection_handles.pop(previous["name"], None)
+    if previous["embedding_model"] != index["embedding_model"]:
+        with embedding_models_lock:
+            embedding_models.pop(previous["embedding_model"], None)  # freed once in-flight queries finish
+    for listener in collection_reload_listeners:
+        listener()
+    print(f"[Index] Now serving '{index['name']}' (was '{previous['name']}').")
+
+def follow_index_alias():
+    """
+    Moves this process to the index the alias points at, if it changed. When
+    the new index uses another embedding model, that model is loaded in the
+    background and the old index keeps serving until it is ready.
+    """
+    target = active_index()
+    if target["name"] == serving_index()["name"] or serving["switching_to"] == target["name"]:
+        return
+    component = embedding_model_component(target["embedding_model"])
+    if component.state == "ready":
+        switch_serving_index(target)
+        return
+    serving["switching_to"] = target["name"]
+
+    def load_and_switch():
+        try:
+            component.get()
+            # The alias may have moved again (e.g. a rollback) while the model loaded
+            if active_index()["name"] == target["name"]:
+                switch_serving_index(target)
+        except Exception as e:
+            print(f"[Index] Could not switch to '{target['name']}': {e}")
+        finally:
+            serving["switching_to"] = None
+        follow_index_alias()
+
+    threading.Thread(target=load_and_switch, name="index-switch", daemon=True).start()
+
+index_write_thread_lock = threading.Lock()
+
+@contextmanager
+def index_write_lock():
+    """
+    Held while chunks are written to the live index and while the alias is
+    swapped, so an ingestion never lands half in the old index and half in the
+    new one. Covers every process through a flock on INDEX_LOCK_PATH.
+    """
+    with index_write_thread_lock:
+        if fcntl is None:  # no flock (Windows): single-process use only
+            yield
+            return
+        with open(INDEX_LOCK_PATH, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# --- 3. COLLECTION CHANGE NOTIFICATIONS ---
+
+# Callbacks run after ingestion adds, updates or deletes chunks: fn(changed_ids)
+collection_change_listeners = []
+# Callbacks run when another process changed the collection (we don't know which chunks)
+collection_reload_listeners = []
+
+# Ingestion may run in a different process (pre-fork mode), so changes are also
+# published as a version number in the state database.
+seen_collection_version = {"value": None, "checked_at": 0.0}
+
+def read_collection_version():
+    row = get_state_db().execute("SELECT value FROM state_meta WHERE key = 'collection_version'").fetchone()
+    return int(row[0]) if row else 0
+
+def notify_collection_changed(changed_ids):
+    with get_state_db() as conn:
+        conn.execute(
+            "INSERT INTO state_meta VALUES ('collection_version', '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+    seen_collection_version["value"] = read_collection_version()
+    for listener in collection_change_listeners:
+        try:
+            listener(changed_ids)
+        except Exception as e:
+            print(f"[Cache] Invalidation listener failed: {e}")
+
+def sync_collection_version():
+    """Drops this process's caches if another process changed the collection since we last looked."""
+    now = time.monotonic()
+    if now - seen_collection_version["checked_at"] < COLLECTION_VERSION_CHECK_INTERVAL:
+        return
+    seen_collection_version["checked_at"] = now
+    version = read_collection_version()
+    if seen_collection_version["value"] is not None and version != seen_collection_version["value"]:
+        for listener in collection_reload_listeners:
+            listener()
+        follow_index_alias()
+    seen_collection_version["value"] = version
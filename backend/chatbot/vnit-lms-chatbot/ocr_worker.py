@@ -0,0 +1,56 @@
+"""
+OCR worker for scanned PDF pages.
+
+ingestion.py runs these functions in a pool of separate processes. Each process
+loads its own EasyOCR reader once (in `init_worker`) and then renders and
+reads single pages of a PDF that is already on disk, so only the page number
+and the recognised text cross the process boundary.
+"""
+import os
+
+import fitz  # PyMuPDF
+import numpy as np
+
+# EasyOCR reader owned by this worker process
+_reader = None
+
+
+def init_worker(torch_threads=1, nice=0):
+    """
+    Process pool initializer: lowers the process priority by `nice` (so chat
+    requests in the web process get the CPU first), limits torch threads and
+    loads EasyOCR once per worker.
+    """
+    global _reader
+    import torch
+    import easyocr
+
+    if nice > 0 and hasattr(os, "nice"):
+        os.nice(nice)
+    # Each worker gets a small slice of the CPU; the pool provides the parallelism
+    torch.set_num_threads(torch_threads)
+    _reader = easyocr.Reader(['en'], gpu=False)
+
+
+def render_page(page, zoom=2.0):
+    """
+    Renders a PDF page to an RGB NumPy array straight from the pixmap samples,
+    without a PNG encode/decode round trip.
+    """
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False)
+    rows = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+    # Drop any row padding so the array is exactly height x width x channels
+    return rows[:, :pix.width * pix.n].reshape(pix.height, pix.width, pix.n)
+
+
+def read_text(reader, img_array):
+    """Runs OCR on an image array and joins the detected lines."""
+    ocr_results = reader.readtext(img_array)
+    return "\n".join([result[1] for result in ocr_results])
+
+
+def ocr_pdf_page(path, page_num, zoom=2.0):
+    """Renders page `page_num` (0-based) of the PDF at `path` and returns its OCR text."""
+    with fitz.open(path, filetype="pdf") as doc:
+        img_array = render_page(doc[page_num], zoom)
+    return read_text(_reader, img_array)
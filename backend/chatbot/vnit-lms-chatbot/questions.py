@@ -0,0 +1,400 @@
+"""Question generation for professors: retrieval, prompting, validation and caching."""
+import time
+import hashlib
+import re
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (
+    GROQ_MODEL, QUESTION_CONTEXT_CHUNKS, QUESTIONS_PER_CALL, QUESTION_RETRY_ROUNDS, QUESTION_FANOUT_WORKERS,
+    QUESTION_CACHE_TTL, QUESTION_CONTEXT_TOKEN_BUDGET,
+)
+from telemetry import CACHE_LOOKUPS, log_event, timed_stage, traced_submit
+from state_db import get_state_db
+from groq_keys import groq_pool
+from models import serving_index
+from retrieval import normalize_query, embed_query, search_chunks, build_context
+from admission import interactive_cpu_work
+
+
+# --- 1. QUESTION GENERATION ---
+
+QUESTION_TYPE_DESCRIPTIONS = {
+    "mcq_single": "multiple choice with a single correct answer (provide 4 options)",
+    "mcq_multiple": "multiple choice with multiple correct answers (provide 4-5 options, at least 2 correct)",
+    "numerical": "numerical answer question (requires a number as answer)"
+}
+
+DIFFICULTY_INSTRUCTIONS = {
+    "easy": "Basic concepts and definitions",
+    "medium": "Application and understanding of concepts",
+    "hard": "Analysis, synthesis, and complex problem-solving"
+}
+
+NO_MATERIALS_ERROR = "No relevant course materials found for this topic. Please ensure materials have been ingested."
+
+def read_question_request(data):
+    """
+    Reads and validates a question generation request body.
+    Returns (params, error_message); exactly one of them is None.
+    """
+    params = {
+        "topic": data.get("topic", ""),
+        "question_type": data.get("questionType", "mcq_single"),  # mcq_single, mcq_multiple, numerical
+        "num_questions": data.get("numQuestions", 1),
+        "difficulty": data.get("difficulty", "medium"),  # easy, medium, hard
+    }
+    if not params["topic"]:
+        return None, "Topic is required"
+    if params["num_questions"] < 1 or params["num_questions"] > 10:
+        return None, "Number of questions must be between 1 and 10"
+    return params, None
+
+def retrieve_question_context(topic, scope=None):
+    """Returns the chunks retrieved for a question generation topic, within the course/material `scope`."""
+    with interactive_cpu_work():
+        # One index for the whole request, even if the alias is swapped meanwhile
+        index = serving_index()
+        # 1. Vectorize the topic to find relevant context
+        with timed_stage("embed"):
+            topic_vector = embed_query(topic, index)
+
+        # 2. Query ChromaDB to find relevant context
+        print("Searching for relevant context...")
+        with timed_stage("retrieve"):
+            hits = search_chunks(
+                topic,
+                topic_vector,
+                n_results=QUESTION_CONTEXT_CHUNKS,  # Get more context for better question generation
+                scope=scope,
+                index=index
+            )
+            passages, _ = build_context(hits, QUESTION_CONTEXT_TOKEN_BUDGET)
+    return passages
+
+def build_question_messages(topic, question_type, num_questions, difficulty, context):
+    """Builds the Groq messages asking for `num_questions` questions about `topic` from `context`."""
+    system_prompt = f"""
+        You are an expert quiz question generator for the VNIT Learning Management System.
+        Your task is to generate high-quality quiz questions based ONLY on the provided course materials.
+        
+        Instructions:
+        1. Generate {num_questions} {QUESTION_TYPE_DESCRIPTIONS.get(question_type, 'multiple choice')} question(s).
+        2. Difficulty level: {DIFFICULTY_INSTRUCTIONS.get(difficulty, 'medium')}
+        3. Base questions STRICTLY on the provided context. Do not use external knowledge.
+        4. Questions should test understanding of the topic: "{topic}"
+        5. For MCQ questions, make distractors plausible but clearly incorrect.
+        6. For numerical questions, provide the exact numerical answer.
+        7. Include brief explanations for why the answer is correct.
+        
+        Format your response as a JSON array with this structure:
+        [
+            {{
+                "questionText": "The question text here",
+                "questionType": "{question_type}",
+                "options": ["Option A", "Option B", "Option C", "Option D"],  // Only for MCQ types
+                "correctAnswer": "Option A",  // For mcq_single or numerical value for numerical
+                "correctAnswers": ["Option A", "Option B"],  // For mcq_multiple
+                "points": 1,
+                "explanation": "Brief explanation of why this is correct"
+            }}
+        ]
+        
+        Return ONLY valid JSON, no additional text.
+        """
+    
+    final_prompt = f"""
+        {system_prompt}
+        
+        ---
+        Course Materials Context:
+        {context}
+        ---
+        
+        Topic: {topic}
+        
+        Generate {num_questions} question(s) now:
+        """
+    return [
+        {"role": "system", "content": "You are a helpful assistant that generates quiz questions. Always return valid JSON arrays."},
+        {"role": "user", "content": final_prompt}
+    ]
+
+def parse_question_json(response_text):
+    """Extracts the list of question objects from the LLM response. Raises on invalid JSON."""
+    # Clean the response - remove markdown code blocks if present
+    cleaned_text = response_text.strip()
+    if cleaned_text.startswith('```json'):
+        cleaned_text = cleaned_text[7:]
+    elif cleaned_text.startswith('```'):
+        cleaned_text = cleaned_text[3:]
+    if cleaned_text.endswith('```'):
+        cleaned_text = cleaned_text[:-3]
+    cleaned_text = cleaned_text.strip()
+    
+    # Try to extract JSON from response
+    if cleaned_text.startswith('['):
+        return json.loads(cleaned_text)
+    if cleaned_text.startswith('{'):
+        # Single question wrapped in object or questions key
+        obj = json.loads(cleaned_text)
+        if 'questions' in obj:
+            return obj['questions']
+        if 'question' in obj:
+            return [obj['question']]
+        # Treat the whole object as a single question
+        return [obj]
+    # Try to find JSON array in the response
+    json_match = re.search(r'\[.*\]', cleaned_text, re.DOTALL)
+    if json_match:
+        return json.loads(json_match.group())
+    # Try to find JSON object
+    json_match = re.search(r'\{.*\}', cleaned_text, re.DOTALL)
+    if json_match:
+        obj = json.loads(json_match.group())
+        return [obj] if isinstance(obj, dict) else obj
+    raise ValueError("Could not find JSON in response")
+
+def validate_question(q, question_type):
+    """Normalizes one generated question in place. Returns False if it is unusable."""
+    if not isinstance(q, dict):
+        return False
+    
+    # Ensure required fields
+    if 'questionText' not in q or 'questionType' not in q:
+        return False
+    
+    # Set question type
+    q['questionType'] = question_type
+    
+    # Ensure points
+    if 'points' not in q:
+        q['points'] = 1
+    
+    # Validate based on type
+    if question_type in ['mcq_single', 'mcq_multiple']:
+        if 'options' not in q or not isinstance(q['options'], list) or len(q['options']) < 2:
+            return False
+        if question_type == 'mcq_single':
+            if 'correctAnswer' not in q:
+                return False
+        else:
+            if 'correctAnswers' not in q or not isinstance(q['correctAnswers'], list):
+                return False
+    elif question_type == 'numerical':
+        if 'correctAnswer' not in q:
+            return False
+        # Convert to number
+        try:
+            q['correctAnswer'] = float(q['correctAnswer'])
+        except:
+            return False
+    
+    return True
+
+def parse_generated_questions(response_text, question_type):
+    """Parses the LLM response and returns only the questions that pass validation."""
+    return [q for q in parse_question_json(response_text) if validate_question(q, question_type)]
+
+def plan_question_slots(num_questions, passages):
+    """
+    Splits a request into slots of QUESTIONS_PER_CALL questions, one Groq call
+    each, and gives every slot its own slice of the context passages. There are
+    never more slots than passages: with few passages each slot asks for more
+    questions rather than two slots sending the same prompt.
+    """
+    calls = max(1, min(-(-num_questions // QUESTIONS_PER_CALL), len(passages)))
+    base, extra = divmod(num_questions, calls)
+    return [
+        {"count": base + (1 if i < extra else 0), "context": "\n\n".join(passages[i::calls])}
+        for i in range(calls)
+    ]
+
+class QuestionSetBuilder:
+    """
+    Collects the questions of one generation request across rounds of
+    concurrent Groq calls. A slot whose answer is short of valid questions
+    (bad JSON, failed validation, duplicates or an API error) is asked again
+    for just the missing questions, up to QUESTION_RETRY_ROUNDS times.
+    The caller runs each round's calls (in threads or as coroutines).
+    """
+
+    def __init__(self, params, passages, existing=()):
+        self.params = params
+        self.pending = plan_question_slots(params["num_questions"], passages)
+        self.questions = []
+        self.existing = list(existing)
+        self._seen = {self._text_key(q) for q in self.existing}
+        self.rounds = 0
+        self.calls = 0
+        self.last_error = None
+
+    @staticmethod
+    def _text_key(question):
+        return normalize_query(str(question.get("questionText", "")))
+
+    def next_round(self):
+        """Returns the slots to request in the next round; empty when done or out of retries."""
+        if not self.pending or self.rounds > QUESTION_RETRY_ROUNDS:
+            return []
+        self.rounds += 1
+        slots, self.pending = self.pending, []
+        self.calls += len(slots)
+        return slots
+
+    def messages(self, slot):
+        messages = build_question_messages(context=slot["context"], **{**self.params, "num_questions": slot["count"]})
+        # Keep retries and top-ups from repeating questions the professor already has
+        known = [q["questionText"] for q in self.existing + self.questions]
+        if known:
+            listing = "\n".join(f"- {text}" for text in known)
+            messages[-1]["content"] += f"\nDo not repeat any of these existing questions:\n{listing}\n"
+        return messages
+
+    def completion_request(self, slot):
+        """The arguments of the Groq call for `slot`."""
+        return {
+            "messages": self.messages(slot),
+            "model": GROQ_MODEL,
+            "temperature": 0.7,  # Slightly creative but still focused
+        }
+
+    def record(self, slot, response_text=None, error=None):
+        """Takes the valid, new questions from one call; re-queues the slot for any that are missing."""
+        accepted = 0
+        if error is None:
+            try:
+                for question in parse_generated_questions(response_text, self.params["question_type"]):
+                    key = self._text_key(question)
+                    if accepted == slot["count"] or key in self._seen:
+                        continue
+                    self._seen.add(key)
+                    self.questions.append(question)
+                    accepted += 1
+            except (json.JSONDecodeError, ValueError) as e:
+                error = e
+        if error is not None:
+            self.last_error = error
+            log_event("question_slot_failed", questions=slot["count"], error=str(error))
+        if accepted < slot["count"]:
+            self.pending.append({**slot, "count": slot["count"] - accepted})
+
+# Groq calls of all question generation requests in this process
+question_executor = ThreadPoolExecutor(max_workers=QUESTION_FANOUT_WORKERS, thread_name_prefix="questions")
+
+def request_questions(completion_request):
+    chat_completion = groq_pool.create_chat_completion(**completion_request)
+    return chat_completion.choices[0].message.content
+
+def generate_question_set(builder):
+    """Runs the rounds of a QuestionSetBuilder, each round's Groq calls concurrently; returns the builder."""
+    while True:
+        slots = builder.next_round()
+        if not slots:
+            return builder
+        futures = [(slot, traced_submit(question_executor, request_questions, builder.completion_request(slot)))
+                   for slot in slots]
+        for slot, future in futures:
+            try:
+                builder.record(slot, future.result())
+            except Exception as e:
+                builder.record(slot, error=e)
+
+def question_cache_key(params, passages):
+    """Question sets are cached by (topic, type, difficulty, hash of the retrieved context)."""
+    context_sha256 = hashlib.sha256("\n\n".join(passages).encode("utf-8")).hexdigest()
+    key = f"{normalize_query(params['topic'])}|{params['question_type']}|{params['difficulty']}|{context_sha256}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+def get_cached_questions(cache_key):
+    row = get_state_db().execute(
+        "SELECT questions FROM question_cache WHERE cache_key = ? AND updated_at > ?",
+        (cache_key, time.time() - QUESTION_CACHE_TTL),
+    ).fetchone()
+    CACHE_LOOKUPS.labels("questions", "hit" if row else "miss").inc()
+    return json.loads(row[0]) if row else []
+
+def save_cached_questions(cache_key, params, questions):
+    now = time.time()
+    with get_state_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO question_cache (cache_key, topic, question_type, difficulty, questions, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (cache_key, params["topic"], params["question_type"], params["difficulty"], json.dumps(questions), now),
+        )
+        conn.execute("DELETE FROM question_cache WHERE updated_at < ?", (now - QUESTION_CACHE_TTL,))
+
+def read_refresh_flag(data):
+    """`refresh: true` in a generation request skips the cached question set and replaces it."""
+    return data.get("refresh") in (True, "true", "1", 1)
+
+class QuestionRequest:
+    """
+    One question generation request: retrieval, the question cache and the
+    response around the Groq calls. answer_question_request here and in
+    asgi.py drive it; they only differ in how they wait for the blocking steps
+    and run the builder's calls.
+    """
+
+    def __init__(self, params, scope, refresh):
+        self.params = params
+        self.scope = scope
+        self.refresh = refresh
+        self.builder = None  # set by prepare() when questions have to be generated
+
+    def prepare(self):
+        """
+        Retrieves the context and the cached questions (blocking). Returns the
+        (response body, status code) if no Groq call is needed, else None.
+        """
+        num_questions = self.params["num_questions"]
+        self.context_chunks = retrieve_question_context(self.params["topic"], self.scope)
+        if not self.context_chunks:
+            print("No relevant context found in database.")
+            return {"error": NO_MATERIALS_ERROR}, 404
+
+        self.cache_key = question_cache_key(self.params, self.context_chunks)
+        self.cached = [] if self.refresh else get_cached_questions(self.cache_key)
+        if len(self.cached) >= num_questions:
+            log_event("question_cache_hit", questions=num_questions)
+            return {"questions": self.cached[:num_questions], "cached_questions": num_questions}, 200
+
+        # 3. Call Groq LLM, one call per slot of questions, only for what the cache doesn't have
+        missing = num_questions - len(self.cached)
+        log_event("question_generation", questions=missing, cached_questions=len(self.cached))
+        self.builder = QuestionSetBuilder({**self.params, "num_questions": missing}, self.context_chunks, self.cached)
+        return None
+
+    def finish(self):
+        """Caches the generated questions (blocking). Returns (response body, status code)."""
+        builder = self.builder
+        log_event("questions_generated", questions=len(builder.questions), calls=builder.calls, rounds=builder.rounds)
+
+        # 4. Cache and return the validated questions
+        questions = self.cached + builder.questions
+        if builder.questions:
+            save_cached_questions(self.cache_key, self.params, questions)
+        if not questions:
+            return {"error": "Failed to generate valid questions. Please try again."}, 500
+        return {"questions": questions[:self.params["num_questions"]], "cached_questions": len(self.cached)}, 200
+
+    @staticmethod
+    def failed(error):
+        """The response for an unexpected error while answering the request."""
+        log_event("error", where="generate_questions", error=str(error))
+        import traceback
+        traceback.print_exc()
+        return {"error": f"An internal error occurred: {error}"}, 500
+
+
+def answer_question_request(params, scope, refresh):
+    """Retrieves context and generates (or reuses) the questions. Returns (response body, status code)."""
+    question_request = QuestionRequest(params, scope, refresh)
+    try:
+        response = question_request.prepare()
+        if response is not None:
+            return response
+        generate_question_set(question_request.builder)
+        return question_request.finish()
+    except Exception as e:
+        return question_request.failed(e)
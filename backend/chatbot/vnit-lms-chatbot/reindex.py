@@ -0,0 +1,119 @@
+"""
+Zero-downtime reindexing of the chatbot's search index.
+
+    python reindex.py status
+    python reindex.py build [--embedding-model M] [--chunk-size N] [--chunk-overlap N] [--name NAME]
+    python reindex.py verify NAME
+    python reindex.py swap NAME [--force]
+    python reindex.py rollback
+    python reindex.py drop NAME
+
+`build` creates a shadow collection next to the live one and fills it from the
+document text kept in the state database (nothing is downloaded or OCR'd
+again), re-chunking and re-embedding at low priority, then verifies it. The
+service keeps answering from the live index meanwhile. `swap` moves the index
+alias to the shadow index; every worker follows within a second or so, once it
+has loaded the new embedding model. `rollback` moves the alias back, and `drop`
+deletes an index that is no longer needed.
+
+Run it where the service's STATE_DB_PATH and CHROMA_DB_PATH live (e.g. a
+Render shell). In pre-fork mode it talks to the running Chroma server.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.request
+
+
+def find_chroma_server():
+    """In pre-fork mode the Chroma server owns chroma.sqlite3; use it instead of opening the files."""
+    if os.environ.get("CHROMA_SERVER_URL"):
+        return
+    url = f"http://127.0.0.1:{os.environ.get('CHROMA_SERVER_PORT', 8001)}"
+    for path in ("/api/v2/heartbeat", "/api/v1/heartbeat"):
+        try:
+            with urllib.request.urlopen(url + path, timeout=2) as response:
+                if response.status == 200:
+                    os.environ["CHROMA_SERVER_URL"] = url
+                    return
+        except Exception:
+            pass
+
+
+def build(args):
+    from config import COLLECTION_NAME
+    from indexes import build_index, create_search_index
+    from models import active_index, get_search_index
+
+    live = active_index()
+    settings = {
+        "embedding_model": args.embedding_model or live["embedding_model"],
+        "chunk_size": args.chunk_size or live["chunk_size"],
+        "chunk_overlap": live["chunk_overlap"] if args.chunk_overlap is None else args.chunk_overlap,
+    }
+    index = get_search_index(args.name) if args.name else None
+    if index is None:
+        name = args.name or f"{COLLECTION_NAME}_{time.strftime('%Y%m%d%H%M%S')}"
+        index = create_search_index(name, **settings)
+    elif index["name"] == live["name"]:
+        raise ValueError(f"'{index['name']}' is the live index; build a new one instead.")
+    elif any(getattr(args, field) is not None and index[field] != value for field, value in settings.items()):
+        raise ValueError(f"Index '{index['name']}' exists with other settings: {index}")
+    else:
+        print(f"Resuming the build of '{index['name']}'.")
+    return dict(build_index(index), index=index["name"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build, verify and swap the chatbot's search index.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="list the indexes and which one is live")
+    build_parser = commands.add_parser("build", help="build and verify a shadow index (resumes NAME if it exists)")
+    build_parser.add_argument("--embedding-model", help="SentenceTransformer model (default: the live index's)")
+    build_parser.add_argument("--chunk-size", type=int, help="characters per chunk (default: the live index's)")
+    build_parser.add_argument("--chunk-overlap", type=int, help="characters shared by neighbouring chunks")
+    build_parser.add_argument("--name", help="collection name (default: <COLLECTION_NAME>_<timestamp>)")
+    verify_parser = commands.add_parser("verify", help="verify a built index again")
+    verify_parser.add_argument("name")
+    swap_parser = commands.add_parser("swap", help="make a verified index live")
+    swap_parser.add_argument("name")
+    swap_parser.add_argument("--force", action="store_true", help="swap even if the index is unverified")
+    commands.add_parser("rollback", help="make the previous index live again")
+    drop_parser = commands.add_parser("drop", help="delete an index that isn't live")
+    drop_parser.add_argument("name")
+    args = parser.parse_args()
+
+    find_chroma_server()
+    from indexes import drop_index, list_search_indexes, rollback_index, run_in_background, swap_index, verify_index
+    from models import get_search_index
+
+    try:
+        if args.command == "status":
+            result = list_search_indexes()
+        elif args.command == "build":
+            run_in_background()
+            result = build(args)
+        elif args.command == "verify":
+            index = get_search_index(args.name)
+            if index is None:
+                raise ValueError(f"Unknown index '{args.name}'.")
+            run_in_background()
+            result = verify_index(index)
+        elif args.command == "swap":
+            result = swap_index(args.name, force=args.force)
+        elif args.command == "rollback":
+            result = rollback_index()
+        else:
+            drop_index(args.name)
+            result = list_search_indexes()
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    print(json.dumps(result, indent=2))
+    return 0 if result.get("passed", True) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,468 @@
+"""
+Query embedding (micro-batched), hybrid vector and lexical search, reranking
+and context assembly for chat and question generation.
+"""
+import threading
+import queue
+import time
+import hashlib
+import re
+import json
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import numpy as np
+
+from config import (
+    EMBED_BATCH_MAX_SIZE, EMBED_BATCH_MAX_WAIT_MS, RETRIEVAL_CACHE_TTL, HYBRID_SEARCH_ENABLED,
+    HYBRID_CANDIDATES, RRF_K, RERANK_ENABLED, RERANK_MODEL, RERANK_CANDIDATES, RERANK_TIMEOUT_MS,
+    RERANK_SCORE_CACHE_SIZE, NEAR_DUPLICATE_SIMILARITY,
+)
+from telemetry import STAGE_LATENCY, QUEUE_DEPTH, log_event, timed_stage
+from state_db import lexical_index_status, get_state_db
+from models import (
+    serving_index, components, get_embedding_model, get_collection, collection_change_listeners,
+    collection_reload_listeners, sync_collection_version,
+)
+from caches import TTLCache, query_embedding_cache, retrieval_cache
+
+
+# --- 1. QUERY EMBEDDING SERVICE ---
+
+class PendingEncode:
+    """One caller waiting for the embedding of `text` by `model_name`."""
+
+    def __init__(self, text, model_name):
+        self.text = text
+        self.model_name = model_name
+        self.enqueued_at = time.monotonic()
+        self.done = threading.Event()
+        self.vector = None
+        self.error = None
+
+
+class EmbeddingBatcher:
+    """
+    Gathers query-embedding requests from concurrent request threads into
+    micro-batches, encodes each batch with one model call and hands every
+    caller back its own vector.
+    """
+
+    def __init__(self, encode_batch, max_batch_size=32, max_wait_ms=5, name="query_embedding"):
+        self._encode_batch = encode_batch
+        self._depth = QUEUE_DEPTH.labels(name)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._requests = 0
+        self._largest_batch = 0
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+        self._total_encode = 0.0
+
+    def _ensure_started(self):
+        # Started lazily so a forked worker process gets its own batching thread
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+
+    def encode(self, text, model_name, timeout=30):
+        """Returns the embedding of `text` by `model_name` as a list of floats."""
+        self._ensure_started()
+        pending = PendingEncode(text, model_name)
+        self._queue.put(pending)
+        self._depth.inc()
+        if not pending.done.wait(timeout):
+            raise TimeoutError("Timed out waiting for the query embedding.")
+        if pending.error is not None:
+            raise pending.error
+        return pending.vector
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # Past the deadline: only take what is already waiting
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._depth.dec(len(batch))
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            started = time.monotonic()
+            # Right after an index swap, callers may still ask for the old model
+            by_model = {}
+            for pending in batch:
+                by_model.setdefault(pending.model_name, []).append(pending)
+            for model_name, group in by_model.items():
+                try:
+                    vectors = self._encode_batch([pending.text for pending in group], model_name)
+                    for pending, vector in zip(group, vectors):
+                        pending.vector = vector.tolist()
+                except Exception as e:
+                    for pending in group:
+                        pending.error = e
+            finished = time.monotonic()
+            for pending in batch:
+                pending.done.set()
+            self._record(batch, started, finished)
+
+    def _record(self, batch, started, finished):
+        waits = [started - pending.enqueued_at for pending in batch]
+        for wait in waits:
+            STAGE_LATENCY.labels("embed_queue_wait").observe(wait)
+        STAGE_LATENCY.labels("embed_batch_encode").observe(finished - started)
+        with self._stats_lock:
+            self._batches += 1
+            self._requests += len(batch)
+            self._largest_batch = max(self._largest_batch, len(batch))
+            self._total_wait += sum(waits)
+            self._max_wait_seen = max(self._max_wait_seen, max(waits))
+            self._total_encode += finished - started
+
+    @property
+    def queued(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._stats_lock:
+            batches = self._batches or 1
+            requests = self._requests or 1
+            return {
+                "batches": self._batches,
+                "requests": self._requests,
+                "queued": self._queue.qsize(),
+                "avg_batch_size": round(self._requests / batches, 2),
+                "max_batch_size": self._largest_batch,
+                "avg_queue_wait_ms": round(1000 * self._total_wait / requests, 2),
+                "max_queue_wait_ms": round(1000 * self._max_wait_seen, 2),
+                "avg_encode_ms": round(1000 * self._total_encode / batches, 2),
+            }
+
+
+def encode_query_batch(texts, model_name):
+    return get_embedding_model(model_name).encode(texts, batch_size=EMBED_BATCH_MAX_SIZE)
+
+
+query_embedder = EmbeddingBatcher(encode_query_batch, EMBED_BATCH_MAX_SIZE, EMBED_BATCH_MAX_WAIT_MS)
+
+
+# --- 2. CACHED QUERIES ---
+
+def normalize_query(text):
+    """Lowercases and collapses whitespace so trivially different spellings share a cache entry."""
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+def embed_query(text, index=None):
+    """Returns the query embedding for `text` by the model of `index` (default: the serving one), from the cache when possible."""
+    model_name = (index or serving_index())["embedding_model"]
+    text = normalize_query(text)
+    key = (model_name, text)
+    vector = query_embedding_cache.get(key)
+    if vector is None:
+        vector = query_embedder.encode(text, model_name)
+        query_embedding_cache.set(key, vector)
+    return vector
+
+def query_collection(query_vector, n_results, where=None, collection_name=None):
+    """Runs collection.query for one vector, caching the result until the collection changes."""
+    sync_collection_version()
+    collection_name = collection_name or serving_index()["name"]
+    vector_key = hashlib.sha1(np.asarray(query_vector, dtype=np.float32).tobytes()).hexdigest()
+    key = (collection_name, vector_key, n_results, json.dumps(where, sort_keys=True))
+    results = retrieval_cache.get(key)
+    if results is None:
+        generation = retrieval_cache.generation
+        query_args = {"query_embeddings": [query_vector], "n_results": n_results}
+        if where:
+            query_args["where"] = where
+        results = get_collection(collection_name).query(**query_args)
+        retrieval_cache.set(key, results, generation)
+    return results
+
+# Request fields that scope ingested chunks and searches to a course / material
+SCOPE_FIELDS = ("courseId", "materialId")
+# Stored for a scope field a chunk was ingested without; such chunks match every scope
+UNSCOPED = ""
+
+def read_scope(data, allow_lists=False):
+    """
+    Reads the optional courseId / materialId scope from a request body.
+    Query endpoints (allow_lists=True) may also pass a list of IDs for either field.
+    Returns (scope, error_message); scope holds only the fields that were given.
+    """
+    scope = {}
+    for field in SCOPE_FIELDS:
+        value = data.get(field)
+        if value is None or value == "" or value == []:
+            continue
+        values = value if allow_lists and isinstance(value, list) else [value]
+        if not all(isinstance(v, (str, int)) and not isinstance(v, bool) for v in values):
+            kind = "a string or a list of strings" if allow_lists else "a string"
+            return None, f"'{field}' must be {kind}"
+        scope[field] = [str(v) for v in values] if isinstance(value, list) else str(value)
+    return scope, None
+
+def scope_values(value):
+    """The stored values a scope field matches: the requested ID(s), plus UNSCOPED."""
+    return (value if isinstance(value, list) else [value]) + [UNSCOPED]
+
+def scope_filter(scope):
+    """Turns a scope from read_scope into a Chroma `where` filter, or None for an unscoped search."""
+    clauses = [{field: {"$in": scope_values(value)}} for field, value in (scope or {}).items()]
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+# Words too common in questions to help lexical matching
+LEXICAL_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it me of on or the this to was what when "
+    "where which who why with explain describe define give".split()
+)
+LEXICAL_MAX_TERMS = 32
+
+def lexical_search(query_text, n_results, scope=None):
+    """
+    Ranks chunks by BM25 against the terms of `query_text`, within `scope`.
+    Returns [(chunk_id, text, metadata)], best first; cached until the collection changes.
+    """
+    conn = get_state_db()
+    if not lexical_index_status["available"]:
+        return []
+    # Keep "4.2" or "CS-101" together; FTS5 matches them as phrases
+    terms = [term for term in re.findall(r"\w+(?:[.\-]\w+)*", query_text.lower()) if term not in LEXICAL_STOPWORDS]
+    if not terms:
+        return []
+    match = " OR ".join(f'"{term}"' for term in list(dict.fromkeys(terms))[:LEXICAL_MAX_TERMS])
+
+    key = ("lexical", match, n_results, json.dumps(scope or {}, sort_keys=True))
+    hits = retrieval_cache.get(key)
+    if hits is not None:
+        return hits
+    generation = retrieval_cache.generation
+    sql = ("SELECT c.chunk_id, lexical_index.text, c.metadata FROM lexical_index "
+           "JOIN lexical_chunks c ON c.rowid = lexical_index.rowid WHERE lexical_index MATCH ?")
+    args = [match]
+    for field, column in (("courseId", "course_id"), ("materialId", "material_id")):
+        value = (scope or {}).get(field)
+        if value is None:
+            continue
+        values = scope_values(value)
+        sql += f" AND c.{column} IN ({','.join('?' * len(values))})"
+        args.extend(values)
+    sql += " ORDER BY bm25(lexical_index) LIMIT ?"
+    args.append(n_results)
+    hits = [(chunk_id, text, json.loads(metadata))
+            for chunk_id, text, metadata in conn.execute(sql, args).fetchall()]
+    retrieval_cache.set(key, hits, generation)
+    return hits
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """Merges ranked lists of chunk IDs; an ID scores 1 / (k + rank) in each list it appears in."""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+def search_chunks(query_text, query_vector, n_results, scope=None, index=None):
+    """
+    Retrieves the `n_results` best chunks for a query within `scope` from
+    `index` (default: the serving one; `query_vector` must come from its model):
+    vector hits, fused with BM25 hits when HYBRID_SEARCH_ENABLED, then
+    reordered by the cross-encoder when RERANK_ENABLED.
+    Returns a list of {"id", "document", "metadata", "distance"} dicts, best first
+    ("distance" is None for chunks found only by the lexical index).
+    """
+    candidates = n_results
+    if HYBRID_SEARCH_ENABLED:
+        candidates = max(candidates, HYBRID_CANDIDATES)
+    if RERANK_ENABLED:
+        candidates = max(candidates, RERANK_CANDIDATES)
+    with timed_stage("vector_search"):
+        results = query_collection(query_vector, n_results=candidates, where=scope_filter(scope),
+                                   collection_name=(index or serving_index())["name"])
+    ids = results['ids'][0]
+    distances = (results.get('distances') or [[]])[0] or [None] * len(ids)
+    metadatas = (results.get('metadatas') or [[]])[0] or [None] * len(ids)
+    hits = {}
+    for chunk_id, document, metadata, distance in zip(ids, results['documents'][0], metadatas, distances):
+        hits[chunk_id] = {"id": chunk_id, "document": document, "metadata": metadata or {}, "distance": distance}
+    ranked = list(hits.values())
+
+    if HYBRID_SEARCH_ENABLED:
+        with timed_stage("lexical_search"):
+            lexical_hits = lexical_search(query_text, candidates, scope)
+        for chunk_id, document, metadata in lexical_hits:
+            hits.setdefault(chunk_id, {"id": chunk_id, "document": document, "metadata": metadata, "distance": None})
+        ranking = reciprocal_rank_fusion([ids, [hit[0] for hit in lexical_hits]])
+        ranked = [hits[chunk_id] for chunk_id in ranking]
+
+    if RERANK_ENABLED:
+        with timed_stage("rerank"):
+            ranked = rerank_hits(query_text, ranked[:RERANK_CANDIDATES])
+    return ranked[:n_results]
+
+
+# --- 3. CROSS-ENCODER RERANKING ---
+
+# (query hash, chunk id) -> cross-encoder score, cleared when the collection changes
+rerank_score_cache = TTLCache(RERANK_SCORE_CACHE_SIZE, RETRIEVAL_CACHE_TTL, "rerank_scores")
+collection_change_listeners.append(lambda changed_ids: rerank_score_cache.clear())
+collection_reload_listeners.append(rerank_score_cache.clear)
+# One scoring batch at a time; torch already spreads a batch over the CPU threads
+rerank_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+rerank_stats = {"reranked": 0, "fully_cached": 0, "timeouts": 0, "not_ready": 0}
+
+def score_hits(query_key, query_text, hits):
+    """Cross-encoder scores for `hits`, computing only the (query, chunk) pairs that aren't cached."""
+    generation = rerank_score_cache.generation
+    scores = {}
+    missing = []
+    for hit in hits:
+        score = rerank_score_cache.get((query_key, hit["id"]))
+        if score is None:
+            missing.append(hit)
+        else:
+            scores[hit["id"]] = score
+    if missing:
+        predicted = components["reranker"].get().predict(
+            [(query_text, hit["document"]) for hit in missing], batch_size=len(missing)
+        )
+        for hit, score in zip(missing, predicted):
+            scores[hit["id"]] = float(score)
+            rerank_score_cache.set((query_key, hit["id"]), float(score), generation)
+    return scores
+
+def rerank_hits(query_text, hits):
+    """
+    Reorders `hits` by cross-encoder relevance to `query_text`. Returns them
+    unchanged if the model isn't loaded yet or scoring exceeds RERANK_TIMEOUT_MS
+    (the scores still land in the cache for the next identical query).
+    """
+    if not hits:
+        return hits
+    reranker = components["reranker"]
+    if reranker.state != "ready":
+        if reranker.state == "cold":
+            reranker.warm_in_background()
+        rerank_stats["not_ready"] += 1
+        return hits
+
+    query_key = hashlib.sha1(normalize_query(query_text).encode("utf-8")).hexdigest()
+    if all(rerank_score_cache.get((query_key, hit["id"])) is not None for hit in hits):
+        rerank_stats["fully_cached"] += 1
+        scores = score_hits(query_key, query_text, hits)
+    else:
+        future = rerank_executor.submit(score_hits, query_key, query_text, hits)
+        try:
+            scores = future.result(timeout=RERANK_TIMEOUT_MS / 1000)
+        except FutureTimeoutError:
+            rerank_stats["timeouts"] += 1
+            log_event("rerank_timeout", budget_ms=RERANK_TIMEOUT_MS, hits=len(hits))
+            return hits
+    rerank_stats["reranked"] += 1
+    return sorted(hits, key=lambda hit: scores[hit["id"]], reverse=True)
+
+def rerank_status():
+    return {
+        "enabled": RERANK_ENABLED,
+        "model": RERANK_MODEL,
+        "candidates": RERANK_CANDIDATES,
+        "timeout_ms": RERANK_TIMEOUT_MS,
+        "reranker": components["reranker"].status(),
+        **rerank_stats,
+        "score_cache": rerank_score_cache.stats(),
+    }
+
+
+# --- 4. CONTEXT ASSEMBLY ---
+
+# Chunk IDs end in _chunk_<i>, i being the chunk's position in its document
+CHUNK_POSITION_PATTERN = re.compile(r"^(.*)_chunk_(\d+)$")
+MIN_SEAM_OVERLAP = 10  # shorter matches at a seam are treated as coincidence
+
+def estimate_tokens(text):
+    """Rough prompt token count (Llama tokenizers average about 4 characters per token of English)."""
+    return (len(text) + 3) // 4
+
+def merge_overlapping(first, second):
+    """Joins two consecutive chunks of a document, dropping the text the splitter repeated at the seam."""
+    overlap = serving_index()["chunk_overlap"]
+    longest = min(len(first), len(second), overlap + overlap // 2)
+    for size in range(longest, MIN_SEAM_OVERLAP - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + "\n" + second
+
+def word_shingles(text, size=5):
+    words = re.findall(r"\w+", text.lower())
+    return {tuple(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def build_context(hits, token_budget):
+    """
+    Turns ranked retrieval hits (from search_chunks) into prompt passages:
+    1. consecutive chunks of the same document are merged and their overlap removed;
+    2. passages that nearly duplicate a better-ranked passage are dropped;
+    3. passages are packed best-first until `token_budget` estimated tokens are used.
+    Returns (passages, hits_used), both in relevance order; hits_used holds
+    only the hits whose text is (at least partly) in a passage.
+    """
+    positions = []
+    for hit in hits:
+        match = CHUNK_POSITION_PATTERN.match(hit["id"])
+        positions.append((match.group(1), int(match.group(2))) if match else (hit["id"], 0))
+
+    # Runs of consecutive chunks of one document, each a list of ranks in document order
+    runs = []
+    for rank in sorted(range(len(hits)), key=lambda r: positions[r]):
+        document, index = positions[rank]
+        if runs and positions[runs[-1][-1]] == (document, index - 1):
+            runs[-1].append(rank)
+        else:
+            runs.append([rank])
+    # A run is as relevant as its best chunk
+    runs.sort(key=min)
+
+    passages, hits_used, kept_shingles = [], [], []
+    used_tokens = 0
+    for run in runs:
+        text = hits[run[0]]["document"]
+        starts = [0]  # where each chunk's new text begins in the merged passage
+        for rank in run[1:]:
+            starts.append(len(text))
+            text = merge_overlapping(text, hits[rank]["document"])
+        shingles = word_shingles(text)
+        if any(jaccard(shingles, kept) >= NEAR_DUPLICATE_SIMILARITY for kept in kept_shingles):
+            continue
+        tokens = estimate_tokens(text)
+        if used_tokens + tokens > token_budget:
+            if passages:
+                continue  # a shorter, less relevant passage may still fit
+            # Always send the best passage, cut down to the budget; chunks that
+            # start past the cut never reach the prompt
+            text = text[:token_budget * 4]
+            tokens = estimate_tokens(text)
+            run = [rank for rank, start in zip(run, starts) if start < len(text)]
+        passages.append(text)
+        hits_used.extend(hits[rank] for rank in run)
+        kept_shingles.append(shingles)
+        used_tokens += tokens
+    return passages, hits_used
@@ -0,0 +1,263 @@
+"""
+The local SQLite state database: ingestion and embedding caches, ingested
+document records, page checkpoints and the lexical (FTS5) index.
+"""
+import threading
+import time
+import hashlib
+import json
+import sqlite3
+import numpy as np
+
+from config import embedding_cache_key, STATE_DB_PATH
+
+
+# --- 1. LOCAL STATE DATABASE (INGESTION CACHE) ---
+
+STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS extraction_cache (
+    content_sha256 TEXT PRIMARY KEY,
+    file_type TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS extraction_pages (
+    content_sha256 TEXT NOT NULL,
+    page_number INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (content_sha256, page_number)
+);
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    chunk_sha256 TEXT NOT NULL,
+    model TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    PRIMARY KEY (chunk_sha256, model)
+);
+CREATE TABLE IF NOT EXISTS ingested_documents (
+    source_id TEXT PRIMARY KEY,
+    content_sha256 TEXT NOT NULL,
+    file_type TEXT NOT NULL,
+    chunk_config TEXT NOT NULL,
+    chunk_ids TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    scope TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+    job_id TEXT PRIMARY KEY,
+    drive_link TEXT NOT NULL,
+    priority TEXT NOT NULL,
+    priority_rank INTEGER NOT NULL,
+    options TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL,
+    stage TEXT,
+    stage_progress REAL NOT NULL DEFAULT 0,
+    stage_started_at REAL,
+    message TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    stage_timings TEXT NOT NULL DEFAULT '{}',
+    batch_id TEXT,
+    checkpoint TEXT NOT NULL DEFAULT '{}',
+    resumes INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ingest_jobs_queue ON ingest_jobs (status, priority_rank, created_at);
+CREATE INDEX IF NOT EXISTS ingest_jobs_batch ON ingest_jobs (batch_id);
+CREATE TABLE IF NOT EXISTS state_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lexical_chunks (
+    rowid INTEGER PRIMARY KEY,
+    chunk_id TEXT NOT NULL UNIQUE,
+    source_id TEXT NOT NULL,
+    course_id TEXT NOT NULL DEFAULT '',
+    material_id TEXT NOT NULL DEFAULT '',
+    metadata TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS lexical_chunks_source ON lexical_chunks (source_id);
+CREATE TABLE IF NOT EXISTS question_cache (
+    cache_key TEXT PRIMARY KEY,
+    topic TEXT NOT NULL,
+    question_type TEXT NOT NULL,
+    difficulty TEXT NOT NULL,
+    questions TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS answer_cache (
+    entry_id TEXT PRIMARY KEY,
+    question TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    chunk_ids TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS search_indexes (
+    name TEXT PRIMARY KEY,
+    embedding_model TEXT NOT NULL,
+    chunk_size INTEGER NOT NULL,
+    chunk_overlap INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    built_at REAL,
+    verification TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS index_documents (
+    collection TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    content_sha256 TEXT NOT NULL,
+    file_type TEXT NOT NULL,
+    chunk_config TEXT NOT NULL,
+    chunk_ids TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    scope TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (collection, source_id)
+);
+CREATE TABLE IF NOT EXISTS index_lexical_chunks (
+    collection TEXT NOT NULL,
+    chunk_id TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    course_id TEXT NOT NULL DEFAULT '',
+    material_id TEXT NOT NULL DEFAULT '',
+    metadata TEXT NOT NULL DEFAULT '{}',
+    text TEXT NOT NULL,
+    PRIMARY KEY (collection, chunk_id)
+);
+"""
+
+# BM25 inverted index over chunk texts; row i belongs to lexical_chunks row i.
+# Created separately because some SQLite builds lack FTS5.
+LEXICAL_INDEX_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS lexical_index USING fts5(text)"
+lexical_index_status = {"available": True}
+
+# One SQLite connection per thread (connections can't be shared between threads)
+_state_db_local = threading.local()
+
+def get_state_db():
+    """Returns this thread's connection to the state database, creating the tables on first use."""
+    conn = getattr(_state_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(STATE_DB_PATH, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(STATE_DB_SCHEMA)
+        try:
+            conn.execute(LEXICAL_INDEX_SCHEMA)
+        except sqlite3.OperationalError as e:
+            if lexical_index_status["available"]:
+                print(f"[Lexical Index] FTS5 is unavailable ({e}); using vector search only.")
+            lexical_index_status["available"] = False
+        _state_db_local.conn = conn
+    return conn
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def get_cached_extraction(content_sha256):
+    row = get_state_db().execute(
+        "SELECT text FROM extraction_cache WHERE content_sha256 = ?", (content_sha256,)
+    ).fetchone()
+    return row[0] if row else None
+
+def has_cached_extraction(content_sha256):
+    return get_state_db().execute(
+        "SELECT 1 FROM extraction_cache WHERE content_sha256 = ?", (content_sha256,)
+    ).fetchone() is not None
+
+def save_extraction(content_sha256, file_type, text):
+    """Caches the text of a file; its page checkpoints aren't needed any more."""
+    with get_state_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO extraction_cache VALUES (?, ?, ?, ?)",
+            (content_sha256, file_type, text, time.time()),
+        )
+        conn.execute("DELETE FROM extraction_pages WHERE content_sha256 = ?", (content_sha256,))
+
+def get_page_checkpoints(content_sha256):
+    """Returns {page_number: text} for the pages of a file OCR'd by an earlier, interrupted extraction."""
+    rows = get_state_db().execute(
+        "SELECT page_number, text FROM extraction_pages WHERE content_sha256 = ?", (content_sha256,)
+    ).fetchall()
+    return {row["page_number"]: row["text"] for row in rows}
+
+def save_page_checkpoint(content_sha256, page_number, text):
+    with get_state_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO extraction_pages VALUES (?, ?, ?, ?)",
+            (content_sha256, page_number, text, time.time()),
+        )
+
+def get_cached_embeddings(hashes, model_name):
+    """Returns {chunk_sha256: embedding list} for the hashes already embedded by `model_name` on the configured backend."""
+    found = {}
+    unique = list(set(hashes))
+    conn = get_state_db()
+    # Stay under SQLite's bound-parameter limit
+    for start in range(0, len(unique), 500):
+        batch = unique[start:start + 500]
+        placeholders = ",".join("?" * len(batch))
+        rows = conn.execute(
+            f"SELECT chunk_sha256, embedding FROM embedding_cache "
+            f"WHERE model = ? AND chunk_sha256 IN ({placeholders})",
+            [embedding_cache_key(model_name), *batch],
+        ).fetchall()
+        for key, blob in rows:
+            found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+    return found
+
+def save_embeddings(hashes, embeddings, model_name):
+    cache_key = embedding_cache_key(model_name)
+    with get_state_db() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO embedding_cache VALUES (?, ?, ?)",
+            [(h, cache_key, np.asarray(e, dtype=np.float32).tobytes())
+             for h, e in zip(hashes, embeddings)],
+        )
+
+def get_ingested_document(source_id):
+    row = get_state_db().execute(
+        "SELECT content_sha256, file_type, chunk_config, chunk_ids, scope FROM ingested_documents WHERE source_id = ?",
+        (source_id,),
+    ).fetchone()
+    if not row:
+        return None
+    return {
+        "content_sha256": row[0],
+        "file_type": row[1],
+        "chunk_config": row[2],
+        "chunk_ids": json.loads(row[3]),
+        "scope": json.loads(row[4]),
+    }
+
+def save_ingested_document(source_id, content_sha256, file_type, chunk_ids, chunk_config, scope=None):
+    with get_state_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO ingested_documents "
+            "(source_id, content_sha256, file_type, chunk_config, chunk_ids, updated_at, scope) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (source_id, content_sha256, file_type, chunk_config, json.dumps(chunk_ids), time.time(),
+             json.dumps(scope or {}, sort_keys=True)),
+        )
+
+def index_chunks(source_id, chunk_ids, text_chunks, metadatas):
+    """Replaces the lexical index entries of `source_id` with the given chunks."""
+    conn = get_state_db()
+    if not lexical_index_status["available"]:
+        return
+    with conn:
+        rowids = [(row[0],) for row in conn.execute(
+            "SELECT rowid FROM lexical_chunks WHERE source_id = ?", (source_id,)
+        )]
+        conn.executemany("DELETE FROM lexical_index WHERE rowid = ?", rowids)
+        conn.executemany("DELETE FROM lexical_chunks WHERE rowid = ?", rowids)
+        for chunk_id, text, metadata in zip(chunk_ids, text_chunks, metadatas):
+            cursor = conn.execute(
+                "INSERT INTO lexical_chunks (chunk_id, source_id, course_id, material_id, metadata) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (chunk_id, source_id, metadata.get("courseId", ""), metadata.get("materialId", ""),
+                 json.dumps(metadata)),
+            )
+            conn.execute("INSERT INTO lexical_index (rowid, text) VALUES (?, ?)", (cursor.lastrowid, text))
@@ -0,0 +1,149 @@
+"""Prometheus metrics, structured log events and per-request stage timings."""
+import os
+import threading
+import time
+import uuid
+import re
+import contextvars
+import cProfile
+from contextlib import contextmanager
+import json
+from prometheus_client import Counter, Gauge, Histogram
+
+from config import PROFILING_ENABLED, PROFILE_DIR, UNLOGGED_ROUTES
+
+
+# --- 1. METRICS AND REQUEST TRACING ---
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+HTTP_REQUESTS = Counter("chatbot_http_requests_total", "HTTP requests served.", ["route", "method", "status"])
+HTTP_LATENCY = Histogram("chatbot_http_request_seconds", "HTTP request latency (streams: until the last event).",
+                         ["route"], buckets=LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge("chatbot_requests_in_flight", "HTTP requests being served.", multiprocess_mode="livesum")
+STAGE_LATENCY = Histogram("chatbot_stage_seconds", "Time spent in one stage of a request or ingestion job.",
+                          ["stage"], buckets=LATENCY_BUCKETS)
+CACHE_LOOKUPS = Counter("chatbot_cache_lookups_total", "Cache lookups by cache and result.", ["cache", "result"])
+QUEUE_DEPTH = Gauge("chatbot_queue_depth", "Items waiting in an in-process queue.", ["queue"],
+                    multiprocess_mode="livesum")
+INGEST_QUEUED_JOBS = Gauge("chatbot_ingest_queued_jobs", "Ingestion jobs waiting in the state database.",
+                           multiprocess_mode="mostrecent")
+INGEST_JOBS = Counter("chatbot_ingest_jobs_total", "Ingestion jobs finished, by status.", ["status"])
+GROQ_REQUESTS = Counter("chatbot_groq_requests_total", "Groq API calls by key and outcome.", ["key", "outcome"])
+GROQ_TOKENS = Counter("chatbot_groq_tokens_total", "Groq tokens used by key and kind.", ["key", "kind"])
+SINGLE_FLIGHT_REQUESTS = Counter("chatbot_single_flight_requests_total",
+                                 "Requests that started (leader) or joined (follower) a coalesced flight.",
+                                 ["group", "role"])
+ADMISSION_DECISIONS = Counter("chatbot_admission_total",
+                              "Requests admitted or refused, by lane and outcome "
+                              "(admitted, queued, queue_full, wait_exceeded, rate_limited).", ["lane", "outcome"])
+LANE_ACTIVE = Gauge("chatbot_lane_active", "Requests holding a slot in an admission lane.", ["lane"],
+                    multiprocess_mode="livesum")
+INGEST_YIELD_SECONDS = Counter("chatbot_ingest_yield_seconds_total",
+                               "Seconds ingestion spent paused for chat and question requests.")
+OCR_PAGES = Counter("chatbot_ocr_pages_total", "Pages and images run through OCR, by outcome.", ["outcome"])
+OCR_SECONDS = Counter("chatbot_ocr_seconds_total", "Wall-clock seconds spent OCR'ing documents.")
+
+# ID of the request (or ingestion job) the current code is working for, and the
+# stage timings collected for it; both are written to the structured log.
+request_id_var = contextvars.ContextVar("request_id", default=None)
+request_stages_var = contextvars.ContextVar("request_stages", default=None)
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+def log_event(event, **fields):
+    """Prints one JSON log line tagged with the current request ID."""
+    record = {"ts": round(time.time(), 3), "event": event, "request_id": request_id_var.get()}
+    record.update(fields)
+    print(json.dumps(record, default=str), flush=True)
+
+def record_stage(stage, seconds, timings=None):
+    """
+    Records `seconds` spent in `stage`: in the chatbot_stage_seconds histogram,
+    in the current request's log line and, if given, as timings[f"{stage}_ms"].
+    """
+    STAGE_LATENCY.labels(stage).observe(seconds)
+    ms = round(1000 * seconds, 1)
+    stages = request_stages_var.get()
+    if stages is not None:
+        stages[stage] = round(stages.get(stage, 0.0) + ms, 1)
+    if timings is not None:
+        timings[f"{stage}_ms"] = ms
+
+@contextmanager
+def timed_stage(stage, timings=None):
+    """Times the enclosed block as `stage` (see record_stage)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started, timings)
+
+# cProfile can only run one profile at a time; requests that find it busy aren't profiled
+profile_lock = threading.Lock()
+
+class RequestTrace:
+    """
+    The request ID, stage timings and optional profile of one HTTP request.
+    Created when the request starts (it becomes the current request for
+    log_event / record_stage); finish() counts it in the metrics and writes
+    its log line.
+    """
+
+    def __init__(self, route, method, headers, args):
+        request_id = headers.get("X-Request-ID") or ""
+        self.request_id = request_id if REQUEST_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+        self.route = route
+        self.method = method
+        self.stages = {}
+        self.started = time.perf_counter()
+        self.profiler = None
+        self.profile_path = None
+        self._finished = False
+        request_id_var.set(self.request_id)
+        request_stages_var.set(self.stages)
+        REQUESTS_IN_FLIGHT.inc()
+        if PROFILING_ENABLED and "1" in (headers.get("X-Profile"), args.get("profile")):
+            self._start_profile()
+
+    def _start_profile(self):
+        if not profile_lock.acquire(blocking=False):
+            return
+        self.profile_path = os.path.join(PROFILE_DIR, f"{self.request_id}.prof")
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def _stop_profile(self):
+        try:
+            self.profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            self.profiler.dump_stats(self.profile_path)
+        except Exception as e:
+            print(f"[Profile] Could not write {self.profile_path}: {e}")
+            self.profile_path = None
+        finally:
+            self.profiler = None
+            profile_lock.release()
+
+    def response_headers(self):
+        headers = {"X-Request-ID": self.request_id}
+        if self.profile_path:
+            headers["X-Profile-File"] = self.profile_path
+        return headers
+
+    def finish(self, status):
+        if self._finished:
+            return
+        self._finished = True
+        if self.profiler is not None:
+            self._stop_profile()
+        elapsed = time.perf_counter() - self.started
+        REQUESTS_IN_FLIGHT.dec()
+        HTTP_REQUESTS.labels(self.route, self.method, str(status)).inc()
+        HTTP_LATENCY.labels(self.route).observe(elapsed)
+        if self.route not in UNLOGGED_ROUTES:
+            log_event("request", method=self.method, route=self.route, status=status,
+                      duration_ms=round(1000 * elapsed, 1), stages=self.stages, profile=self.profile_path)
+
+def traced_submit(executor, fn, *args):
+    """executor.submit that runs `fn` as part of the current request (same request ID and stage timings)."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
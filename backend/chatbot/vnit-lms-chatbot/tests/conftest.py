@@ -0,0 +1,71 @@
+"""
+Test setup. The service modules are imported with their state in a temporary
+directory; importing them starts no models or ingestion workers (see
+app.start_services).
+Run from the service directory:
+
+    python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+STATE_DIR = tempfile.mkdtemp(prefix="chatbot-tests-")
+os.environ.setdefault("GROQ_API_KEYS", "test-key")
+os.environ["STATE_DB_PATH"] = os.path.join(STATE_DIR, "chatbot_state.sqlite3")
+os.environ["CHROMA_DB_PATH"] = os.path.join(STATE_DIR, "chroma_db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admission  # noqa: E402
+import models  # noqa: E402
+import state_db  # noqa: E402
+
+
+class Clock:
+    """A time.monotonic that only moves when a test advances it."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def make_lane():
+    """Makes Lanes that are taken out of admission.admission_lanes again after the test."""
+    lanes = []
+
+    def make(limit=1, max_queue=10, max_wait_ms=60000):
+        lane = admission.Lane(f"test_{len(lanes)}", limit, max_queue, max_wait_ms)
+        lanes.append(lane)
+        return lane
+
+    yield make
+    for lane in lanes:
+        admission.admission_lanes.pop(lane.name, None)
+
+
+@pytest.fixture
+def temp_state_db(tmp_path, monkeypatch):
+    """A new, empty state database for one test; returns this thread's connection to it."""
+    path = str(tmp_path / "chatbot_state.sqlite3")
+    monkeypatch.setattr(state_db, "STATE_DB_PATH", path)
+    monkeypatch.setattr(models, "STATE_DB_PATH", path)
+    monkeypatch.setattr(state_db, "_state_db_local", threading.local())
+    monkeypatch.setitem(models.serving, "index", None)
+    return state_db.get_state_db()
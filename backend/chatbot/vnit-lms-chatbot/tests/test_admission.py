@@ -0,0 +1,149 @@
+import hashlib
+import hmac
+
+import pytest
+
+import admission
+
+
+def test_release_hands_the_slot_to_waiters_in_arrival_order(make_lane):
+    lane = make_lane(limit=1)
+    woken = []
+    assert lane.enter(lambda: woken.append("holder")) is None
+    first = lane.enter(lambda: woken.append("first"))
+    second = lane.enter(lambda: woken.append("second"))
+    assert lane.queued == 2
+
+    lane.release(1.0)
+    assert woken == ["first"]
+    assert first.granted and not second.granted
+    assert lane.active == 1 and lane.queued == 1
+
+    lane.release(1.0)
+    assert woken == ["first", "second"]
+    lane.release(1.0)
+    assert lane.active == 0 and lane.queued == 0
+    assert lane.outcomes == {"admitted": 1, "queued": 2}
+
+
+def test_abandon_before_the_grant_leaves_the_queue(make_lane):
+    lane = make_lane(limit=1)
+    lane.enter(lambda: None)
+    waiter = lane.enter(lambda: None)
+
+    assert lane.abandon(waiter) is False
+    assert lane.queued == 0
+    lane.release(1.0)
+    assert lane.active == 0
+    assert lane.outcomes["wait_exceeded"] == 1
+
+
+def test_abandon_after_the_grant_keeps_the_slot(make_lane):
+    lane = make_lane(limit=1)
+    lane.enter(lambda: None)
+    waiter = lane.enter(lambda: None)
+
+    # The slot is handed over just as the waiter gives up
+    lane.release(1.0)
+    assert lane.abandon(waiter) is True
+    assert lane.active == 1 and lane.queued == 0
+
+    admission.LaneSlot(lane).release()
+    assert lane.active == 0
+
+
+def test_queue_full_is_refused_with_retry_after(make_lane):
+    lane = make_lane(limit=1, max_queue=1)
+    lane.enter(lambda: None)
+    lane.enter(lambda: None)
+
+    with pytest.raises(admission.AdmissionRejected) as rejected:
+        lane.enter(lambda: None)
+    assert rejected.value.status == 503
+    # No slot has been released yet, so there is no hold time to go by
+    assert rejected.value.retry_after == 1
+    assert admission.rejection_headers(rejected.value) == {"Retry-After": "1"}
+    assert lane.outcomes["queue_full"] == 1
+
+
+def test_wait_exceeded_is_refused_with_the_expected_wait(make_lane):
+    lane = make_lane(limit=1, max_wait_ms=5000)
+    lane.enter(lambda: None)
+    lane.release(4.0)  # slots are held for 4s
+    lane.enter(lambda: None)
+    lane.enter(lambda: None)  # first in line: about 4s
+
+    with pytest.raises(admission.AdmissionRejected) as rejected:
+        lane.enter(lambda: None)  # second in line: about 8s
+    assert rejected.value.status == 503
+    assert rejected.value.retry_after == 8
+    assert lane.outcomes["wait_exceeded"] == 1
+    assert lane.queued == 1
+
+
+def test_acquire_gives_up_after_max_wait(make_lane):
+    lane = make_lane(limit=1, max_wait_ms=10)
+    with lane.acquire():
+        with pytest.raises(admission.AdmissionRejected):
+            lane.acquire()
+        assert lane.queued == 0
+    assert lane.active == 0
+
+
+def test_rate_limit_bucket_refills(clock):
+    limiter = admission.RateLimiter("test", per_minute=60, burst=2)
+    limiter.check("ip:10.0.0.1")
+    limiter.check("ip:10.0.0.1")
+    with pytest.raises(admission.AdmissionRejected) as rejected:
+        limiter.check("ip:10.0.0.1")
+    assert rejected.value.status == 429
+    assert rejected.value.retry_after == 1
+    # Other users have their own bucket
+    limiter.check("ip:10.0.0.2")
+
+    clock.advance(1.0)
+    limiter.check("ip:10.0.0.1")
+    with pytest.raises(admission.AdmissionRejected):
+        limiter.check("ip:10.0.0.1")
+
+    # A bucket never holds more than the burst
+    clock.advance(600.0)
+    limiter.check("ip:10.0.0.1")
+    limiter.check("ip:10.0.0.1")
+    with pytest.raises(admission.AdmissionRejected):
+        limiter.check("ip:10.0.0.1")
+
+
+def test_request_user_ignores_client_supplied_identities(monkeypatch):
+    monkeypatch.setattr(admission, "RATE_LIMIT_USER_SECRET", "secret")
+    spoofed = {"X-User-ID": "alice", "X-Forwarded-For": "1.2.3.4, 10.0.0.7"}
+    assert admission.request_user(spoofed, "127.0.0.1") == "ip:10.0.0.7"
+    assert admission.request_user({}, "127.0.0.1") == "ip:127.0.0.1"
+
+    signature = hmac.new(b"secret", b"alice", hashlib.sha256).hexdigest()
+    signed = {**spoofed, "X-User-Signature": signature}
+    assert admission.request_user(signed, "127.0.0.1") == "user:alice"
+
+
+def test_ingest_submissions_are_rate_limited(monkeypatch):
+    limiter = admission.RateLimiter("test_ingest", per_minute=60, burst=1)
+    monkeypatch.setitem(admission.RATE_LIMITED_ROUTES, "/chatbot-api/ingest", limiter)
+    admission.check_rate_limit("/chatbot-api/ingest", "POST", {}, "10.0.0.1")
+    with pytest.raises(admission.AdmissionRejected) as rejected:
+        admission.check_rate_limit("/chatbot-api/ingest", "POST", {}, "10.0.0.1")
+    assert rejected.value.status == 429
+    # Job status polling isn't limited
+    admission.check_rate_limit("/chatbot-api/ingest", "GET", {}, "10.0.0.1")
+
+
+def test_ingestion_yields_to_queued_and_retrieving_requests(make_lane):
+    # Ingestion has no lane of its own: it pauses while interactive requests need the CPU
+    lane = make_lane(limit=1)
+    assert not admission.interactive_demand()
+    with admission.interactive_cpu_work():
+        assert admission.interactive_demand()
+    lane.enter(lambda: None)
+    lane.enter(lambda: None)
+    assert admission.interactive_demand()
+    lane.release(1.0)
+    assert not admission.interactive_demand()
@@ -0,0 +1,56 @@
+import pytest
+
+import retrieval
+
+
+@pytest.fixture(autouse=True)
+def chunk_overlap(monkeypatch):
+    monkeypatch.setattr(retrieval, "serving_index", lambda: {"chunk_overlap": 20})
+
+
+def words(prefix, count):
+    """`count` distinct words, so passages never look like near-duplicates of each other."""
+    return " ".join(f"{prefix}{i}" for i in range(count))
+
+
+def hit(chunk_id, document):
+    return {"id": chunk_id, "document": document, "metadata": {}, "distance": 0.1}
+
+
+def test_passages_stay_within_the_token_budget():
+    hits = [
+        hit("drive_a_pdf_chunk_0", words("alpha", 30)),   # ~60 tokens
+        hit("drive_b_pdf_chunk_0", words("beta", 60)),    # ~120 tokens, doesn't fit after "a"
+        hit("drive_c_pdf_chunk_3", words("gamma", 10)),   # ~20 tokens, still fits
+    ]
+    passages, hits_used = retrieval.build_context(hits, token_budget=100)
+    assert sum(retrieval.estimate_tokens(passage) for passage in passages) <= 100
+    assert passages == [hits[0]["document"], hits[2]["document"]]
+    assert [h["id"] for h in hits_used] == ["drive_a_pdf_chunk_0", "drive_c_pdf_chunk_3"]
+
+
+def test_an_oversized_best_passage_is_cut_and_only_surviving_chunks_are_used():
+    first, second, third = words("one", 20), words("two", 20), words("three", 20)
+    hits = [
+        hit("drive_a_pdf_chunk_0", first),
+        hit("drive_a_pdf_chunk_2", third),
+        hit("drive_a_pdf_chunk_1", second),
+    ]
+    budget = retrieval.estimate_tokens(first + "\n" + second[:10])
+    passages, hits_used = retrieval.build_context(hits, token_budget=budget)
+    assert len(passages) == 1
+    assert retrieval.estimate_tokens(passages[0]) <= budget
+    assert passages[0].startswith(first + "\n" + second[:5])
+    assert [h["id"] for h in hits_used] == ["drive_a_pdf_chunk_0", "drive_a_pdf_chunk_1"]
+
+
+def test_consecutive_chunks_merge_and_near_duplicates_are_dropped():
+    text = words("delta", 40)
+    hits = [
+        hit("drive_a_pdf_chunk_0", text[:150]),
+        hit("drive_copy_pdf_chunk_0", text),  # the same text uploaded again
+        hit("drive_a_pdf_chunk_1", text[130:]),  # repeats 20 characters of chunk 0
+    ]
+    passages, hits_used = retrieval.build_context(hits, token_budget=1000)
+    assert passages == [text]
+    assert [h["id"] for h in hits_used] == ["drive_a_pdf_chunk_0", "drive_a_pdf_chunk_1"]
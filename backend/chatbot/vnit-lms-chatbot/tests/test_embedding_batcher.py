@@ -0,0 +1,71 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import retrieval
+
+
+def queue_requests(batcher, texts, model_name="model"):
+    pending = [retrieval.PendingEncode(text, model_name) for text in texts]
+    for item in pending:
+        batcher._queue.put(item)
+    return pending
+
+
+def test_a_full_batch_is_taken_without_waiting():
+    batcher = retrieval.EmbeddingBatcher(None, max_batch_size=3, max_wait_ms=60000, name="test")
+    queue_requests(batcher, ["a", "b", "c", "d"])
+    started = time.monotonic()
+    batch = batcher._collect_batch()
+    assert [pending.text for pending in batch] == ["a", "b", "c"]
+    assert time.monotonic() - started < 1
+    assert batcher.queued == 1
+
+
+def test_a_partial_batch_is_taken_after_max_wait():
+    batcher = retrieval.EmbeddingBatcher(None, max_batch_size=8, max_wait_ms=50, name="test")
+    started = time.monotonic()
+    queue_requests(batcher, ["a"])
+    batch = batcher._collect_batch()
+    assert [pending.text for pending in batch] == ["a"]
+    assert time.monotonic() - started >= 0.04
+
+
+def test_concurrent_callers_share_a_batch_and_get_their_own_vectors():
+    batches = []
+
+    def encode_batch(texts, model_name):
+        batches.append(list(texts))
+        return np.array([[float(len(text))] for text in texts])
+
+    batcher = retrieval.EmbeddingBatcher(encode_batch, max_batch_size=8, max_wait_ms=60000, name="test")
+    queue_requests(batcher, ["a" * n for n in range(1, 8)])
+    results = {}
+
+    def call():
+        results["x" * 8] = batcher.encode("x" * 8, "model")
+
+    caller = threading.Thread(target=call)
+    caller.start()
+    caller.join(5)
+    assert results == {"x" * 8: [8.0]}
+    assert len(batches) == 1 and len(batches[0]) == 8
+
+
+def test_an_encoding_error_reaches_every_waiter_of_that_model():
+    def encode_batch(texts, model_name):
+        if model_name == "broken":
+            raise ValueError("model failed to load")
+        return np.ones((len(texts), 2))
+
+    batcher = retrieval.EmbeddingBatcher(encode_batch, max_batch_size=5, max_wait_ms=60000, name="test")
+    broken = queue_requests(batcher, ["a", "b", "c"], "broken")
+    working = queue_requests(batcher, ["d"], "working")
+    with pytest.raises(ValueError, match="model failed to load"):
+        batcher.encode("e", "broken")
+    for pending in broken:
+        assert pending.done.is_set() and isinstance(pending.error, ValueError)
+    assert working[0].error is None and working[0].vector == [1.0, 1.0]
+    assert batcher.stats()["max_batch_size"] == 5
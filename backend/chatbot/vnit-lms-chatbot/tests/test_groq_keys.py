@@ -0,0 +1,82 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import groq_keys
+
+
+def rate_limit_error(headers):
+    error = groq_keys.RateLimitError.__new__(groq_keys.RateLimitError)
+    error.response = SimpleNamespace(headers=headers)
+    return error
+
+
+def make_pool(size, responses, max_attempts=4):
+    """
+    A pool whose keys answer from `responses`: {key index: [exception or headers, ...]},
+    one entry per call (a key with no entries left answers with no headers).
+    Returns (pool, calls) where calls lists the key index of every call made.
+    """
+    pool = groq_keys.GroqKeyPool([f"gsk_test_key_{i}" for i in range(size)], max_attempts, backoff_seconds=0)
+    calls = []
+    for key in pool.keys:
+        def create(index=key.index, **kwargs):
+            calls.append(index)
+            response = responses.get(index, []).pop(0) if responses.get(index) else {}
+            if isinstance(response, Exception):
+                raise response
+            completion = SimpleNamespace(key=index, usage=None)
+            return SimpleNamespace(headers=response, parse=lambda: completion)
+        key.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+            with_raw_response=SimpleNamespace(create=create))))
+    return pool, calls
+
+
+def test_calls_rotate_over_the_keys():
+    pool, calls = make_pool(3, {})
+    for _ in range(4):
+        pool.create_chat_completion(model="m", messages=[])
+    assert calls == [0, 1, 2, 0]
+
+
+def test_a_rate_limited_key_is_retried_on_another_and_rested():
+    pool, calls = make_pool(3, {0: [rate_limit_error({"retry-after": "7s"})]})
+    completion = pool.create_chat_completion(model="m", messages=[])
+    assert completion.key == 1
+    assert pool.keys[0].rate_limited == 1
+    assert 6 < pool.keys[0].cooldown_until - time.time() <= 7
+
+    pool.create_chat_completion(model="m", messages=[])
+    pool.create_chat_completion(model="m", messages=[])
+    assert calls == [0, 1, 2, 1]  # key 0 is skipped while it rests
+
+
+def test_a_key_out_of_quota_is_rested_until_its_window_resets():
+    pool, calls = make_pool(2, {0: [{"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "2m"}]})
+    pool.create_chat_completion(model="m", messages=[])
+    assert 119 < pool.keys[0].cooldown_until - time.time() <= 120
+    pool.create_chat_completion(model="m", messages=[])
+    pool.create_chat_completion(model="m", messages=[])
+    assert calls == [0, 1, 1]
+
+
+def test_the_last_error_is_raised_once_every_attempt_failed(monkeypatch):
+    monkeypatch.setattr(groq_keys, "GROQ_MAX_COOLDOWN_WAIT", 0)
+    errors = {i: [rate_limit_error({"retry-after": "30s"})] for i in range(2)}
+    errors[0].append(rate_limit_error({"retry-after": "30s"}))
+    last = errors[0][1]
+    pool, calls = make_pool(2, errors, max_attempts=3)
+    with pytest.raises(groq_keys.RateLimitError) as raised:
+        pool.create_chat_completion(model="m", messages=[])
+    assert raised.value is last
+    assert calls == [0, 1, 0]
+    assert [key.in_flight for key in pool.keys] == [0, 0]
+
+
+@pytest.mark.parametrize("value, seconds", [
+    ("7.66s", 7.66), ("2m59.5s", 179.5), ("1h2m", 3720), ("250ms", 0.25), ("3", 3.0),
+])
+def test_groq_reset_durations_are_parsed(value, seconds):
+    assert groq_keys.parse_groq_duration(value) == pytest.approx(seconds)
+    assert groq_keys.parse_groq_duration(None) is None
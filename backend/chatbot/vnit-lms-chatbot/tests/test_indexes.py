@@ -0,0 +1,98 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import indexes
+import ingestion
+import reindex
+import state_db
+from config import COLLECTION_NAME
+
+
+class Collection:
+    def __init__(self):
+        self.ids = set()
+
+    def upsert(self, embeddings, documents, metadatas, ids):
+        self.ids.update(ids)
+
+    def delete(self, ids):
+        self.ids.difference_update(ids)
+
+
+@pytest.fixture
+def live(temp_state_db, monkeypatch):
+    """
+    A live index holding one document whose text is stored, with fake
+    collections and embedding model. Returns the chunk IDs of the live document.
+    """
+    collections = {}
+    dropped = []
+    monkeypatch.setattr(indexes, "get_collection", lambda name=None: collections.setdefault(name, Collection()))
+    monkeypatch.setattr(ingestion, "get_embedding_model", lambda name=None: SimpleNamespace(
+        encode=lambda texts, batch_size: np.ones((len(texts), 2), dtype=np.float32)))
+    monkeypatch.setitem(indexes.components, "chroma", SimpleNamespace(
+        get=lambda: SimpleNamespace(delete_collection=lambda name: dropped.append(name))))
+    monkeypatch.setattr(indexes, "REINDEX_DUTY_CYCLE", 1.0)
+
+    text = " ".join(f"word{i}" for i in range(400))
+    state_db.save_extraction("a" * 64, "pdf", text)
+    chunk_ids = ["drive_f1_pdf_chunk_0", "drive_f1_pdf_chunk_1"]
+    state_db.save_ingested_document("f1", "a" * 64, "pdf", chunk_ids, ingestion.current_chunk_config())
+    state_db.index_chunks("f1", chunk_ids, ["live text 0", "live text 1"], [{}, {}])
+    return SimpleNamespace(chunk_ids=chunk_ids, dropped=dropped)
+
+
+def shadow(status="verified", name="shadow"):
+    index = indexes.create_search_index(name, "model-b", 200, 20)
+    indexes.update_search_index(name, status=status)
+    return index
+
+
+def live_chunk_ids():
+    return state_db.get_ingested_document("f1")["chunk_ids"]
+
+
+def test_swap_rollback_and_drop(live):
+    shadow()
+    assert indexes.swap_index("shadow") == {"active": "shadow", "previous": COLLECTION_NAME}
+    swapped_ids = live_chunk_ids()
+    assert len(swapped_ids) > len(live.chunk_ids)  # re-chunked with the shadow index's 200-character chunks
+    assert indexes.get_index_status("shadow") == "live"
+    assert indexes.get_index_status(COLLECTION_NAME) == "previous"
+
+    assert indexes.rollback_index() == {"active": COLLECTION_NAME, "previous": "shadow"}
+    assert live_chunk_ids() == live.chunk_ids
+    assert [row[0] for row in state_db.get_state_db().execute("SELECT chunk_id FROM lexical_chunks")] == live.chunk_ids
+    assert indexes.get_index_status("shadow") == "previous"
+
+    indexes.drop_index("shadow")
+    assert live.dropped == ["shadow"]
+    status = indexes.list_search_indexes()
+    assert status["active"] == COLLECTION_NAME and status["previous"] is None
+    assert [index["name"] for index in status["indexes"]] == [COLLECTION_NAME]
+    with pytest.raises(ValueError, match="no previous index"):
+        indexes.rollback_index()
+
+
+def test_the_live_index_cannot_be_dropped_swapped_in_or_rebuilt(live):
+    with pytest.raises(ValueError, match="is the live index"):
+        indexes.drop_index(COLLECTION_NAME)
+    with pytest.raises(ValueError, match="already the live index"):
+        indexes.swap_index(COLLECTION_NAME)
+    args = SimpleNamespace(name=COLLECTION_NAME, embedding_model=None, chunk_size=None, chunk_overlap=None)
+    with pytest.raises(ValueError, match="build a new one instead"):
+        reindex.build(args)
+    assert live.dropped == []
+    assert live_chunk_ids() == live.chunk_ids
+
+
+def test_an_unverified_index_is_only_swapped_in_with_force(live):
+    shadow(status="built")
+    with pytest.raises(ValueError, match="verify it first"):
+        indexes.swap_index("shadow")
+    assert indexes.list_search_indexes()["active"] == COLLECTION_NAME
+
+    assert indexes.swap_index("shadow", force=True)["active"] == "shadow"
+    assert indexes.get_index_status("shadow") == "live"
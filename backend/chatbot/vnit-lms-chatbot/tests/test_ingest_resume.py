@@ -0,0 +1,125 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import ingestion
+
+
+class Killed(BaseException):
+    """Stands in for the process dying (redeploy, OOM kill): nothing in the job catches it."""
+
+
+class ScannedPdf:
+    """A PDF whose pages have no text layer, so every page is OCR'd."""
+
+    def __init__(self, pages):
+        self.pages = [SimpleNamespace(number=i, get_text=lambda: "") for i in range(pages)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        return iter(self.pages)
+
+    def __getitem__(self, page_num):
+        return self.pages[page_num]
+
+
+class Collection:
+    def __init__(self):
+        self.ids = set()
+
+    def upsert(self, embeddings, documents, metadatas, ids):
+        self.ids.update(ids)
+
+    def get(self, ids, include):
+        return {"ids": [chunk_id for chunk_id in ids if chunk_id in self.ids]}
+
+
+@pytest.fixture
+def worker(temp_state_db, tmp_path, monkeypatch):
+    """
+    Runs ingestion jobs of a 3-page scanned PDF with fake OCR, embedding model and
+    collection; set `kill_after` to {"ocr": n} or {"encode": n} to kill the
+    process after n pages OCR'd or n embedding batches.
+    """
+    state = SimpleNamespace(downloads=0, ocr_pages=[], encoded=[], kill_after={}, collection=Collection())
+
+    def download_drive_file(file_id, job):
+        state.downloads += 1
+        path = tmp_path / f"download_{state.downloads}.pdf"
+        path.write_bytes(b"%PDF-1.4 scanned lecture")
+        return str(path), "application/pdf", path.stat().st_size, "c" * 64
+
+    def read_text(reader, page):
+        if len(state.ocr_pages) == state.kill_after.get("ocr"):
+            raise Killed()
+        state.ocr_pages.append(page.number)
+        return f"page{page.number} " + " ".join(f"p{page.number}w{i}" for i in range(150))
+
+    def encode(texts, batch_size):
+        if len(state.encoded) == state.kill_after.get("encode"):
+            raise Killed()
+        state.encoded.append(list(texts))
+        return np.ones((len(texts), 2), dtype=np.float32)
+
+    monkeypatch.setattr(ingestion, "download_drive_file", download_drive_file)
+    monkeypatch.setattr(ingestion, "detect_file_type", lambda *args: "pdf")
+    monkeypatch.setattr(ingestion, "fitz", SimpleNamespace(open=lambda path, filetype: ScannedPdf(3)))
+    monkeypatch.setattr(ingestion, "OCR_ENABLED", True)
+    monkeypatch.setattr(ingestion, "OCR_WORKERS", 0)
+    monkeypatch.setattr(ingestion, "get_ocr_reader", lambda: None)
+    monkeypatch.setattr(ingestion.ocr_worker, "render_page", lambda page, zoom: page)
+    monkeypatch.setattr(ingestion.ocr_worker, "read_text", read_text)
+    monkeypatch.setattr(ingestion, "INGEST_EMBED_BATCH_SIZE", 2)
+    monkeypatch.setattr(ingestion, "get_embedding_model", lambda name=None: SimpleNamespace(encode=encode))
+    monkeypatch.setattr(ingestion, "get_collection", lambda name=None: state.collection)
+    return state
+
+
+def run_next_job():
+    job = ingestion.claim_next_job()
+    ingestion.process_drive_link(job.drive_link, job)
+    return job
+
+
+def restart(state):
+    """What a new ingestion owner does with the job the dead one left running."""
+    state.kill_after = {}
+    ingestion.recover_interrupted_jobs()
+
+
+def test_a_job_killed_during_ocr_resumes_from_the_stored_pages(worker):
+    ingestion.IngestJob("https://drive.google.com/file/d/f1/view").insert()
+    worker.kill_after = {"ocr": 1}
+    with pytest.raises(Killed):
+        run_next_job()
+    assert worker.ocr_pages == [0]
+
+    restart(worker)
+    job = run_next_job()
+    assert job.status == "completed" and job.resumes == 1
+    assert worker.ocr_pages == [0, 1, 2]  # page 0 was not OCR'd again
+
+
+def test_a_job_killed_after_one_embedding_batch_resumes_without_re_embedding(worker):
+    ingestion.IngestJob("https://drive.google.com/file/d/f1/view").insert()
+    worker.kill_after = {"encode": 1}
+    with pytest.raises(Killed):
+        run_next_job()
+    first_batch = worker.encoded[0]
+    assert len(first_batch) == 2
+
+    restart(worker)
+    job = run_next_job()
+    assert job.status == "completed"
+    assert worker.downloads == 1 and worker.ocr_pages == [0, 1, 2]  # resumed from the extracted text
+    re_encoded = [text for batch in worker.encoded[1:] for text in batch]
+    assert not set(first_batch) & set(re_encoded)
+    doc = ingestion.get_ingested_document("f1")
+    assert len(first_batch) + len(re_encoded) == len(doc["chunk_ids"])
+    assert worker.collection.ids == set(doc["chunk_ids"])
@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+import ingestion
+import state_db
+
+
+class CountingModel:
+    """An embedding model that records the texts it was asked to encode."""
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts, batch_size=32):
+        self.encoded.extend(texts)
+        return np.array([[float(len(text)), 1.0] for text in texts], dtype=np.float32)
+
+
+class FakeCollection:
+    def __init__(self, ids=()):
+        self.ids = set(ids)
+        self.deleted = []
+
+    def upsert(self, embeddings, documents, metadatas, ids):
+        self.ids.update(ids)
+
+    def delete(self, ids):
+        self.deleted.extend(ids)
+        self.ids.difference_update(ids)
+
+    def get(self, ids, include):
+        return {"ids": [chunk_id for chunk_id in ids if chunk_id in self.ids]}
+
+
+@pytest.fixture
+def embedding_models(monkeypatch):
+    loaded = {}
+    monkeypatch.setattr(ingestion, "get_embedding_model", lambda name=None: loaded.setdefault(name, CountingModel()))
+    return loaded
+
+
+def make_doc(source_id, content_sha256, upload=None):
+    job = ingestion.IngestJob("https://drive.google.com/file/d/x/view", options={"upload": upload} if upload else None)
+    job.insert()
+    doc = ingestion.IngestDocument(job)
+    doc.source_id = source_id
+    doc.content_sha256 = content_sha256
+    doc.file_type = "pdf"
+    return doc
+
+
+def test_identical_chunks_are_embedded_once(temp_state_db, embedding_models):
+    chunks = ["first chunk", "second chunk"]
+    vectors, encoded = ingestion.embed_chunks(chunks, model_name="model-a")
+    assert encoded == 2
+
+    again, encoded = ingestion.embed_chunks(chunks + ["third chunk"], model_name="model-a")
+    assert encoded == 1
+    assert embedding_models["model-a"].encoded == chunks + ["third chunk"]
+    assert again[:2] == vectors
+
+
+def test_another_embedding_model_misses_the_cache(temp_state_db, embedding_models):
+    ingestion.embed_chunks(["some chunk"], model_name="model-a")
+    _, encoded = ingestion.embed_chunks(["some chunk"], model_name="model-b")
+    assert encoded == 1
+    assert embedding_models["model-b"].encoded == ["some chunk"]
+
+
+def test_identical_file_content_reuses_the_extracted_text(temp_state_db, monkeypatch):
+    extracted = []
+
+    def extract_text_from_pdf(path, job=None, content_sha256=None):
+        extracted.append(content_sha256)
+        return "Sorting algorithms. " * 20
+
+    monkeypatch.setattr(ingestion, "extract_text_from_pdf", extract_text_from_pdf)
+    first, second = make_doc("file-1", "a" * 64), make_doc("file-2", "a" * 64)
+    assert ingestion.extract_document(first)
+    assert ingestion.extract_document(second)
+    assert extracted == ["a" * 64]
+    assert second.text_chunks == first.text_chunks
+    assert second.ids[0] == "drive_file-2_pdf_chunk_0"
+
+
+def test_unchanged_file_is_skipped_unless_the_chunk_settings_changed(temp_state_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(ingestion, "detect_file_type", lambda *args: "pdf")
+    path = tmp_path / "notes.pdf"
+    path.write_bytes(b"%PDF-1.4 lecture notes")
+    source_id = f"upload_{ingestion.file_sha256(str(path))[:24]}"
+    content_sha256 = ingestion.file_sha256(str(path))
+
+    state_db.save_ingested_document(source_id, content_sha256, "pdf", ["c0"], ingestion.current_chunk_config())
+    doc = make_doc(None, None, upload={"path": str(path), "filename": "notes.pdf"})
+    assert ingestion.fetch_document(doc) is False
+    assert doc.job.status == "completed"
+
+    state_db.save_ingested_document(source_id, content_sha256, "pdf", ["c0"], "all-MiniLM-L6-v2|500|50")
+    doc = make_doc(None, None, upload={"path": str(path), "filename": "notes.pdf"})
+    assert ingestion.fetch_document(doc) is True
+    assert doc.source_id == source_id
+
+
+def store(doc, collection, monkeypatch):
+    monkeypatch.setattr(ingestion, "get_collection", lambda name=None: collection)
+    doc.text_chunks = [f"chunk {i}" for i in range(len(doc.ids))]
+    doc.metadatas = [{"sourceId": doc.source_id} for _ in doc.ids]
+    embeddings = [[1.0, 0.0] for _ in doc.ids]
+    ingestion.store_documents([doc], doc.text_chunks, embeddings, ingestion.active_index())
+
+
+def test_store_deletes_chunks_of_the_previous_longer_version(temp_state_db, monkeypatch):
+    old_ids = [f"drive_f1_pdf_chunk_{i}" for i in range(3)]
+    state_db.save_ingested_document("f1", "old", "pdf", old_ids, ingestion.current_chunk_config())
+    collection = FakeCollection(old_ids)
+    doc = make_doc("f1", "new")
+    doc.ids = old_ids[:1]
+
+    store(doc, collection, monkeypatch)
+    assert collection.deleted == old_ids[1:]
+    assert collection.ids == set(old_ids[:1])
+    assert state_db.get_ingested_document("f1")["chunk_ids"] == old_ids[:1]
+
+
+def test_store_deletes_legacy_chunks_stored_before_the_cache(temp_state_db, monkeypatch):
+    legacy_ids = [f"drive_f2_pdf_chunk_{i}" for i in range(5)]
+    collection = FakeCollection(legacy_ids)
+    doc = make_doc("f2", "new")
+    doc.ids = legacy_ids[:2]
+
+    store(doc, collection, monkeypatch)
+    assert collection.deleted == legacy_ids[2:]
+    assert state_db.get_ingested_document("f2")["content_sha256"] == "new"
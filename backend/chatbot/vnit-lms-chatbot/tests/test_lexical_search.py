@@ -0,0 +1,79 @@
+import pytest
+
+import retrieval
+import state_db
+
+
+@pytest.fixture
+def index(temp_state_db):
+    """Indexes {chunk_id: (text, courseId, materialId)} in the lexical index of a new state DB."""
+    retrieval.retrieval_cache.clear()
+
+    def add(chunks):
+        for chunk_id, (text, course_id, material_id) in chunks.items():
+            state_db.index_chunks(chunk_id, [chunk_id], [text],
+                                  [{"courseId": course_id, "materialId": material_id}])
+    return add
+
+
+def found(query, scope=None):
+    return sorted(chunk_id for chunk_id, _, _ in retrieval.lexical_search(query, 10, scope))
+
+
+def test_reciprocal_rank_fusion_weights_ranks_by_rrf_k():
+    vector = ["a"] + [f"v{i}" for i in range(8)] + ["d"]
+    lexical = ["e", "d"]
+    # With the usual k a chunk found by both retrievers beats one ranked first by only one
+    assert retrieval.reciprocal_rank_fusion([vector, lexical], k=retrieval.RRF_K)[0] == "d"
+    assert retrieval.reciprocal_rank_fusion([vector, lexical])[0] == "d"
+    # A small k lets a single top rank win
+    assert retrieval.reciprocal_rank_fusion([vector, lexical], k=1)[0] == "a"
+
+
+def test_stopwords_are_dropped_from_the_query(index):
+    index({"c1": ("what is the answer", "", ""), "c2": ("quicksort pivot", "", "")})
+    assert found("what is the") == []
+    assert found("what is the pivot") == ["c2"]
+
+
+def test_section_numbers_and_course_codes_match_as_phrases(index):
+    index({
+        "section": ("see section 4.2 for proofs", "", ""),
+        "apart": ("4 proofs and 2 lemmas", "", ""),
+        "code": ("syllabus of CS-101", "", ""),
+        "code_apart": ("101 topics in cs", "", ""),
+    })
+    assert found("what is 4.2") == ["section"]
+    assert found("CS-101 syllabus") == ["code"]
+
+
+def test_only_the_first_lexical_max_terms_are_searched(index, monkeypatch):
+    monkeypatch.setattr(retrieval, "LEXICAL_MAX_TERMS", 2)
+    index({"first": ("alpha notes", "", ""), "third": ("gamma notes", "", "")})
+    assert found("alpha beta gamma") == ["first"]
+    assert found("alpha alpha beta gamma") == ["first"]  # repeated terms count once
+
+
+def test_course_and_material_filters(index):
+    index({
+        "cs_m1": ("graph search", "CS101", "m1"),
+        "cs_m2": ("graph search", "CS101", "m2"),
+        "ma_m3": ("graph search", "MA201", "m3"),
+        "ee_m4": ("graph search", "EE301", "m4"),
+    })
+    assert found("graph", {"courseId": "CS101"}) == ["cs_m1", "cs_m2"]
+    assert found("graph", {"courseId": ["CS101", "MA201"]}) == ["cs_m1", "cs_m2", "ma_m3"]
+    assert found("graph", {"courseId": "CS101", "materialId": ["m2", "m3"]}) == ["cs_m2"]
+
+
+def test_vector_hits_are_used_alone_without_fts5(index, monkeypatch):
+    index({"lexical_only": ("binary heap", "", "")})
+    monkeypatch.setitem(retrieval.lexical_index_status, "available", False)
+    monkeypatch.setattr(retrieval, "HYBRID_SEARCH_ENABLED", True)
+    monkeypatch.setattr(retrieval, "RERANK_ENABLED", False)
+    monkeypatch.setattr(retrieval, "query_collection", lambda vector, n_results, where, collection_name: {
+        "ids": [["v1", "v2"]], "documents": [["heap one", "heap two"]], "distances": [[0.1, 0.2]],
+    })
+    assert retrieval.lexical_search("binary heap", 10) == []
+    hits = retrieval.search_chunks("binary heap", [0.0], 5, index={"name": "test"})
+    assert [hit["id"] for hit in hits] == ["v1", "v2"]
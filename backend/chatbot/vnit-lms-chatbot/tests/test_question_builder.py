@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+import questions
+
+PARAMS = {"topic": "Sorting", "question_type": "mcq_single", "num_questions": 6, "difficulty": "medium"}
+
+
+@pytest.fixture(autouse=True)
+def question_settings(monkeypatch):
+    monkeypatch.setattr(questions, "QUESTIONS_PER_CALL", 3)
+    monkeypatch.setattr(questions, "QUESTION_RETRY_ROUNDS", 2)
+
+
+def question(text):
+    return {"questionText": text, "questionType": "mcq_single", "options": ["A", "B"], "correctAnswer": "A"}
+
+
+def answer(*questions):
+    return json.dumps(list(questions))
+
+
+def test_every_slot_gets_its_own_passages():
+    slots = questions.plan_question_slots(10, ["p1", "p2", "p3", "p4", "p5", "p6"])
+    assert [slot["count"] for slot in slots] == [3, 3, 2, 2]
+    assert [slot["context"] for slot in slots] == ["p1\n\np5", "p2\n\np6", "p3", "p4"]
+
+    # Fewer passages than calls: fewer, larger slots rather than repeated prompts
+    slots = questions.plan_question_slots(10, ["p1", "p2"])
+    assert slots == [{"count": 5, "context": "p1"}, {"count": 5, "context": "p2"}]
+
+
+def test_a_short_answer_requeues_its_slot_for_the_missing_questions():
+    builder = questions.QuestionSetBuilder(PARAMS, ["p1", "p2"])
+    first, second = builder.next_round()
+    builder.record(first, answer(question("Q1"), question("Q2"), question("Q3")))
+    invalid = {"questionText": "Q5", "questionType": "mcq_single"}  # no options
+    builder.record(second, answer(question("Q4"), invalid))
+
+    assert builder.next_round() == [{"count": 2, "context": "p2"}]
+    builder.record({"count": 2, "context": "p2"}, answer(question("Q5"), question("Q6")))
+
+    assert builder.next_round() == []
+    assert [q["questionText"] for q in builder.questions] == ["Q1", "Q2", "Q3", "Q4", "Q5", "Q6"]
+    assert (builder.rounds, builder.calls) == (2, 3)
+
+
+def test_duplicates_and_known_questions_are_not_counted():
+    builder = questions.QuestionSetBuilder({**PARAMS, "num_questions": 3}, ["p1"], existing=[question("Q1")])
+    (slot,) = builder.next_round()
+    builder.record(slot, answer(question("q1 "), question("Q2"), question("Q2"), question("Q3")))
+
+    assert [q["questionText"] for q in builder.questions] == ["Q2", "Q3"]
+    (retry,) = builder.next_round()
+    assert retry["count"] == 1
+    assert "- Q1" in builder.messages(retry)[-1]["content"]
+
+
+def test_failed_slots_are_retried_a_limited_number_of_times():
+    builder = questions.QuestionSetBuilder({**PARAMS, "num_questions": 3}, ["p1"])
+    (slot,) = builder.next_round()
+    builder.record(slot, "Sorry, I can't help with that.")
+    assert isinstance(builder.last_error, ValueError)
+    for _ in range(questions.QUESTION_RETRY_ROUNDS):
+        (slot,) = builder.next_round()
+        assert slot["count"] == 3
+        builder.record(slot, error=RuntimeError("rate limited"))
+
+    assert builder.next_round() == []
+    assert builder.questions == []
+    assert builder.calls == 1 + questions.QUESTION_RETRY_ROUNDS
@@ -0,0 +1,60 @@
+import pytest
+
+import ingestion
+import retrieval
+import state_db
+
+
+@pytest.fixture
+def lexical_chunks(temp_state_db):
+    """Indexes a chunk of course CS101, one of course MA201 and one ingested before scoping existed."""
+    retrieval.retrieval_cache.clear()
+    state_db.index_chunks("cs", ["cs_0"], ["merge sort splits the array"], [{"courseId": "CS101"}])
+    state_db.index_chunks("ma", ["ma_0"], ["merge sort in a proof"], [{"courseId": "MA201"}])
+    state_db.index_chunks("legacy", ["legacy_0"], ["merge sort is stable"], [{"sourceId": "legacy"}])
+
+
+def test_scope_filters_also_match_unscoped_chunks():
+    assert retrieval.scope_filter({}) is None
+    assert retrieval.scope_filter({"courseId": "CS101"}) == {"courseId": {"$in": ["CS101", ""]}}
+    assert retrieval.scope_filter({"courseId": ["CS101", "CS102"], "materialId": "m1"}) == {"$and": [
+        {"courseId": {"$in": ["CS101", "CS102", ""]}},
+        {"materialId": {"$in": ["m1", ""]}},
+    ]}
+
+
+def test_a_legacy_chunk_is_found_by_a_scoped_lexical_search(lexical_chunks):
+    hits = retrieval.lexical_search("merge sort", 10, scope={"courseId": "CS101"})
+    assert sorted(chunk_id for chunk_id, _, _ in hits) == ["cs_0", "legacy_0"]
+
+
+def test_new_chunks_store_the_unscoped_marker():
+    metadata, = ingestion.build_chunk_metadata("f1", "pdf", {"courseId": "CS101"}, [None])
+    assert (metadata["courseId"], metadata["materialId"]) == ("CS101", "")
+
+
+class LegacyCollection:
+    def __init__(self, metadatas):
+        self.metadatas = metadatas
+
+    def get(self, limit, offset, include):
+        ids = list(self.metadatas)[offset:offset + limit]
+        return {"ids": ids, "metadatas": [self.metadatas[chunk_id] for chunk_id in ids]}
+
+    def update(self, ids, metadatas):
+        self.metadatas.update(zip(ids, metadatas))
+
+
+def test_legacy_chunks_are_backfilled_with_the_unscoped_marker(temp_state_db, monkeypatch):
+    collection = LegacyCollection({
+        "drive_x_pdf_chunk_0": {"sourceId": "x"},
+        "drive_x_pdf_chunk_1": None,
+        "upload_y_chunk_0": {"sourceId": "y", "courseId": "CS101", "materialId": ""},
+    })
+    monkeypatch.setattr(ingestion, "get_collection", lambda name=None: collection)
+    ingestion.backfill_scope_markers()
+    assert collection.metadatas == {
+        "drive_x_pdf_chunk_0": {"sourceId": "x", "courseId": "", "materialId": ""},
+        "drive_x_pdf_chunk_1": {"courseId": "", "materialId": ""},
+        "upload_y_chunk_0": {"sourceId": "y", "courseId": "CS101", "materialId": ""},
+    }
@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+
+import admission
+import flights
+
+
+@pytest.fixture
+def group(monkeypatch):
+    monkeypatch.setattr(flights, "SINGLE_FLIGHT_ENABLED", True)
+    group = flights.SingleFlight("test")
+    yield group
+    flights.single_flight_groups.remove(group)
+
+
+class Slot:
+    def __init__(self):
+        self.released = 0
+
+    def release(self):
+        self.released += 1
+
+
+def test_followers_join_the_leaders_flight_until_it_lands(group):
+    flight, leader = group.join("key", flights.Flight)
+    follower_flight, follower = group.join("key", flights.Flight)
+    assert leader and not follower
+    assert follower_flight is flight
+    assert group.stats() == {"in_flight": 1, "led": 1, "joined": 1}
+
+    group.land("key", flight)
+    later, leader = group.join("key", flights.Flight)
+    assert leader and later is not flight
+
+
+def test_a_landed_flight_does_not_forget_its_successor(group):
+    old, _ = group.join("key", flights.Flight)
+    group.land("key", old)
+    new, _ = group.join("key", flights.Flight)
+    group.land("key", old)
+    assert group.join("key", flights.Flight) == (new, False)
+
+
+def test_follower_gets_every_event_of_the_flight(group):
+    flight, _ = group.join("key", flights.Flight)
+    flight.publish("sources", {"sources": []})
+    followed = []
+    follower = threading.Thread(target=lambda: followed.extend(flight.follow()))
+    follower.start()
+
+    slot = Slot()
+    events = iter([("token", {"text": "Hi"}), ("done", {"answer": "Hi", "cached": False, "timings": {}})])
+    flights.run_flight(group, "key", flight, events, slot)
+    follower.join(timeout=5)
+
+    assert followed == flight.wait()
+    assert [event for event, _ in followed] == ["sources", "token", "done"]
+    assert slot.released == 1
+    assert group.stats()["in_flight"] == 0
+    assert flights.chat_response(flight.wait()) == ({"answer": "Hi"}, 200)
+
+
+def test_a_failing_flight_ends_with_an_error_event(group):
+    def events():
+        yield "sources", {"sources": []}
+        raise RuntimeError("Groq is down")
+
+    flight, _ = group.join("key", flights.Flight)
+    slot = Slot()
+    flights.run_flight(group, "key", flight, events(), slot)
+
+    event, data = flight.wait()[-1]
+    assert event == "error" and "Groq is down" in data["error"]
+    assert slot.released == 1
+    assert flights.chat_response(flight.wait())[1] == 500
+
+
+def test_a_refused_flight_refuses_its_followers(group):
+    flight, _ = group.join("key", flights.Flight)
+    follower_flight, _ = group.join("key", flights.Flight)
+    flights.refuse_flight(group, "key", flight, admission.AdmissionRejected(503, "busy", 7))
+
+    with pytest.raises(admission.AdmissionRejected) as rejected:
+        flights.chat_response(follower_flight.wait())
+    assert (rejected.value.status, rejected.value.retry_after) == (503, 7)
+    assert group.stats()["in_flight"] == 0
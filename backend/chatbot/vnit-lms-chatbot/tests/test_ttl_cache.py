@@ -0,0 +1,46 @@
+import caches
+
+
+def make_cache(max_size=2, ttl=60):
+    return caches.TTLCache(max_size, ttl, "test")
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = make_cache()
+    cache.set("key", "value")
+    clock.advance(59)
+    assert cache.get("key") == "value"
+    clock.advance(2)
+    assert cache.get("key") is None
+    assert cache.stats()["size"] == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_the_least_recently_used_entry_is_evicted(clock):
+    cache = make_cache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "b" is now the least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.evictions == 1
+
+
+def test_setting_an_entry_again_renews_its_ttl(clock):
+    cache = make_cache()
+    cache.set("key", "old")
+    clock.advance(50)
+    cache.set("key", "new")
+    clock.advance(50)
+    assert cache.get("key") == "new"
+
+
+def test_a_value_computed_before_a_clear_is_dropped(clock):
+    cache = make_cache()
+    generation = cache.generation
+    cache.clear()  # e.g. ingestion changed the collection while the value was computed
+    cache.set("key", "stale", generation)
+    assert cache.get("key") is None
+    cache.set("key", "fresh", cache.generation)
+    assert cache.get("key") == "fresh"
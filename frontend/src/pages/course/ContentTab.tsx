@@ -41,7 +41,7 @@ import {
     Circle,
 } from "lucide-react";
 import { Badge } from "@/components/ui/badge";
-import { ingestDocuments } from "@/services/chatbotService";
+import { ingestDocuments, ingestDocumentsBulk } from "@/services/chatbotService";
 import MaterialViewer from "@/components/MaterialViewer";
 
 interface ContentTabProps {
@@ -164,6 +164,7 @@ export default function ContentTab({ courseId }: ContentTabProps) {
                 }
 
                 // Upload each drive link as a separate material
+                const driveLinksToIngest: { drive_link: string; materialId?: string }[] = [];
                 for (const driveLink of linksToProcess) {
                     const formData = new FormData();
                     formData.append("module", uploadData.module);
@@ -172,16 +173,19 @@ export default function ContentTab({ courseId }: ContentTabProps) {
                     formData.append("courseId", courseId);
                     formData.append("link", driveLink.trim());
 
-                    await materialService.uploadMaterial(formData);
+                    const material = await materialService.uploadMaterial(formData);
                     
-                    // Ingest each drive link into RAG system
                     if (driveLink.includes("drive.google.com")) {
-                        try {
-                            await ingestDocuments({ drive_link: driveLink.trim() });
-                        } catch (ingestError) {
-                            console.error(`Failed to ingest ${driveLink}:`, ingestError);
-                            // Continue with other links even if one fails
-                        }
+                        driveLinksToIngest.push({ drive_link: driveLink.trim(), materialId: material?._id });
+                    }
+                }
+
+                // Ingest all drive links into RAG system in one bulk request
+                if (driveLinksToIngest.length > 0) {
+                    try {
+                        await ingestDocumentsBulk({ drive_links: driveLinksToIngest, courseId });
+                    } catch (ingestError) {
+                        console.error("Failed to ingest drive links:", ingestError);
                     }
                 }
 
@@ -198,9 +202,9 @@ export default function ContentTab({ courseId }: ContentTabProps) {
                 formData.append("courseId", courseId);
                 formData.append("link", uploadData.link);
 
-                await materialService.uploadMaterial(formData);
+                const material = await materialService.uploadMaterial(formData);
                 if (uploadData.link.includes("drive.google.com")) {
-                    await ingestDocuments({ drive_link: uploadData.link });
+                    await ingestDocuments({ drive_link: uploadData.link, courseId, materialId: material?._id });
                 }
 
                 toast({
@@ -20,14 +20,20 @@ export const chatbotService = {
     },
 };
 
-export const ingestDocuments = async (data: any) => {
+const postIngest = async (path: string, data: any, errorMessage: string) => {
     try {
-        const response = await chatClient.post("/chatbot-api/ingest", {
+        const response = await chatClient.post(path, {
             ...data,
         });
         return response.data;
     } catch (error: any) {
-        console.error("Error ingesting documents:", error);
-        throw new Error("Failed to ingest documents");
+        console.error(`${errorMessage}:`, error);
+        throw new Error(errorMessage);
     }
 };
+
+export const ingestDocuments = (data: any) =>
+    postIngest("/chatbot-api/ingest", data, "Failed to ingest documents");
+
+export const ingestDocumentsBulk = (data: any) =>
+    postIngest("/chatbot-api/ingest/bulk", data, "Failed to queue bulk document ingestion");